@@ -0,0 +1,142 @@
+import os
+import glob
+import time
+import struct
+import logging
+import numpy as np
+
+'''
+这是录制过程的磁盘日志模块。
+录制时事件以定长二进制记录追加写入日志文件，并周期性 fsync，
+程序崩溃后可在下次启动时从日志中恢复录制内容。
+'''
+
+JOURNAL_MAGIC = b'RMJ1'
+JOURNAL_VERSION = 2
+JOURNAL_SUFFIX = '.rmj'
+# 文件头: 魔数, 版本, 单条记录字节数, 录制开始的系统时间
+JOURNAL_HEADER = struct.Struct('<4sHHd')
+
+
+class CaptureJournal:
+    """
+    录制日志文件。文件由固定长度的文件头和连续的事件记录组成，
+    事件记录的格式即为录制器的记录 dtype，可以直接内存映射读取。
+    """
+    def __init__(self, path, dtype, start_time=None, fsync_interval=1.0):
+        """
+        创建一个新的日志文件。
+        参数:
+            path (str): 日志文件路径。
+            dtype (numpy.dtype): 事件记录的 dtype。
+            start_time (float, optional): 录制开始的系统时间，默认为当前时间。
+            fsync_interval (float): 两次 fsync 之间的最小间隔（秒）。
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.start_time = time.time() if start_time is None else start_time
+        self.fsync_interval = fsync_interval
+        self.count = 0  # 已写入的记录数
+        self._last_sync = time.monotonic()
+        self._file = open(path, 'wb')
+        self._file.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, self.dtype.itemsize, self.start_time))
+        self.sync()
+
+    @classmethod
+    def create(cls, directory, dtype, start_time=None, fsync_interval=1.0):
+        """
+        在指定目录中创建一个以时间命名的日志文件。
+        参数:
+            directory (str): 日志目录，不存在时自动创建。
+        返回:
+            CaptureJournal: 新建的日志。
+        """
+        os.makedirs(directory, exist_ok=True)
+        start_time = time.time() if start_time is None else start_time
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(start_time))
+        path = os.path.join(directory, f"capture-{stamp}-{os.getpid()}{JOURNAL_SUFFIX}")
+        return cls(path, dtype, start_time, fsync_interval)
+
+    def append(self, records):
+        """
+        追加一批事件记录，并按 fsync_interval 周期性落盘。
+        参数:
+            records (numpy.ndarray): 与日志 dtype 相同的记录数组。
+        """
+        if not len(records):
+            return
+        self._file.write(np.ascontiguousarray(records, dtype=self.dtype).tobytes())
+        self.count += len(records)
+        if time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """将缓冲数据写入磁盘。"""
+        if self._file.closed:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        """落盘并关闭日志文件（文件保留在磁盘上）。"""
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def discard(self):
+        """关闭并删除日志文件，在录制内容已安全导出后调用。"""
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            logging.error(f"删除录制日志失败: {self.path}, 错误: {e}")
+
+    def events(self):
+        """
+        以内存映射方式读取当前已写入的事件。
+        返回:
+            numpy.ndarray: 事件记录数组（只读）。
+        """
+        if not self._file.closed:
+            self._file.flush()
+        return read_journal(self.path, self.dtype)[1]
+
+
+def read_journal(path, dtype):
+    """
+    读取日志文件。崩溃时最后一条记录可能只写了一半，这部分会被忽略。
+    参数:
+        path (str): 日志文件路径。
+        dtype (numpy.dtype): 期望的事件记录 dtype。
+    返回:
+        tuple: (录制开始的系统时间, 内存映射的事件数组)。
+    异常:
+        ValueError: 文件头无效或记录格式不匹配。
+    """
+    dtype = np.dtype(dtype)
+    with open(path, 'rb') as f:
+        header = f.read(JOURNAL_HEADER.size)
+    if len(header) < JOURNAL_HEADER.size:
+        raise ValueError(f"录制日志文件头不完整: {path}")
+    magic, version, record_size, start_time = JOURNAL_HEADER.unpack(header)
+    if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION or record_size != dtype.itemsize:
+        raise ValueError(f"不支持的录制日志格式: {path}")
+    count = (os.path.getsize(path) - JOURNAL_HEADER.size) // record_size
+    if count <= 0:
+        return start_time, np.empty(0, dtype=dtype)
+    events = np.memmap(path, dtype=dtype, mode='r', offset=JOURNAL_HEADER.size, shape=(count,))
+    return start_time, events
+
+
+def find_journals(directory):
+    """
+    查找目录中遗留的录制日志（上次运行未正常导出的录制）。
+    参数:
+        directory (str): 日志目录。
+    返回:
+        list: 日志文件路径列表，按名称（即时间）排序。
+    """
+    if not directory or not os.path.isdir(directory):
+        return []
+    return sorted(glob.glob(os.path.join(directory, '*' + JOURNAL_SUFFIX)))
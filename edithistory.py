@@ -0,0 +1,362 @@
+import heapq
+import sys
+import time
+from collections import deque
+import numpy as np
+
+'''
+这是编辑历史（撤销/重做）模块。
+每次编辑记录为一条列式差异，不复制文档：
+- 修改的音符: 音符对象（作为 id）、所属乐器序号，以及修改前后的 (开始, 结束, 音高, 力度) 两个数组；
+- 删除的音符: 所属乐器、在编辑前的列表中的位置和音符对象（撤销时原样放回）；
+- 新增的音符: 所属乐器、在编辑后的列表中的位置和音符对象。
+每个乐器的音符列表始终按开始时间排序：新增的音符二分查找插入位置（大批量时与原列表一次归并），
+开始时间被修改的音符在提交时移到新的位置（记为同一音符的删除和新增），删除任意多个音符只遍历列表一次。
+历史总大小受内存预算限制，超出时丢弃最早的记录；短时间内对同一组音符的同类编辑（连续拖动、连续调整力度）合并为一条。
+'''
+
+DEFAULT_MEMORY_BUDGET = 64 << 20  # 编辑历史默认最多占用的内存（字节）
+COALESCE_SECONDS = 1.5  # 间隔不超过此时长的同类编辑合并为一条记录
+_NOTE_BYTES = sys.getsizeof(object()) + 120  # 由记录独占的音符对象（已删除的音符）的估计大小
+MERGE_THRESHOLD = 32  # 一次插入超过这么多音符时改为与原列表归并
+
+
+def _note_values(note):
+    return note.start, note.end, note.pitch, note.velocity
+
+
+def _start(note):
+    return note.start
+
+
+def _bisect_start(notes, start):
+    """返回按开始时间排序的列表中第一个开始时间大于 start 的位置（二分查找）。"""
+    low, high = 0, len(notes)
+    while low < high:
+        middle = (low + high) // 2
+        if notes[middle].start <= start:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def insert_sorted(notes, inserted):
+    """
+    把音符按开始时间插入已排序的音符列表（开始时间相同时排在原有音符之后，与追加后稳定排序的结果一致）。
+    少量音符逐个二分查找位置后插入；数量较多时排序后与原列表一次归并，O(n + k log k)。
+    参数:
+        notes (list): 按开始时间排序的音符列表。
+        inserted (iterable): 要插入的音符。
+    返回:
+        list: 插入后的列表（逐个插入时就是传入的列表）。
+    """
+    inserted = sorted(inserted, key=_start)
+    if len(inserted) <= MERGE_THRESHOLD:
+        for note in inserted:
+            notes.insert(_bisect_start(notes, note.start), note)
+        return notes
+    return list(heapq.merge(notes, inserted, key=_start))
+
+
+def _remove_by_identity(notes, targets):
+    """
+    从列表中删除指定的音符对象（按对象而不是按值比较，一次遍历）。
+    返回:
+        tuple: (剩余的音符列表, 被删除音符的位置列表, 按原顺序排列的被删除音符)。
+    """
+    ids = {id(note) for note in targets}
+    kept, positions, removed = [], [], []
+    for position, note in enumerate(notes):
+        if id(note) in ids:
+            positions.append(position)
+            removed.append(note)
+        else:
+            kept.append(note)
+    return kept, positions, removed
+
+
+def _note_ids(groups):
+    """{乐器序号: (位置列表, 音符列表)} -> {(乐器序号, id(音符))}。"""
+    return {(index, id(note)) for index, (_, notes) in groups.items() for note in notes}
+
+
+def _insert_at(notes, positions, inserted):
+    """
+    把音符插回列表中的指定位置（位置是插入完成后的下标，一次遍历）。
+    参数:
+        notes (list): 当前的音符列表。
+        positions (list): 升序的目标位置。
+        inserted (list): 与 positions 对应的音符。
+    """
+    result = []
+    remaining = iter(notes)
+    targets = dict(zip(positions, inserted))
+    for position in range(len(notes) + len(inserted)):
+        result.append(targets[position] if position in targets else next(remaining))
+    return result
+
+
+class NoteEdit:
+    """
+    一次编辑的差异记录。由 MidiDocument.begin_edit 创建，编辑操作在修改数据之前/之后调用
+    change / remove / add 报告受影响的音符，最后由 MidiDocument.end_edit 提交；
+    提交时按差异一次性批量更新文档的增量统计。
+    """
+    def __init__(self, document, label, coalesce_key=None):
+        """
+        参数:
+            document (MidiDocument): 被编辑的文档。
+            label (str): 编辑的名称（如“删除音符”）。
+            coalesce_key (hashable, optional): 合并键，与上一条记录相同且间隔很短时两条记录合并。
+        """
+        self.document = document
+        self.label = label
+        self.coalesce_key = coalesce_key
+        self.time = time.monotonic()
+        self.changed = []  # 修改的音符对象
+        self.changed_instruments = []
+        self.before = []  # 提交后为 (n, 4) 数组
+        self.after = None
+        self._changed_ids = set()
+        self.removed = {}  # 乐器序号 -> (位置列表, 音符列表)
+        self.added = {}  # 乐器序号 -> 音符列表；提交后为 (位置列表, 音符列表)
+        self.extent = None  # 提交后为 (最早 tick, 最晚 tick, 乐器序号集合)
+
+    def change(self, instrument, note):
+        """修改音符之前调用（同一音符多次调用只记录第一次的值）。"""
+        if id(note) in self._changed_ids:
+            return
+        index = self.document._instrument_index(instrument)
+        self._changed_ids.add(id(note))
+        self.changed.append(note)
+        self.changed_instruments.append(index)
+        self.before.append(_note_values(note))
+
+    def insert(self, instrument, notes):
+        """
+        把新音符按开始时间插入乐器的音符列表。
+        参数:
+            instrument (miditoolkit.Instrument or int): 乐器（或乐器序号）。
+            notes (iterable): 新的音符对象。
+        """
+        notes = list(notes)
+        index = self.document._instrument_index(instrument)
+        target = self.document.midi.instruments[index]
+        target.notes = insert_sorted(target.notes, notes)
+        self.added.setdefault(index, []).extend(notes)
+
+    def remove(self, instrument, notes):
+        """
+        从乐器中删除一组音符（按对象一次遍历完成删除，并记录原来的位置）。
+        参数:
+            instrument (miditoolkit.Instrument or int): 乐器（或乐器序号）。
+            notes (iterable): 要删除的音符对象。
+        """
+        index = self.document._instrument_index(instrument)
+        target = self.document.midi.instruments[index]
+        if index in self.removed:
+            raise ValueError("同一次编辑中每个乐器只能删除一次音符")
+        target.notes, positions, removed = _remove_by_identity(target.notes, notes)
+        if removed:
+            self.removed[index] = (positions, removed)
+
+    def finish(self):
+        """
+        提交时调用：记录修改后的值（丢弃数值没有变化的音符），把新增音符的位置固定下来，
+        计算编辑影响的范围，并更新文档的增量统计。
+        """
+        before = np.array(self.before, dtype=np.int64).reshape(-1, 4)
+        after = np.array([_note_values(note) for note in self.changed], dtype=np.int64).reshape(-1, 4)
+        modified = (before != after).any(axis=1)
+        self.before, self.after = before[modified], after[modified]
+        self.changed = [note for note, keep in zip(self.changed, modified.tolist()) if keep]
+        self.changed_instruments = np.array(self.changed_instruments, dtype=np.int64)[modified]
+        self._changed_ids = None
+        self._reorder_moved()
+        for index, notes in list(self.added.items()):
+            ids = {id(note) for note in notes}
+            located = [(position, note) for position, note in enumerate(self.document.midi.instruments[index].notes)
+                       if id(note) in ids]
+            self.added[index] = ([position for position, _ in located], [note for _, note in located])
+        self.extent = self._extent()
+        self._update_document(self.before, self.after, self.removed, self.added)
+
+    def _reorder_moved(self):
+        """
+        把开始时间被修改的音符移到按开始时间排序的新位置（每个乐器遍历一次列表），记为这些音符的删除和新增：
+        撤销时先把它们从新位置取出、恢复原值，再放回原来的位置。
+        只处理本次编辑没有删除音符的乐器（移动和量化不会同时删除音符）。
+        """
+        starts_changed = (self.before[:, 0] != self.after[:, 0]).tolist()
+        moved = {}
+        for note, index, changed in zip(self.changed, self.changed_instruments.tolist(), starts_changed):
+            if changed and index not in self.removed:
+                moved.setdefault(index, []).append(note)
+        for index, notes in moved.items():
+            target = self.document.midi.instruments[index]
+            ids = {id(note) for note in notes}
+            added_ids = {id(note) for note in self.added.get(index, ())}
+            kept, positions, removed = [], [], []
+            added_before = 0  # 位置之前本次新增的音符数，换算为编辑前列表中的位置
+            for position, note in enumerate(target.notes):
+                if id(note) in ids:
+                    positions.append(position - added_before)
+                    removed.append(note)
+                else:
+                    kept.append(note)
+                    added_before += id(note) in added_ids
+            target.notes = insert_sorted(kept, removed)
+            self.removed[index] = (positions, removed)
+            self.added.setdefault(index, []).extend(removed)
+
+    def _extent(self):
+        """
+        返回:
+            tuple: 编辑影响的 (最早 tick, 最晚 tick, 乐器序号集合)，撤销和重做影响的范围相同。
+        """
+        removed_instruments, removed_values = self._group_values(self.removed)
+        added_instruments, added_values = self._group_values(self.added)
+        values = np.concatenate((self.before, self.after, removed_values, added_values))
+        if not len(values):
+            return 0, 0, set()
+        tracks = set(np.concatenate((self.changed_instruments, removed_instruments, added_instruments)).tolist())
+        return int(values[:, 0].min()), int(values[:, 1].max()), tracks
+
+    def _update_document(self, old_values, new_values, dropped, inserted):
+        """
+        按差异批量更新文档统计：先移除旧值（修改前的值和被删除的音符），再加入新值。
+        只是移到新位置的音符的数值变化已包含在修改前后的值中，不重复计入。
+        """
+        moved = _note_ids(dropped) & _note_ids(inserted)
+        removed_instruments, removed_values = self._group_values(dropped, moved)
+        added_instruments, added_values = self._group_values(inserted, moved)
+        self.document.notes_removed(np.concatenate((self.changed_instruments, removed_instruments)),
+                                    np.concatenate((old_values, removed_values)))
+        self.document.notes_added(np.concatenate((self.changed_instruments, added_instruments)),
+                                  np.concatenate((new_values, added_values)))
+
+    @staticmethod
+    def _group_values(groups, exclude=()):
+        """{乐器序号: (位置列表, 音符列表)} -> (乐器序号数组, (n, 4) 数组)，跳过 exclude 中的 (乐器序号, id(音符))。"""
+        notes = [(index, note) for index, (_, group) in groups.items() for note in group
+                 if (index, id(note)) not in exclude]
+        instruments = [index for index, _ in notes]
+        values = [_note_values(note) for _, note in notes]
+        return (np.array(instruments, dtype=np.int64),
+                np.array(values, dtype=np.int64).reshape(-1, 4))
+
+    def is_empty(self):
+        return not self.changed and not self.removed and not self.added
+
+    def nbytes(self):
+        """记录占用内存的估计值。"""
+        size = self.before.nbytes + self.after.nbytes + self.changed_instruments.nbytes + 8 * len(self.changed)
+        moved = len(_note_ids(self.removed) & _note_ids(self.added))  # 移到新位置的音符仍在文档中
+        for positions, notes in self.removed.values():
+            size += len(notes) * (16 + _NOTE_BYTES)  # 删除的音符只由记录持有
+        for positions, notes in self.added.values():
+            size += len(notes) * 16
+        return size - moved * _NOTE_BYTES
+
+    def _apply(self, values, take, put):
+        """按差异把文档切换到编辑前（撤销）或编辑后（重做）的状态。"""
+        instruments = self.document.midi.instruments
+        current = self.after if values is self.before else self.before
+        for index, (positions, notes) in put.items():
+            instruments[index].notes = _remove_by_identity(instruments[index].notes, notes)[0]
+        for note, row in zip(self.changed, values.tolist()):
+            note.start, note.end, note.pitch, note.velocity = row
+        for index, (positions, notes) in take.items():
+            instruments[index].notes = _insert_at(instruments[index].notes, positions, notes)
+        self._update_document(current, values, put, take)
+
+    def undo(self):
+        self._apply(self.before, self.removed, self.added)
+
+    def redo(self):
+        self._apply(self.after, self.added, self.removed)
+
+    def merge(self, newer):
+        """
+        尝试把紧接着的同类编辑合并到本记录中（只合并修改的是同一组音符、且没有增删其他音符的编辑）。
+        两条记录都只是把同一组音符移到新位置时，合并后沿用本记录的原位置和新记录的新位置。
+        返回:
+            bool: 是否已合并。
+        """
+        moved = _note_ids(self.removed)
+        if (self.coalesce_key is None or newer.coalesce_key != self.coalesce_key
+                or newer.time - self.time > COALESCE_SECONDS
+                or not (moved == _note_ids(self.added) == _note_ids(newer.removed) == _note_ids(newer.added))
+                or len(self.changed) != len(newer.changed)
+                or any(a is not b for a, b in zip(self.changed, newer.changed))):
+            return False
+        self.after = newer.after
+        self.added = newer.added
+        self.time = newer.time
+        self.extent = (min(self.extent[0], newer.extent[0]), max(self.extent[1], newer.extent[1]),
+                       self.extent[2] | newer.extent[2])
+        return True
+
+
+class EditHistory:
+    """
+    撤销/重做栈。记录总大小超过内存预算时丢弃最早的记录（至少保留最近的一条）。
+    """
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        参数:
+            memory_budget (int): 撤销和重做记录最多占用的内存（字节）。
+        """
+        self.memory_budget = memory_budget
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.size = 0
+
+    def push(self, edit):
+        """记录一次新的编辑（清空重做栈）。"""
+        if edit.is_empty():
+            return
+        self.size -= sum(record.nbytes() for record in self.redo_stack)
+        self.redo_stack.clear()
+        if self.undo_stack and self.undo_stack[-1].merge(edit):
+            return
+        self.undo_stack.append(edit)
+        self.size += edit.nbytes()
+        self._trim()
+
+    def _trim(self):
+        while self.size > self.memory_budget and len(self.undo_stack) > 1:
+            self.size -= self.undo_stack.popleft().nbytes()
+
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def undo(self):
+        """
+        撤销最近一次编辑。
+        返回:
+            NoteEdit or None: 被撤销的记录，没有可撤销的编辑时为 None。
+        """
+        if not self.undo_stack:
+            return None
+        edit = self.undo_stack.pop()
+        edit.undo()
+        self.redo_stack.append(edit)
+        return edit
+
+    def redo(self):
+        """
+        重做最近一次撤销的编辑。
+        返回:
+            NoteEdit or None: 被重做的记录，没有可重做的编辑时为 None。
+        """
+        if not self.redo_stack:
+            return None
+        edit = self.redo_stack.pop()
+        edit.redo()
+        self.undo_stack.append(edit)
+        return edit
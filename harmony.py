@@ -0,0 +1,307 @@
+import numpy as np
+
+'''
+这是调性分析模块。
+按时值加权统计音级分布（12 个音级的直方图），与大调/小调模板做相关匹配来估计调性。
+也可以按小节分析：向量化地把音符时值分摊到各小节，按滑动窗口估计调性或五声调式（宫商角徵羽），
+按小节匹配三和弦；编辑后只更新受影响的小节。
+'''
+
+PITCH_CLASS_NAMES = ['C', 'C#', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab', 'A', 'Bb', 'B']
+
+# Krumhansl-Kessler 调性轮廓（以 C 大调 / C 小调为主音）
+_MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+_MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+
+def _key_templates():
+    """24 个调的模板矩阵 (24, 12)：前 12 行为各主音的大调，后 12 行为小调，每行已去均值并归一化。"""
+    rows = [np.roll(profile, tonic) for profile in (_MAJOR_PROFILE, _MINOR_PROFILE) for tonic in range(12)]
+    templates = np.array(rows)
+    templates -= templates.mean(axis=1, keepdims=True)
+    templates /= np.linalg.norm(templates, axis=1, keepdims=True)
+    return templates
+
+
+KEY_TEMPLATES = _key_templates()
+KEY_NAMES = PITCH_CLASS_NAMES + [name + 'm' for name in PITCH_CLASS_NAMES]  # 与 KEY_TEMPLATES 的行对应
+
+
+def pitch_class_histogram(pitches, weights=None):
+    """
+    统计音级直方图。
+    参数:
+        pitches (numpy.ndarray): 音高 (0-127)。
+        weights (numpy.ndarray, optional): 每个音符的权重（通常为时值），默认每个音符计 1。
+    返回:
+        numpy.ndarray: 长度为 12 的直方图。
+    """
+    pitches = np.asarray(pitches, dtype=np.int64)
+    return np.bincount(pitches % 12, weights=weights, minlength=12).astype(np.float64)
+
+
+def match_keys(histograms):
+    """
+    将一个或多个音级直方图与 24 个调模板做相关匹配。
+    参数:
+        histograms (numpy.ndarray): 形状为 (12,) 或 (n, 12) 的直方图。
+    返回:
+        tuple: (调序号, 相关系数)，调序号对应 KEY_NAMES；全零的直方图序号为 -1。
+    """
+    histograms = np.atleast_2d(np.asarray(histograms, dtype=np.float64))
+    centered = histograms - histograms.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(centered, axis=1)
+    scores = centered @ KEY_TEMPLATES.T / np.where(norms > 0, norms, 1)[:, None]
+    best = scores.argmax(axis=1)
+    correlation = scores[np.arange(len(best)), best]
+    best[norms == 0] = -1
+    return best, correlation
+
+
+def estimate_key(pitches, weights=None):
+    """
+    估计一组音符的调性。
+    参数:
+        pitches (numpy.ndarray): 音高。
+        weights (numpy.ndarray, optional): 每个音符的权重（通常为时值）。
+    返回:
+        str or None: 调名（如 'G'、'Em'），没有音符时为 None。
+    """
+    if not len(pitches):
+        return None
+    best, _ = match_keys(pitch_class_histogram(pitches, weights))
+    return KEY_NAMES[best[0]] if best[0] >= 0 else None
+
+
+# --- 五声调式 ---
+
+MODE_NAMES = ['宫', '商', '角', '徵', '羽']
+_PENTATONIC = np.array([0, 2, 4, 7, 9])  # 以宫音为 0 的五声音阶，第 i 个音是第 i 种调式的主音
+PENTATONIC_THRESHOLD = 0.9  # 五声音阶内的时值占比达到此值时按五声调式命名
+
+
+def _mode_templates():
+    """60 个五声调式模板 (60, 12)：第 (宫音*5 + 调式) 行，主音和主音上方纯五度加重，已去均值并归一化。"""
+    rows = []
+    for gong in range(12):
+        collection = (gong + _PENTATONIC) % 12
+        for tonic in collection:
+            row = np.zeros(12)
+            row[collection] = 1.0
+            row[tonic] += 1.5
+            if (tonic + 7) % 12 in collection:
+                row[(tonic + 7) % 12] += 0.5
+            rows.append(row)
+    templates = np.array(rows)
+    templates -= templates.mean(axis=1, keepdims=True)
+    templates /= np.linalg.norm(templates, axis=1, keepdims=True)
+    return templates
+
+
+MODE_TEMPLATES = _mode_templates()
+_COLLECTION_MASKS = np.array([np.isin(np.arange(12), (gong + _PENTATONIC) % 12) for gong in range(12)], dtype=np.float64)
+
+
+def match_keys_or_modes(histograms):
+    """
+    为每个直方图命名调性：五声音阶内的时值占比不低于 PENTATONIC_THRESHOLD 时按五声调式命名
+    （如 'G宫'、'E羽'），否则按大小调命名（与 match_keys 相同）。
+    参数:
+        histograms (numpy.ndarray): 形状为 (n, 12) 的直方图。
+    返回:
+        list: 每个直方图的名称，全零的直方图为 None。
+    """
+    histograms = np.atleast_2d(np.asarray(histograms, dtype=np.float64))
+    keys, _ = match_keys(histograms)
+    totals = histograms.sum(axis=1)
+    inside = histograms @ _COLLECTION_MASKS.T / np.where(totals > 0, totals, 1)[:, None]
+    gong = inside.argmax(axis=1)
+    pentatonic = inside[np.arange(len(gong)), gong] >= PENTATONIC_THRESHOLD
+    centered = histograms - histograms.mean(axis=1, keepdims=True)
+    # 只比较同一音阶（同一宫音）的 5 种调式
+    candidates = MODE_TEMPLATES.reshape(12, 5, 12)[gong]
+    mode = np.einsum('nmk,nk->nm', candidates, centered).argmax(axis=1)
+    tonic = (gong + _PENTATONIC[mode]) % 12
+    names = []
+    for index in range(len(histograms)):
+        if keys[index] < 0:
+            names.append(None)
+        elif pentatonic[index]:
+            names.append(PITCH_CLASS_NAMES[tonic[index]] + MODE_NAMES[mode[index]])
+        else:
+            names.append(KEY_NAMES[keys[index]])
+    return names
+
+
+# --- 和弦 ---
+
+_CHORD_QUALITIES = [('', (0, 4, 7)), ('m', (0, 3, 7)), ('dim', (0, 3, 6))]
+
+
+def _chord_templates():
+    """36 个三和弦模板 (36, 12)：第 (性质*12 + 根音) 行，根音加重，已归一化。"""
+    rows = []
+    for _, intervals in _CHORD_QUALITIES:
+        for root in range(12):
+            row = np.zeros(12)
+            row[(root + np.array(intervals)) % 12] = 1.0
+            row[root] += 0.2
+            rows.append(row / np.linalg.norm(row))
+    return np.array(rows)
+
+
+CHORD_TEMPLATES = _chord_templates()
+CHORD_NAMES = [PITCH_CLASS_NAMES[root] + suffix for suffix, _ in _CHORD_QUALITIES for root in range(12)]
+
+
+def match_chords(histograms):
+    """
+    用余弦相似度将音级直方图与三和弦模板匹配。
+    参数:
+        histograms (numpy.ndarray): 形状为 (n, 12) 的直方图。
+    返回:
+        list: 和弦名（如 'C'、'Am'、'Bdim'），全零的直方图为 None。
+    """
+    histograms = np.atleast_2d(np.asarray(histograms, dtype=np.float64))
+    norms = np.linalg.norm(histograms, axis=1)
+    best = (histograms @ CHORD_TEMPLATES.T).argmax(axis=1)
+    return [CHORD_NAMES[b] if norm > 0 else None for b, norm in zip(best.tolist(), norms.tolist())]
+
+
+# --- 按小节分析 ---
+
+def bar_starts(time_signatures, ticks_per_beat, end_tick):
+    """
+    按拍号变化计算小节线。
+    参数:
+        time_signatures (list): [(tick, 分子, 分母)]，0 tick 前没有拍号时按 4/4。
+        ticks_per_beat (int): 每拍 tick 数。
+        end_tick (int): 需要覆盖到的 tick。
+    返回:
+        numpy.ndarray: 各小节的起始 tick，最后一个元素是最后一小节的结束位置（至少一个小节）。
+    """
+    changes = sorted((int(tick), n, d) for tick, n, d in time_signatures if n > 0 and d > 0)
+    if not changes or changes[0][0] > 0:
+        changes.insert(0, (0, 4, 4))
+    segments = []
+    for index, (tick, numerator, denominator) in enumerate(changes):
+        length = max(int(ticks_per_beat * 4 * numerator // denominator), 1)
+        stop = changes[index + 1][0] if index + 1 < len(changes) else max(end_tick, tick) + 1
+        segments.append(np.arange(tick, stop, length, dtype=np.int64))
+    bars = np.concatenate(segments)
+    return np.append(bars, bars[-1] + length)
+
+
+def bar_histograms(bars, start, end, pitch):
+    """
+    向量化计算每个小节内按时值加权的音级直方图（跨小节的音符按各小节内的时长分摊）。
+    对每个音级，到 t 为止的发声总时长 F(t) = Σ(t - 开始, 开始 < t) - Σ(t - 结束, 结束 < t)，
+    用排序后的前缀和在所有小节线上一次求出，直方图即相邻小节线上 F 的差。
+    参数:
+        bars (numpy.ndarray): bar_starts 返回的小节线。
+        start, end, pitch (numpy.ndarray): 音符的开始 tick、结束 tick 和音高。
+    返回:
+        numpy.ndarray: (小节数, 12) 的 int64 直方图（单位为 tick）。
+    """
+    bars = np.asarray(bars, dtype=np.int64)
+    pitch_class = np.asarray(pitch, dtype=np.int64) % 12
+    span = max(int(bars[-1]), int(np.max(end, initial=0))) + 1
+    queries = np.arange(12)[:, None] * span + bars[None, :]
+    covered = np.zeros(queries.shape, dtype=np.int64)
+    for ticks, sign in ((start, 1), (end, -1)):
+        ticks = np.asarray(ticks, dtype=np.int64)
+        keyed = pitch_class * span + ticks  # 按 (音级, tick) 排序
+        order = np.argsort(keyed, kind='stable')
+        keyed = keyed[order]
+        sums = np.concatenate(([0], np.cumsum(ticks[order])))
+        first = np.searchsorted(keyed, np.arange(12) * span)[:, None]
+        before = np.searchsorted(keyed, queries)
+        covered += sign * (bars[None, :] * (before - first) - (sums[before] - sums[first]))
+    return np.diff(covered, axis=1).T
+
+
+class BarHarmony:
+    """
+    每个小节的音级直方图、调性（或五声调式）和和弦。
+    调性按前后 KEY_WINDOW_BARS 个小节的滑动窗口估计，和弦按单个小节估计。
+    增删音符时只更新它们跨越的小节的直方图，读取名称时只重新匹配受影响的小节。
+    """
+    KEY_WINDOW_BARS = 2
+
+    def __init__(self, time_signatures, ticks_per_beat, start, end, pitch):
+        """
+        参数:
+            time_signatures (list): [(tick, 分子, 分母)]。
+            ticks_per_beat (int): 每拍 tick 数。
+            start, end, pitch (numpy.ndarray): 参与分析的音符（通常不含鼓组）。
+        """
+        self.time_signatures = list(time_signatures)
+        self.ticks_per_beat = ticks_per_beat
+        self.bars = bar_starts(self.time_signatures, ticks_per_beat, int(np.max(end, initial=0)))
+        self.histograms = bar_histograms(self.bars, start, end, pitch)
+        count = len(self.histograms)
+        self.keys = [None] * count
+        self.chords = [None] * count
+        self._dirty = (0, count)
+
+    def _extend(self, end_tick):
+        """音符超出最后一个小节时按最后的拍号追加小节。"""
+        bars = bar_starts(self.time_signatures, self.ticks_per_beat, end_tick)
+        extra = len(bars) - len(self.bars)
+        self.bars = bars
+        self.histograms = np.vstack((self.histograms, np.zeros((extra, 12), dtype=np.int64)))
+        self.keys += [None] * extra
+        self.chords += [None] * extra
+        self._mark_dirty(len(self.histograms) - extra, len(self.histograms))
+
+    def _mark_dirty(self, first, last):
+        if self._dirty is None:
+            self._dirty = (first, last)
+        else:
+            self._dirty = (min(self._dirty[0], first), max(self._dirty[1], last))
+
+    def update(self, start, end, pitch, sign=1):
+        """
+        批量记录新增（sign=1）或删除（sign=-1）的音符：把每个音符的时值分摊到它跨越的小节（向量化）。
+        参数:
+            start, end, pitch (numpy.ndarray): 音符的开始 tick、结束 tick 和音高。
+            sign (int): 1 或 -1。
+        """
+        start = np.asarray(start, dtype=np.int64)
+        end = np.asarray(end, dtype=np.int64)
+        pitch = np.asarray(pitch, dtype=np.int64)
+        sounding = end > start
+        start, end, pitch = start[sounding], end[sounding], pitch[sounding]
+        if not len(start):
+            return
+        if end.max() > self.bars[-1]:
+            self._extend(int(end.max()))
+        first = np.searchsorted(self.bars, start, side='right') - 1
+        spans = np.searchsorted(self.bars, end, side='left') - first
+        # 每个 (音符, 跨越的小节) 一行
+        note = np.repeat(np.arange(len(start)), spans)
+        bar = first[note] + np.arange(len(note)) - np.repeat(np.cumsum(spans) - spans, spans)
+        overlap = np.minimum(end[note], self.bars[bar + 1]) - np.maximum(start[note], self.bars[bar])
+        np.add.at(self.histograms, (bar, pitch[note] % 12), sign * overlap)
+        self._mark_dirty(int(first.min()), int((first + spans).max()))
+
+    def labels(self):
+        """
+        返回:
+            tuple: (每个小节的调名列表, 每个小节的和弦名列表)，没有音符的小节为 None。
+        """
+        if self._dirty is not None:
+            first, last = self._dirty
+            window = self.KEY_WINDOW_BARS
+            count = len(self.histograms)
+            # 调性窗口覆盖到受影响小节前后 window 个小节
+            key_first, key_last = max(first - window, 0), min(last + window, count)
+            low, high = max(key_first - window, 0), min(key_last + window, count)
+            cumulative = np.concatenate((np.zeros((1, 12), dtype=np.int64), np.cumsum(self.histograms[low:high], axis=0)))
+            index = np.arange(key_first, key_last)
+            windows = (cumulative[np.minimum(index + window + 1, count) - low]
+                       - cumulative[np.maximum(index - window, 0) - low])
+            self.keys[key_first:key_last] = match_keys_or_modes(windows)
+            self.chords[first:last] = match_chords(self.histograms[first:last])
+            self._dirty = None
+        return self.keys, self.chords
@@ -0,0 +1,182 @@
+import json
+import os
+from PyQt5 import QtCore, QtGui, QtWidgets
+from midilibrary import MidiLibrary
+from thumbnails import THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT, thumbnail_path
+
+'''
+这是曲库浏览窗口。
+搜索只查询 SQLite 索引，不打开任何 MIDI 文件；扫描文件夹在后台线程（及其进程池）中进行。
+预览图直接读取扫描时按内容哈希缓存的缩略图，不需要把文件加载到钢琴卷帘中。
+'''
+
+
+class LibraryScanWorker(QtCore.QThread):
+    """在后台线程中增量扫描文件夹，解析工作由 MidiLibrary.scan 分发到进程池。"""
+    progress = QtCore.pyqtSignal(int, int)  # (已完成数, 待解析总数)
+    scanned = QtCore.pyqtSignal(int, int, str)  # (新增或更新数, 移除数, 错误信息)
+
+    def __init__(self, db_path, root, thumbnail_dir=None, parent=None):
+        """
+        参数:
+            db_path (str): 索引数据库路径。
+            root (str): 要扫描的文件夹。
+            thumbnail_dir (str, optional): 缩略图缓存目录。
+        """
+        super().__init__(parent)
+        self.db_path = db_path
+        self.root = root
+        self.thumbnail_dir = thumbnail_dir
+
+    def run(self):
+        changed = removed = 0
+        error = ""
+        try:
+            library = MidiLibrary(self.db_path)  # 扫描线程使用自己的连接
+            try:
+                changed, removed = library.scan(self.root, progress=self.progress.emit,
+                                                thumbnail_dir=self.thumbnail_dir)
+            finally:
+                library.close()
+        except Exception as e:
+            error = str(e)
+        self.scanned.emit(changed, removed, error)
+
+
+class LibraryPanel(QtWidgets.QDialog):
+    """
+    曲库浏览窗口（非模态）。双击结果时发出 file_activated(文件路径)。
+    """
+    file_activated = QtCore.pyqtSignal(str)
+
+    # (列标题, 从索引记录生成显示值的函数；数值按数值排序)
+    COLUMNS = [
+        ("预览", lambda row: ""),  # 缩略图显示为图标
+        ("文件名", lambda row: row['name']),
+        ("时长", lambda row: f"{int(row['duration'] // 60):02d}:{int(row['duration'] % 60):02d}"
+                             if row['duration'] is not None else ""),
+        ("速度", lambda row: "" if row['tempo_min'] is None else
+                             f"{row['tempo_min']:.0f}" if round(row['tempo_min']) == round(row['tempo_max'])
+                             else f"{row['tempo_min']:.0f}-{row['tempo_max']:.0f}"),
+        ("调性", lambda row: row['key'] or ""),
+        ("音符数", lambda row: "" if row['note_count'] is None else row['note_count']),
+        ("音色", lambda row: ", ".join(map(str, json.loads(row['programs']))) if row['programs'] else ""),
+        ("路径", lambda row: row['error'] and f"[无法解析] {row['path']}" or row['path']),
+    ]
+
+    def __init__(self, db_path, thumbnail_dir=None, parent=None):
+        """
+        参数:
+            db_path (str): 索引数据库路径。
+            thumbnail_dir (str, optional): 缩略图缓存目录。
+        """
+        super().__init__(parent)
+        self.setWindowTitle("曲库")
+        self.resize(900, 520)
+        self.db_path = db_path
+        self.thumbnail_dir = thumbnail_dir
+        self.library = MidiLibrary(db_path)
+        self.scan_worker = None
+        self.thumbnails = {}  # 内容哈希 -> QPixmap
+
+        self.search_edit = QtWidgets.QLineEdit()
+        self.search_edit.setPlaceholderText("搜索文件名、路径或调性（如 茉莉花、G、Em）")
+        self.search_edit.textChanged.connect(self.refresh)
+        self.scan_button = QtWidgets.QPushButton("扫描文件夹...")
+        self.scan_button.clicked.connect(lambda: self.scan_folder())
+        self.status_label = QtWidgets.QLabel()
+
+        self.table = QtWidgets.QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels([title for title, _ in self.COLUMNS])
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.table.verticalHeader().setVisible(False)
+        self.table.verticalHeader().setDefaultSectionSize(THUMBNAIL_HEIGHT + 4)
+        self.table.setIconSize(QtCore.QSize(THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT))
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.cellDoubleClicked.connect(self._on_row_activated)
+
+        top = QtWidgets.QHBoxLayout()
+        top.addWidget(self.search_edit)
+        top.addWidget(self.scan_button)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addLayout(top)
+        layout.addWidget(self.table)
+        layout.addWidget(self.status_label)
+        self.refresh()
+
+    def refresh(self):
+        """按搜索框的内容查询索引并刷新列表。"""
+        rows = self.library.search(self.search_edit.text())
+        self.table.setSortingEnabled(False)
+        self.table.setRowCount(len(rows))
+        for r, row in enumerate(rows):
+            for c, (_, value) in enumerate(self.COLUMNS):
+                item = QtWidgets.QTableWidgetItem()
+                item.setData(QtCore.Qt.DisplayRole, value(row))
+                item.setData(QtCore.Qt.UserRole, row['path'])
+                self.table.setItem(r, c, item)
+            thumbnail = self._thumbnail(row['hash'])
+            if thumbnail is not None:
+                self.table.item(r, 0).setData(QtCore.Qt.DecorationRole, thumbnail)
+        self.table.setSortingEnabled(True)
+        self.table.resizeColumnsToContents()
+        if not self.is_scanning():
+            self.status_label.setText(f"共 {len(rows)} 个结果")
+
+    def _thumbnail(self, content_hash):
+        """返回缓存的缩略图（QPixmap），尚未生成时返回 None。"""
+        if not self.thumbnail_dir or not content_hash:
+            return None
+        pixmap = self.thumbnails.get(content_hash)
+        if pixmap is None:
+            path = thumbnail_path(self.thumbnail_dir, content_hash)
+            if not os.path.exists(path):
+                return None
+            pixmap = self.thumbnails[content_hash] = QtGui.QPixmap(path)
+        return pixmap
+
+    def is_scanning(self):
+        """返回是否正在扫描。"""
+        return self.scan_worker is not None and self.scan_worker.isRunning()
+
+    def scan_folder(self, root=None):
+        """
+        在后台增量扫描文件夹（未指定时弹出文件夹选择对话框）。
+        参数:
+            root (str, optional): 要扫描的文件夹。
+        """
+        if self.is_scanning():
+            return
+        if root is None:
+            root = QtWidgets.QFileDialog.getExistingDirectory(self, "选择要扫描的文件夹", os.getcwd())
+            if not root:
+                return
+        self.scan_button.setEnabled(False)
+        self.status_label.setText(f"正在扫描: {root}")
+        self.scan_worker = LibraryScanWorker(self.db_path, root, self.thumbnail_dir)
+        self.scan_worker.progress.connect(self._on_scan_progress)
+        self.scan_worker.scanned.connect(self._on_scan_finished)
+        self.scan_worker.start()
+
+    def _on_scan_progress(self, done, total):
+        self.status_label.setText(f"正在解析: {done}/{total}")
+
+    def _on_scan_finished(self, changed, removed, error):
+        self.scan_button.setEnabled(True)
+        self.refresh()
+        if error:
+            self.status_label.setText(f"扫描失败: {error}")
+        else:
+            self.status_label.setText(f"扫描完成：更新 {changed} 个文件，移除 {removed} 个文件")
+
+    def _on_row_activated(self, row, column):
+        item = self.table.item(row, 0)
+        if item is not None:
+            self.file_activated.emit(item.data(QtCore.Qt.UserRole))
+
+    def shutdown(self):
+        """程序退出时等待扫描结束并关闭数据库。"""
+        if self.scan_worker is not None:
+            self.scan_worker.wait()
+        self.library.close()
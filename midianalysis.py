@@ -0,0 +1,414 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from midiloader import load_midi_arrays
+from tempotracker import TempoMap
+
+'''
+这是 MIDI 文件分析模块。
+在列式音符数组上用 NumPy 计算统计信息（音高/力度范围、控制器类型、时长等）和异常检查，
+返回结构化的报告；同类警告合并为一条（给出数量和前几个例子），不会逐个音符列出。
+也可以作为命令行工具批量检查文件或文件夹，输出 JSON:
+    python -m midianalysis 文件或文件夹 [...] [-o 报告.json]
+'''
+
+MIDI_EXTENSIONS = ('.mid', '.midi')
+DRUM_CHANNEL = 9
+LONG_NOTE_BEATS = 16  # 超过此拍数的音符视为超长音符
+BPM_RANGE = (30, 300)  # 正常的速度范围
+MAX_EXAMPLES = 5  # 每条警告最多列出的例子数
+OVERLAP_REPAIR_MODES = ('truncate', 'merge', 'drop')
+
+
+def _warning(code, message, count=None, examples=None, **details):
+    """生成一条警告记录。"""
+    warning = {'code': code, 'message': message}
+    if count is not None:
+        warning['count'] = int(count)
+    if examples is not None:
+        warning['examples'] = examples
+    warning.update(details)
+    return warning
+
+
+def _instrument_groups(arrays):
+    """
+    与 MidiArrays.to_miditoolkit 相同地把音符分组为乐器：每个 (音轨, 通道, 音色) 一个乐器，按第一个音符出现的顺序。
+    返回:
+        tuple: (各乐器的键 (音轨*16+通道)*128+音色, 每个音符所属的乐器序号)。
+    """
+    notes = arrays.notes
+    instrument_key = (notes['track'].astype(np.int64) * 16 + notes['channel']) * 128 + notes['program']
+    keys, first, inverse = np.unique(instrument_key, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return keys[order], rank[inverse]
+
+
+def _group_range(values, group, count):
+    """每组的 (最小值, 最大值)，没有元素的组为 (None, None)。"""
+    low = np.full(count, np.iinfo(np.int64).max)
+    high = np.full(count, np.iinfo(np.int64).min)
+    np.minimum.at(low, group, values)
+    np.maximum.at(high, group, values)
+    return [(int(a), int(b)) if a <= b else (None, None) for a, b in zip(low.tolist(), high.tolist())]
+
+
+def _sweep(start, end, pitch, group):
+    """
+    同音高重叠的扫描线：按 (乐器, 音高, 开始, 结束) 排序后，用分段的累计最大值求出每个音符之前
+    同一音高上仍在发声的最远结束位置，O(n log n)。
+    返回:
+        tuple: (排序下标, 是否是音高通道的第一个音符, 是否在之前的同音高音符发声时开始,
+                该时刻仍在发声的音符（结束最晚者）的排序位置，没有时为 -1)。
+    """
+    count = len(start)
+    order = np.lexsort((end, start, pitch, group))
+    sorted_start = start[order].astype(np.int64)
+    sorted_end = end[order].astype(np.int64)
+    lane_key = group[order].astype(np.int64) * 128 + pitch[order]
+    new_lane = np.ones(count, dtype=bool)
+    new_lane[1:] = lane_key[1:] != lane_key[:-1]
+    # 把通道序号放在高位，整体的累计最大值就不会跨越通道
+    lane = np.cumsum(new_lane)
+    low = int(sorted_end.min()) if count else 0
+    span = (int(sorted_end.max()) - low + 1) if count else 1
+    packed = lane * span + (sorted_end - low)
+    reach = np.maximum.accumulate(packed)
+    holder = np.maximum.accumulate(np.where(packed == reach, np.arange(count), 0))
+    overlapped = np.zeros(count, dtype=bool)
+    overlapped[1:] = ~new_lane[1:] & (sorted_start[1:] < reach[:-1] - lane[1:] * span + low)
+    sounding = np.full(count, -1, dtype=np.int64)
+    sounding[1:] = np.where(overlapped[1:], holder[:-1], -1)
+    return order, new_lane, overlapped, sounding
+
+
+def find_same_pitch_overlaps(start, end, pitch, group):
+    """
+    找出所有同音高重叠：同一乐器中，在另一个同音高音符仍在发声时开始的音符
+    （这类音符渲染时会使前一个音符的 note off 提前或丢失，造成卡音）。和弦不算重叠。
+    参数:
+        start, end, pitch (numpy.ndarray): 音符的开始 tick、结束 tick 和音高。
+        group (numpy.ndarray): 每个音符所属的乐器序号。
+    返回:
+        tuple: (后开始的音符下标, 与之重叠的仍在发声的音符下标)，按乐器、音高和开始时间排序。
+    """
+    order, _, overlapped, sounding = _sweep(start, end, pitch, group)
+    return order[overlapped], order[sounding[overlapped]]
+
+
+def repair_overlaps(start, end, pitch, group, mode='truncate'):
+    """
+    批量修复同音高重叠。
+    参数:
+        start, end, pitch, group (numpy.ndarray): 同 find_same_pitch_overlaps。
+        mode (str): 'truncate' 把音符截断到下一个同音高音符开始处（开始时间相同的音符只保留最长的）；
+            'merge' 把互相重叠的一串音符合并为第一个音符，结束位置取最晚者；
+            'drop' 删除在同音高音符发声时开始的音符。
+    返回:
+        tuple: (新的结束 tick 数组, 是否保留各音符的布尔数组)，与输入的下标对应。
+    异常:
+        ValueError: 未知的修复方式。
+    """
+    if mode not in OVERLAP_REPAIR_MODES:
+        raise ValueError(f"未知的重叠修复方式: {mode}")
+    count = len(start)
+    new_end = np.array(end, dtype=np.int64)
+    keep = np.ones(count, dtype=bool)
+    if not count:
+        return new_end, keep
+    order, new_lane, overlapped, _ = _sweep(start, end, pitch, group)
+    sorted_start = start[order].astype(np.int64)
+    sorted_end = new_end[order]
+    if mode == 'truncate':
+        following = np.append(sorted_start[1:], 0)
+        cut = np.append(~new_lane[1:], False) & (following < sorted_end)
+        sorted_end[cut] = following[cut]
+        new_end[order] = sorted_end
+        keep[order[cut & (sorted_end <= sorted_start)]] = False
+    elif mode == 'merge':
+        first = np.flatnonzero(new_lane | ~overlapped)
+        new_end[order[first]] = np.maximum.reduceat(sorted_end, first)
+        keep[order[overlapped]] = False
+    else:
+        keep[order[overlapped]] = False
+    return new_end, keep
+
+
+def analyze_arrays(arrays, path=None):
+    """
+    分析列式文档。
+    参数:
+        arrays (MidiArrays): 列式文档。
+        path (str, optional): 文件路径（写入报告）。
+    返回:
+        dict: 可直接序列化为 JSON 的报告，包括文件信息、各乐器统计、速度/拍号/调号变化和警告列表。
+    """
+    notes = arrays.notes
+    events = arrays.events
+    ticks_per_beat = arrays.ticks_per_beat
+    keys, group = _instrument_groups(arrays)
+    count = len(keys)
+    tempos = arrays.tempo_changes()
+    end_tick = arrays.max_tick
+    tempo_map = TempoMap.from_tempo_changes(tempos, ticks_per_beat)
+    lyrics = arrays.lyrics()
+    markers = arrays.markers()
+    time_signatures = arrays.time_signatures()
+    key_signatures = arrays.key_signatures()
+
+    # 控制器归入同一 (音轨, 通道) 的第一个乐器（与 to_miditoolkit 一致）
+    status = events['status']
+    is_cc = (status < 0xF0) & ((status & 0xF0) == 0xB0)
+    cc_channel = events['track'][is_cc].astype(np.int64) * 16 + (status[is_cc] & 0x0F)
+    cc_number = events['data1'][is_cc]
+    instrument_channel = keys // 128
+    channels, first_instrument = np.unique(instrument_channel, return_index=True)
+    position = np.searchsorted(channels, cc_channel)
+    attached = position < len(channels)
+    attached[attached] = channels[position[attached]] == cc_channel[attached]
+    cc_instrument = first_instrument[position[attached]]
+    cc_counts = np.bincount(cc_instrument, minlength=count)
+
+    names = arrays.track_names()
+    note_counts = np.bincount(group, minlength=count)
+    pitch_ranges = _group_range(notes['pitch'], group, count)
+    velocity_ranges = _group_range(notes['velocity'], group, count)
+    instruments = []
+    for index, key in enumerate(keys.tolist()):
+        channel_key, program = divmod(key, 128)
+        track, channel = divmod(channel_key, 16)
+        numbers = np.unique(cc_number[attached][cc_instrument == index]).tolist()
+        instruments.append({
+            'index': index,
+            'name': names[track],
+            'track': track,
+            'channel': channel,
+            'program': program,
+            'is_drum': channel == DRUM_CHANNEL,
+            'note_count': int(note_counts[index]),
+            'control_change_count': int(cc_counts[index]),
+            'pitch_range': list(pitch_ranges[index]),
+            'velocity_range': list(velocity_ranges[index]),
+            'control_numbers': numbers,
+        })
+
+    warnings = []
+    if ticks_per_beat <= 0:
+        warnings.append(_warning('invalid_ticks_per_beat', f"无效的 ticks_per_beat 值: {ticks_per_beat}"))
+    # 只含元事件的音轨（如格式 1 的速度/指挥音轨）本来就没有音符，不算空音轨
+    content_tracks = set(np.unique(events['track'][status != 0xFF]).tolist())
+    empty_tracks = sorted(content_tracks - set(np.unique(notes['track']).tolist()))
+    if empty_tracks:
+        warnings.append(_warning('empty_tracks', f"{len(empty_tracks)} 条音轨没有音符", len(empty_tracks),
+                                 tracks=empty_tracks))
+
+    if len(notes):
+        length = notes['end'] - notes['start']
+        long_notes = np.flatnonzero(length > max(ticks_per_beat, 1) * LONG_NOTE_BEATS)
+        if len(long_notes):
+            per_instrument = np.bincount(group[long_notes], minlength=count)
+            warnings.append(_warning(
+                'long_notes', f"{len(long_notes)} 个超长音符（超过 {LONG_NOTE_BEATS} 拍），最长 {int(length[long_notes].max())} tick",
+                len(long_notes),
+                [{'instrument': int(group[i]), 'start': int(notes['start'][i]), 'end': int(notes['end'][i])}
+                 for i in long_notes[:MAX_EXAMPLES].tolist()],
+                instruments={str(i): int(c) for i, c in enumerate(per_instrument.tolist()) if c}))
+
+        later, earlier = find_same_pitch_overlaps(notes['start'], notes['end'], notes['pitch'], group)
+        if len(later):
+            overlap_counts = np.bincount(group[later], minlength=count)
+            examples = [{'instrument': int(group[b]), 'pitch': int(notes['pitch'][b]),
+                         'first': [int(notes['start'][a]), int(notes['end'][a])],
+                         'second': [int(notes['start'][b]), int(notes['end'][b])]}
+                        for b, a in zip(later[:MAX_EXAMPLES].tolist(), earlier[:MAX_EXAMPLES].tolist())]
+            warnings.append(_warning(
+                'overlapping_notes',
+                f"{int(np.count_nonzero(overlap_counts))} 个乐器中共有 {len(later)} 个音符与同音高的音符重叠",
+                len(later), examples,
+                instruments={str(i): int(c) for i, c in enumerate(overlap_counts.tolist()) if c}))
+
+    bpms = [bpm for tick, bpm in tempos]
+    if min(bpms) < BPM_RANGE[0] or max(bpms) > BPM_RANGE[1]:
+        warnings.append(_warning('abnormal_bpm', f"存在异常BPM，范围: {min(bpms):.2f} ~ {max(bpms):.2f}",
+                                 sum(1 for bpm in bpms if not BPM_RANGE[0] <= bpm <= BPM_RANGE[1])))
+    abnormal = [(tick, n, d) for tick, n, d in time_signatures if n > 12 or d > 16]
+    if abnormal:
+        warnings.append(_warning('abnormal_time_signature', f"{len(abnormal)} 个异常拍号", len(abnormal),
+                                 [{'tick': tick, 'time_signature': f"{n}/{d}"} for tick, n, d in abnormal[:MAX_EXAMPLES]]))
+
+    report = {
+        'name': os.path.basename(path) if path else None,
+        'path': path,
+        'ticks_per_beat': ticks_per_beat,
+        'track_count': arrays.num_tracks,
+        'instrument_count': count,
+        'note_count': int(len(notes)),
+        'control_change_count': int(is_cc.sum()),
+        'sysex_count': int(((status == 0xF0) | (status == 0xF7)).sum()),
+        'end_tick': int(end_tick),
+        'duration': float(tempo_map.ticks_to_seconds(end_tick, ticks_per_beat)) if ticks_per_beat > 0 else None,
+        'instruments': instruments,
+        'tempos': [{'tick': tick, 'bpm': round(bpm, 3)} for tick, bpm in tempos],
+        'time_signatures': [{'tick': tick, 'numerator': n, 'denominator': d} for tick, n, d in time_signatures],
+        'key_signatures': [{'tick': tick, 'key': name} for tick, name in key_signatures],
+        'lyric_count': len(lyrics),
+        'lyrics': [text for tick, text in lyrics[:MAX_EXAMPLES]],
+        'marker_count': len(markers),
+        'markers': [{'tick': tick, 'text': text} for tick, text in markers[:MAX_EXAMPLES]],
+        'warnings': warnings,
+    }
+    return report
+
+
+def analyze_file(path):
+    """
+    分析一个 MIDI 文件。
+    参数:
+        path (str): MIDI 文件路径。
+    返回:
+        dict: 报告；文件无法读取时只包含 name、path 和 error。
+    """
+    try:
+        arrays = load_midi_arrays(path)
+    except (OSError, ValueError) as e:
+        return {'name': os.path.basename(path), 'path': path, 'error': str(e)}
+    return analyze_arrays(arrays, path)
+
+
+def format_report(report):
+    """
+    将报告格式化为可读的文本（用于信息窗口）。
+    参数:
+        report (dict): analyze_file 或 analyze_arrays 返回的报告。
+    返回:
+        str: 多行文本。
+    """
+    if 'error' in report:
+        return f"文件名: {report['name']}\n无法读取MIDI文件: {report['error']}"
+    duration = report['duration']
+    info = [
+        f"文件名: {report['name']}",
+        f"文件路径: {report['path']}",
+        f"Ticks Per Beat: {report['ticks_per_beat']}",
+        f"音轨数: {report['track_count']}（乐器 {report['instrument_count']} 个）",
+        f"总音符数: {report['note_count']}",
+        f"总控制器事件数: {report['control_change_count']}",
+        f"总节拍事件数: {len(report['tempos'])}",
+        f"总拍号事件数: {len(report['time_signatures'])}",
+        f"总调号事件数: {len(report['key_signatures'])}",
+        f"总歌词事件数: {report['lyric_count']}",
+        f"总marker事件数: {report['marker_count']}",
+        f"总长度（秒）: {duration:.2f}" if duration is not None else "总长度（秒）: 计算失败",
+    ]
+    for instrument in report['instruments']:
+        info.append(f"\n乐器{instrument['index'] + 1}（音轨 {instrument['track']}，通道 {instrument['channel'] + 1}）:")
+        info.append(f"  名称: {instrument['name'] or '(无)'}")
+        info.append(f"  程序号(乐器): {instrument['program']}")
+        info.append(f"  是否鼓组: {'是' if instrument['is_drum'] else '否'}")
+        info.append(f"  音符数: {instrument['note_count']}")
+        info.append(f"  控制器事件数: {instrument['control_change_count']}")
+        if instrument['note_count']:
+            info.append(f"  音高范围: {instrument['pitch_range'][0]} ~ {instrument['pitch_range'][1]}")
+            info.append(f"  力度范围: {instrument['velocity_range'][0]} ~ {instrument['velocity_range'][1]}")
+        else:
+            info.append("  无音符")
+        if instrument['control_numbers']:
+            info.append(f"  控制器类型: {instrument['control_numbers']}")
+    if report['lyrics']:
+        info.append(f"\n部分歌词: {', '.join(report['lyrics'][:3])} ...")
+    if report['tempos']:
+        info.append("\n节拍变化:")
+        info += [f"  时间: {t['tick']}，BPM: {t['bpm']:.2f}" for t in report['tempos'][:20]]
+        if len(report['tempos']) > 20:
+            info.append(f"  ……共 {len(report['tempos'])} 个")
+    if report['time_signatures']:
+        info.append("\n拍号变化:")
+        info += [f"  时间: {t['tick']}，拍号: {t['numerator']}/{t['denominator']}" for t in report['time_signatures'][:20]]
+    if report['key_signatures']:
+        info.append("\n调号变化:")
+        info += [f"  时间: {k['tick']}，调号: {k['key']}" for k in report['key_signatures'][:20]]
+    if report['markers']:
+        info.append("\nMarkers:")
+        info += [f"  {m['text']} @ {m['tick']}" for m in report['markers']]
+    if report['sysex_count']:
+        info.append(f"\n系统独占事件数: {report['sysex_count']}")
+    for warning in report['warnings']:
+        info.append(f"\n警告: {warning['message']}")
+        for example in warning.get('examples', [])[:3]:
+            info.append(f"  例: {json.dumps(example, ensure_ascii=False)}")
+    return "\n".join(info)
+
+
+def find_midi_files(paths):
+    """
+    展开命令行参数中的文件和文件夹（递归查找 MIDI 文件）。
+    参数:
+        paths (list): 文件或文件夹路径。
+    返回:
+        list: MIDI 文件路径，按路径排序。
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                found += [os.path.join(directory, name) for name in names if name.lower().endswith(MIDI_EXTENSIONS)]
+        else:
+            found.append(path)
+    return sorted(found)
+
+
+def summarize(reports):
+    """
+    汇总多个文件的报告。
+    返回:
+        dict: 文件数、无法读取的文件数、有警告的文件数和各类警告的文件数。
+    """
+    warning_files = {}
+    for report in reports:
+        for code in {warning['code'] for warning in report.get('warnings', [])}:
+            warning_files[code] = warning_files.get(code, 0) + 1
+    return {
+        'files': len(reports),
+        'errors': sum(1 for report in reports if 'error' in report),
+        'files_with_warnings': sum(1 for report in reports if report.get('warnings')),
+        'warnings': warning_files,
+    }
+
+
+def main(argv=None):
+    """命令行入口：分析文件或文件夹，输出 JSON 报告。存在无法读取的文件时返回 1。"""
+    parser = argparse.ArgumentParser(prog='python -m midianalysis', description="批量检查 MIDI 文件并输出 JSON 报告")
+    parser.add_argument('paths', nargs='+', help="MIDI 文件或文件夹（递归查找）")
+    parser.add_argument('-o', '--output', help="报告输出路径（默认输出到标准输出）")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="工作进程数（默认为 CPU 核数）")
+    parser.add_argument('--warnings-only', action='store_true', help="只输出有警告或无法读取的文件")
+    parser.add_argument('--indent', type=int, default=None, help="JSON 缩进")
+    args = parser.parse_args(argv)
+
+    files = find_midi_files(args.paths)
+    if len(files) > 1 and args.workers != 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            reports = list(executor.map(analyze_file, files, chunksize=max(1, len(files) // 64)))
+    else:
+        reports = [analyze_file(path) for path in files]
+    result = {'summary': summarize(reports)}
+    if args.warnings_only:
+        reports = [report for report in reports if 'error' in report or report['warnings']]
+    result['files'] = reports
+
+    text = json.dumps(result, ensure_ascii=False, indent=args.indent)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+    return 1 if result['summary']['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,679 @@
+import heapq
+import os
+import tempfile
+from collections import deque
+import numpy as np
+from miditoolkit import MidiFile
+from edithistory import EditHistory, NoteEdit
+from harmony import BarHarmony
+from midiloader import load_midi_document, _MAJOR_KEYS, _MINOR_KEYS
+from smfwriter import SmfWriter, encode_channel_events
+from tempotracker import TempoMap
+
+'''
+这是编辑器的文档模块。
+每个打开的文件对应一个 MidiDocument，界面、时长计算、渲染和分析都从它读取数据。
+派生数据（音符视图、速度图等）按需计算并缓存。文档的修改日志 (ChangeJournal) 为每次编辑分配递增的版本号，
+并记录修改的 tick 范围和音轨：缓存过期时只重建受影响的音轨，界面只更新受影响的音符，未保存状态也由版本号判断。
+结束位置、音符数、各乐器的音高/力度范围等统计和每小节的调性/和弦分析只在加载后完整计算一次，
+之后按每次编辑的差异批量增量更新。
+'''
+
+# 文档音符的列式视图: 开始/结束 tick、音高、力度、所属乐器序号
+DOCUMENT_NOTE_DTYPE = [('start', '<i8'), ('end', '<i8'), ('pitch', 'u1'), ('velocity', 'u1'),
+                       ('instrument', '<u2')]
+
+
+DEFAULT_BPM = 120
+# 非鼓组乐器依次使用的通道（跳过鼓组通道 9），与 miditoolkit 的写出规则一致
+_MELODIC_CHANNELS = [channel for channel in range(16) if channel != 9]
+# 同一 tick 上事件的写出顺序（与 miditoolkit 一致）
+_ORDER_PROGRAM, _ORDER_BEND, _ORDER_CONTROL, _ORDER_NOTE_OFF, _ORDER_NOTE_ON = 6, 7, 8, 9, 10
+_ORDER_TEMPO, _ORDER_TIME_SIGNATURE, _ORDER_KEY, _ORDER_MARKER, _ORDER_LYRIC = 1, 2, 3, 4, 5
+JOURNAL_LENGTH = 1024  # 修改日志保留的版本数，更早的版本按整个文档被修改处理
+
+
+def _encode_text(text):
+    """元事件文本按 latin-1 编码，无法编码的文本（如中文音轨名）改用 UTF-8。"""
+    try:
+        return text.encode('latin-1')
+    except UnicodeEncodeError:
+        return text.encode('utf-8')
+
+
+def write_atomically(path, write):
+    """
+    先将内容写入同目录下的临时文件并 fsync，再重命名覆盖目标文件。
+    参数:
+        path (str): 目标路径。
+        write (callable): write(fileobj)，向以二进制写模式打开的文件写入内容。
+    异常:
+        OSError: 写入或重命名失败（临时文件会被删除）。
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        # mkstemp 创建的文件只有属主可读写，沿用原文件的权限
+        os.chmod(temp_path, os.stat(path).st_mode & 0o7777 if os.path.exists(path) else 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    # 同步目录项，确保重命名本身也已落盘
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class DocumentSnapshot:
+    """
+    文档在某一版本的只读快照，供后台线程写出 MIDI 文件。
+    音符直接取自文档的列式视图，其余数据复制为数组或元组，之后的编辑不会影响快照。
+    """
+    def __init__(self, document):
+        """
+        参数:
+            document (MidiDocument): 要保存的文档（在界面线程中调用）。
+        """
+        midi = document.midi
+        self.version = document.version
+        self.ticks_per_beat = midi.ticks_per_beat
+        self.max_tick = max(midi.max_tick, document.end_tick() + 1)  # 编辑后 midi.max_tick 不会更新
+        self.notes = document.notes().copy()
+        self.instruments = [(instrument.name, instrument.program, instrument.is_drum)
+                            for instrument in midi.instruments]
+        self.controls = []  # 每个乐器的 (tick, 控制器号, 值) 数组
+        self.bends = []  # 每个乐器的 (tick, 弯音值) 数组
+        for instrument in midi.instruments:
+            if instrument.control_changes:
+                controls = [(cc.time, cc.number, cc.value) for cc in instrument.control_changes]
+            else:
+                # 没有控制器事件时按延音踏板区间写出 CC64
+                controls = [event for pedal in instrument.pedals
+                            for event in ((pedal.start, 64, 127), (pedal.end, 64, 0))]
+            self.controls.append(np.array(controls, dtype=np.int64).reshape(-1, 3))
+            self.bends.append(np.array([(bend.time, bend.pitch) for bend in instrument.pitch_bends],
+                                       dtype=np.int64).reshape(-1, 2))
+        self.time_signatures = [(ts.time, ts.numerator, ts.denominator) for ts in midi.time_signature_changes]
+        self.tempos = [(tc.time, tc.tempo) for tc in midi.tempo_changes]
+        self.lyrics = [(lyric.time, lyric.text) for lyric in midi.lyrics]
+        self.markers = [(marker.time, marker.text) for marker in midi.markers]
+        self.keys = [(key.time, key.key_name) for key in midi.key_signature_changes]
+
+    def _write_meta_track(self, writer):
+        """写出第一条音轨：拍号、速度、歌词、标记和调号。"""
+        events = []  # (tick, 同 tick 顺序, 元事件类型, 数据)
+        if not self.time_signatures or min(t for t, _, _ in self.time_signatures) > 0:
+            events.append((0, _ORDER_TIME_SIGNATURE, 0x58, bytes((4, 2, 24, 8))))
+        for tick, numerator, denominator in self.time_signatures:
+            events.append((tick, _ORDER_TIME_SIGNATURE, 0x58,
+                           bytes((numerator, max(denominator, 1).bit_length() - 1, 24, 8))))
+        if not self.tempos or min(t for t, _ in self.tempos) > 0:
+            events.append((0, _ORDER_TEMPO, 0x51, int(round(6e7 / DEFAULT_BPM)).to_bytes(3, 'big')))
+        for tick, bpm in self.tempos:
+            events.append((tick, _ORDER_TEMPO, 0x51, int(round(6e7 / bpm)).to_bytes(3, 'big')))
+        for tick, text in self.lyrics:
+            events.append((tick, _ORDER_LYRIC, 0x05, _encode_text(text)))
+        for tick, text in self.markers:
+            events.append((tick, _ORDER_MARKER, 0x06, _encode_text(text)))
+        for tick, key_name in self.keys:
+            minor = key_name.endswith('m')
+            sharps = (_MINOR_KEYS if minor else _MAJOR_KEYS).index(key_name) - 7
+            events.append((tick, _ORDER_KEY, 0x59, bytes((sharps & 0xFF, int(minor)))))
+        events.sort(key=lambda event: (event[0], event[1]))  # 稳定排序，同类事件保持原有顺序
+
+        writer.begin_track()
+        previous = 0
+        for tick, _, meta_type, data in events:
+            writer.write_meta(tick - previous, meta_type, data)
+            previous = tick
+        writer.end_track(1)
+
+    def _write_instrument_track(self, writer, index):
+        """
+        写出一个乐器的音轨。事件按 (tick, 同 tick 顺序, 音符结束位置, 原始顺序) 一次排序后整体编码。
+        """
+        name, program, is_drum = self.instruments[index]
+        channel = 9 if is_drum else _MELODIC_CHANNELS[index % len(_MELODIC_CHANNELS)]
+        notes = self.notes[self.notes['instrument'] == index]
+        controls = self.controls[index]
+        bends = self.bends[index] + [0, 8192]  # 弯音值转换为 0-16383
+        count = len(notes)
+
+        # 事件顺序: 程序变更、弯音、控制器，然后每个音符的开/关交替
+        ticks = np.concatenate(([0], bends[:, 0], controls[:, 0],
+                                np.column_stack((notes['start'], notes['end'])).ravel()))
+        order = np.concatenate(([_ORDER_PROGRAM], np.full(len(bends), _ORDER_BEND),
+                                np.full(len(controls), _ORDER_CONTROL),
+                                np.tile([_ORDER_NOTE_ON, _ORDER_NOTE_OFF], count)))
+        ends = np.zeros(len(ticks), dtype=np.int64)
+        if count:
+            ends[len(ticks) - 2 * count::2] = notes['end']
+        status = np.concatenate(([0xC0], np.full(len(bends), 0xE0), np.full(len(controls), 0xB0),
+                                 np.tile([0x90, 0x80], count))) | channel
+        data1 = np.concatenate(([program], bends[:, 1] & 0x7F, controls[:, 1], np.repeat(notes['pitch'], 2)))
+        data2 = np.concatenate(([0], bends[:, 1] >> 7, controls[:, 2], np.repeat(notes['velocity'], 2)))
+        sort = np.lexsort((np.arange(len(ticks)), ends, order, ticks))
+
+        writer.begin_track()
+        if name:
+            writer.write_meta(0, 0x03, _encode_text(name))
+        writer.write_encoded(encode_channel_events(ticks[sort], status[sort], data1[sort], data2[sort]))
+        writer.end_track(1)
+
+    def write(self, fileobj):
+        """
+        将快照编码为标准 MIDI 文件（格式 1：速度音轨 + 每个乐器一条音轨）。
+        参数:
+            fileobj: 以二进制写模式打开、支持 seek 的文件对象。
+        """
+        writer = SmfWriter(fileobj, ticks_per_beat=self.ticks_per_beat,
+                           num_tracks=1 + len(self.instruments), midi_format=1)
+        self._write_meta_track(writer)
+        for index in range(len(self.instruments)):
+            self._write_instrument_track(writer, index)
+
+    def save(self, path):
+        """
+        原子地保存到文件，写入中途出错或崩溃时原文件保持不变。
+        参数:
+            path (str): 目标路径。
+        异常:
+            OSError: 写入或重命名失败（临时文件会被删除）。
+        """
+        write_atomically(path, self.write)
+
+
+class _Extreme:
+    """
+    可删除元素的集合的最大值（或最小值）：堆加延迟删除，插入、删除均摊 O(log n)，读取 O(1)。
+    """
+    __slots__ = ('sign', 'heap', 'removed')
+
+    def __init__(self, values, largest=True):
+        """
+        参数:
+            values (numpy.ndarray): 初始元素。
+            largest (bool): True 时维护最大值，否则维护最小值。
+        """
+        self.sign = -1 if largest else 1
+        self.heap = (np.asarray(values, dtype=np.int64) * self.sign).tolist()
+        heapq.heapify(self.heap)
+        self.removed = {}  # 已删除但仍在堆中的键 -> 数量
+
+    def add(self, value):
+        heapq.heappush(self.heap, self.sign * value)
+
+    def remove(self, value):
+        key = self.sign * value
+        if self.heap[0] == key:
+            heapq.heappop(self.heap)
+            # 堆顶始终是有效元素，读取时无需清理
+            while self.heap and self.removed.get(self.heap[0]):
+                self.removed[self.heap[0]] -= 1
+                heapq.heappop(self.heap)
+        else:
+            self.removed[key] = self.removed.get(key, 0) + 1
+
+    @property
+    def value(self):
+        """当前的最大值（或最小值），集合为空时为 None。"""
+        return self.sign * self.heap[0] if self.heap else None
+
+
+class DocumentStats:
+    """
+    增量维护的文档统计：结束位置、音符数、各乐器的音符数、音高/力度直方图、力度总和和起止 tick。
+    加载后由音符视图完整计算一次，之后每次编辑用 update 批量更新受影响的音符。
+    """
+    def __init__(self, notes, instrument_count):
+        """
+        参数:
+            notes (numpy.ndarray): DOCUMENT_NOTE_DTYPE 音符视图。
+            instrument_count (int): 乐器数。
+        """
+        instrument = notes['instrument'].astype(np.int64)
+        size = instrument_count * 128
+        self.note_count = len(notes)
+        self.note_counts = np.bincount(instrument, minlength=instrument_count)
+        self.pitch_histogram = np.bincount(instrument * 128 + notes['pitch'], minlength=size).reshape(-1, 128)
+        self.velocity_histogram = np.bincount(instrument * 128 + notes['velocity'], minlength=size).reshape(-1, 128)
+        self.velocity_sums = np.bincount(instrument, weights=notes['velocity'], minlength=instrument_count).astype(np.int64)
+        self.pitch_counts = self.pitch_histogram.sum(axis=0)  # 所有乐器合计，用于全局音高范围
+        self._end = _Extreme(notes['end'])
+        order = np.argsort(instrument, kind='stable')
+        bounds = np.searchsorted(instrument[order], np.arange(instrument_count + 1))
+        self._starts = [_Extreme(notes['start'][order[a:b]], largest=False) for a, b in zip(bounds[:-1], bounds[1:])]
+        self._ends = [_Extreme(notes['end'][order[a:b]]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def _grow(self, instrument_count):
+        """新增乐器时扩展各数组。"""
+        extra = instrument_count - len(self.note_counts)
+        if extra <= 0:
+            return
+        self.note_counts = np.append(self.note_counts, np.zeros(extra, dtype=np.int64))
+        self.velocity_sums = np.append(self.velocity_sums, np.zeros(extra, dtype=np.int64))
+        self.pitch_histogram = np.vstack((self.pitch_histogram, np.zeros((extra, 128), dtype=np.int64)))
+        self.velocity_histogram = np.vstack((self.velocity_histogram, np.zeros((extra, 128), dtype=np.int64)))
+        self._starts += [_Extreme([], largest=False) for _ in range(extra)]
+        self._ends += [_Extreme([]) for _ in range(extra)]
+
+    def update(self, instruments, values, sign):
+        """
+        批量记录新增（sign=1）或删除（sign=-1）的音符；修改音符按“删除旧值、新增新值”记录。
+        参数:
+            instruments (numpy.ndarray): 每个音符的乐器序号。
+            values (numpy.ndarray): (n, 4) 的 (开始, 结束, 音高, 力度)。
+            sign (int): 1 或 -1。
+        """
+        if not len(values):
+            return
+        self._grow(int(instruments.max()) + 1)
+        start, end, pitch, velocity = values.T
+        self.note_count += sign * len(values)
+        np.add.at(self.note_counts, instruments, sign)
+        np.add.at(self.pitch_histogram, (instruments, pitch), sign)
+        np.add.at(self.velocity_histogram, (instruments, velocity), sign)
+        np.add.at(self.velocity_sums, instruments, sign * velocity)
+        np.add.at(self.pitch_counts, pitch, sign)
+        # 删除时要求这些值已在集合中，因此先删除旧值再新增新值
+        for index, start_tick, end_tick in zip(instruments.tolist(), start.tolist(), end.tolist()):
+            if sign > 0:
+                self._end.add(end_tick)
+                self._starts[index].add(start_tick)
+                self._ends[index].add(end_tick)
+            else:
+                self._end.remove(end_tick)
+                self._starts[index].remove(start_tick)
+                self._ends[index].remove(end_tick)
+
+    @property
+    def end_tick(self):
+        """最后一个音符结束的 tick，没有音符时为 0。"""
+        return self._end.value or 0
+
+    @staticmethod
+    def _histogram_range(histogram):
+        present = np.flatnonzero(histogram)
+        return (int(present[0]), int(present[-1])) if len(present) else None
+
+    def pitch_range(self, instrument=None):
+        """返回全部（或指定乐器）音符的 (最低音高, 最高音高)，没有音符时为 None。"""
+        return self._histogram_range(self.pitch_counts if instrument is None else self.pitch_histogram[instrument])
+
+    def velocity_range(self, instrument):
+        """返回指定乐器音符的 (最小力度, 最大力度)，没有音符时为 None。"""
+        return self._histogram_range(self.velocity_histogram[instrument])
+
+    def instrument_span(self, instrument):
+        """返回指定乐器第一个音符开始和最后一个音符结束的 tick，没有音符时为 (None, None)。"""
+        return self._starts[instrument].value, self._ends[instrument].value
+
+
+class DocumentChange:
+    """
+    一段版本区间内对文档的修改：受影响的 tick 范围 [start, end] 和音轨序号集合。
+    tracks 为 None 表示整个文档都可能被修改（如替换内容、修改速度或拍号），此时 start、end 也为 None。
+    """
+    __slots__ = ('start', 'end', 'tracks')
+
+    def __init__(self, start=None, end=None, tracks=None):
+        self.start = start
+        self.end = end
+        self.tracks = tracks
+
+    def union(self, other):
+        """返回同时包含两次修改的范围。"""
+        if self.tracks is None or other.tracks is None:
+            return DocumentChange()
+        return DocumentChange(min(self.start, other.start), max(self.end, other.end), self.tracks | other.tracks)
+
+    def overlaps(self, start, end):
+        """返回修改范围是否与 [start, end] 相交。"""
+        return self.tracks is None or (self.start <= end and start <= self.end)
+
+
+class ChangeJournal:
+    """
+    文档的修改日志：单调递增的版本号，以及最近 JOURNAL_LENGTH 个版本各自修改的范围。
+    缓存和界面记下自己对应的版本号，之后用 since 取得期间的修改，只更新受影响的部分。
+    """
+    def __init__(self):
+        self.version = 0
+        self.entries = deque(maxlen=JOURNAL_LENGTH)  # (版本号, DocumentChange)
+
+    def record(self, change):
+        """
+        记录一次修改。
+        参数:
+            change (DocumentChange): 修改的范围。
+        返回:
+            int: 新的版本号。
+        """
+        self.version += 1
+        self.entries.append((self.version, change))
+        return self.version
+
+    def since(self, version):
+        """
+        参数:
+            version (int): 调用方上次同步时的版本号。
+        返回:
+            DocumentChange or None: 此后所有修改的合并范围，没有修改时为 None；
+                版本号已超出日志保留的范围时视为整个文档被修改。
+        """
+        if version == self.version:
+            return None
+        if not self.entries or self.entries[0][0] > version + 1:
+            return DocumentChange()
+        change = None
+        for entry_version, entry in reversed(self.entries):
+            if entry_version <= version:
+                break
+            change = entry if change is None else change.union(entry)
+        return change
+
+
+class MidiDocument:
+    """
+    一个打开的 MIDI 文档。
+    - midi: 编辑器使用的 miditoolkit.MidiFile（唯一的数据来源）。
+    - path: 文件路径，新建或录制的文档为 None。
+    - version: 版本号，每次编辑后由 mark_changed 记入修改日志 (journal) 并递增。
+    - saved_version: 与磁盘上文件内容一致的版本号，从未保存过时为 None。
+    - history: 撤销/重做历史 (EditHistory)。
+    """
+    def __init__(self, midi=None, path=None, notes=None):
+        """
+        参数:
+            midi (miditoolkit.MidiFile, optional): 文档内容，默认为空文档。
+            path (str, optional): 文件路径。
+            notes (numpy.ndarray, optional): 已知的 DOCUMENT_NOTE_DTYPE 音符视图（如从工程文件映射），
+                直接作为第 0 版的缓存。
+        """
+        self.midi = midi if midi is not None else MidiFile(ticks_per_beat=480)
+        self.path = path
+        self.journal = ChangeJournal()
+        self.saved_version = 0 if path is not None else None
+        self._cache = {}  # 名称 -> (计算时的版本号, 值)
+        self._stats = None  # 增量维护的 DocumentStats，第一次读取时完整计算
+        self._harmony = None  # 增量维护的 BarHarmony（每小节的调性与和弦），第一次读取时完整计算
+        self.history = EditHistory()
+        if notes is not None:
+            self._cache['notes'] = (0, notes)
+
+    @classmethod
+    def load(cls, path):
+        """
+        从文件加载文档（列式解析并校验）。
+        参数:
+            path (str): MIDI 文件路径。
+        返回:
+            MidiDocument: 文档。
+        异常:
+            ValueError: 文件损坏或格式不支持。
+        """
+        return cls(load_midi_document(path), path)
+
+    def snapshot(self):
+        """
+        返回:
+            DocumentSnapshot: 当前版本的快照，可交给后台线程保存。
+        """
+        return DocumentSnapshot(self)
+
+    @property
+    def version(self):
+        return self.journal.version
+
+    def is_saved(self):
+        """返回当前版本是否已与磁盘上的文件一致。"""
+        return self.saved_version == self.version
+
+    def is_modified(self):
+        """
+        返回是否有尚未保存的修改：保存过的文档比较版本号，
+        从未保存的文档（新建、录制、修复模式打开）被编辑过或含有音符时视为已修改。
+        """
+        if self.saved_version is not None:
+            return not self.is_saved()
+        return self.version > 0 or self.end_tick() > 0
+
+    def mark_changed(self, start=None, end=None, tracks=None):
+        """
+        文档内容被修改后调用，把修改范围记入修改日志并递增版本号，过期的缓存按范围更新。
+        未给出范围时视为整个文档被修改，增量统计和和声分析也会在下次读取时完整重算
+        （音符编辑的增量统计由 NoteEdit 通过 notes_added / notes_removed 维护）。
+        参数:
+            start (int, optional): 修改范围的起始 tick。
+            end (int, optional): 修改范围的结束 tick。
+            tracks (set, optional): 修改的音轨（乐器序号）。
+        """
+        if tracks is None:
+            self._stats = None
+            self._harmony = None
+            change = DocumentChange()
+        else:
+            change = DocumentChange(start, end, frozenset(tracks))
+        self.journal.record(change)
+
+    def changes_since(self, version):
+        """
+        参数:
+            version (int): 调用方上次同步时的版本号。
+        返回:
+            DocumentChange or None: 此后的修改范围，没有修改时为 None，见 ChangeJournal.since。
+        """
+        return self.journal.since(version)
+
+    def begin_edit(self, label, coalesce_key=None):
+        """
+        开始一次可撤销的编辑。
+        参数:
+            label (str): 编辑的名称。
+            coalesce_key (hashable, optional): 合并键，见 NoteEdit。
+        返回:
+            NoteEdit: 编辑记录，编辑操作通过它报告受影响的音符，完成后交给 end_edit。
+        """
+        return NoteEdit(self, label, coalesce_key)
+
+    def end_edit(self, edit):
+        """提交编辑：记入撤销历史和修改日志（没有实际修改任何音符时什么也不做）。"""
+        edit.finish()
+        if edit.is_empty():
+            return
+        self.history.push(edit)
+        self.mark_changed(*edit.extent)
+
+    def undo(self):
+        """
+        撤销最近一次编辑。
+        返回:
+            NoteEdit or None: 被撤销的编辑，没有可撤销的编辑时为 None。
+        """
+        edit = self.history.undo()
+        if edit is not None:
+            self.mark_changed(*edit.extent)
+        return edit
+
+    def redo(self):
+        """
+        重做最近一次撤销的编辑。
+        返回:
+            NoteEdit or None: 被重做的编辑，没有可重做的编辑时为 None。
+        """
+        edit = self.history.redo()
+        if edit is not None:
+            self.mark_changed(*edit.extent)
+        return edit
+
+    def stats(self):
+        """
+        返回:
+            DocumentStats: 增量维护的统计，只在第一次读取时由音符视图完整计算。
+        """
+        if self._stats is None:
+            self._stats = DocumentStats(self.notes(), len(self.midi.instruments))
+        return self._stats
+
+    def harmony(self):
+        """
+        返回:
+            BarHarmony: 每小节的调性（或五声调式）与和弦分析（不含鼓组），第一次读取时完整计算，之后随编辑增量更新。
+        """
+        if self._harmony is None:
+            notes = self.notes()
+            drums = np.array([instrument.is_drum for instrument in self.midi.instruments] + [False], dtype=bool)
+            melodic = notes[~drums[notes['instrument']]]
+            self._harmony = BarHarmony([(ts.time, ts.numerator, ts.denominator) for ts in self.midi.time_signature_changes],
+                                       max(self.midi.ticks_per_beat, 1), melodic['start'], melodic['end'], melodic['pitch'])
+        return self._harmony
+
+    def _instrument_index(self, instrument):
+        if isinstance(instrument, int):
+            return instrument
+        # Instrument 按内容比较相等，这里按对象查找
+        return next(index for index, candidate in enumerate(self.midi.instruments) if candidate is instrument)
+
+    def notes_added(self, instruments, values):
+        """
+        新增音符或修改音符之后调用（通常由 NoteEdit 调用），批量增量更新统计与和声分析。
+        参数:
+            instruments (numpy.ndarray): 每个音符的乐器序号。
+            values (numpy.ndarray): (n, 4) 的 (开始, 结束, 音高, 力度)。
+        """
+        self._update_derived(instruments, values, 1)
+
+    def notes_removed(self, instruments, values):
+        """
+        删除音符或修改音符之前调用（通常由 NoteEdit 调用），参数同 notes_added（修改前的值）。
+        """
+        self._update_derived(instruments, values, -1)
+
+    def _update_derived(self, instruments, values, sign):
+        if self._stats is not None:
+            self._stats.update(instruments, values, sign)
+        if self._harmony is not None and len(values):
+            drums = np.array([instrument.is_drum for instrument in self.midi.instruments], dtype=bool)
+            melodic = values[~drums[instruments]]
+            self._harmony.update(melodic[:, 0], melodic[:, 1], melodic[:, 2], sign)
+
+    def _memo(self, name, compute, update=None):
+        """
+        返回当前版本的缓存值，缓存不存在时计算。
+        缓存过期时，若给出了 update 且期间只修改了部分音轨，调用 update(旧值, DocumentChange) 增量更新，否则重新计算。
+        """
+        entry = self._cache.get(name)
+        if entry is None:
+            entry = (self.version, compute())
+        elif entry[0] != self.version:
+            change = self.changes_since(entry[0])
+            if update is not None and change.tracks is not None:
+                entry = (self.version, update(entry[1], change))
+            else:
+                entry = (self.version, compute())
+        self._cache[name] = entry
+        return entry[1]
+
+    @property
+    def ticks_per_beat(self):
+        return self.midi.ticks_per_beat
+
+    def notes(self):
+        """
+        返回:
+            numpy.ndarray: 所有音符的 DOCUMENT_NOTE_DTYPE 列式视图（按乐器顺序）。
+        """
+        def build(indices):
+            instruments = [self.midi.instruments[index] for index in indices]
+            counts = [len(instrument.notes) for instrument in instruments]
+            notes = np.empty(sum(counts), dtype=DOCUMENT_NOTE_DTYPE)
+            if not len(notes):
+                return notes
+            flat = [(n.start, n.end, n.pitch, n.velocity) for instrument in instruments for n in instrument.notes]
+            columns = np.array(flat, dtype=np.int64)
+            notes['start'] = columns[:, 0]
+            notes['end'] = columns[:, 1]
+            notes['pitch'] = columns[:, 2]
+            notes['velocity'] = columns[:, 3]
+            notes['instrument'] = np.repeat(indices, counts)
+            return notes
+
+        def update(notes, change):
+            # 视图按乐器顺序排列：未修改的乐器沿用原来的行，只重建修改过的乐器
+            count = len(self.midi.instruments)
+            bounds = np.searchsorted(notes['instrument'], np.arange(count + 1))
+            parts = [build([index]) if index in change.tracks else notes[bounds[index]:bounds[index + 1]]
+                     for index in range(count)]
+            return np.concatenate(parts) if parts else notes[:0]
+        return self._memo('notes', lambda: build(list(range(len(self.midi.instruments)))), update)
+
+    def end_tick(self):
+        """
+        返回:
+            int: 最后一个音符结束的 tick，没有音符时为 0。
+        """
+        return self.stats().end_tick
+
+    def pitch_range(self):
+        """
+        返回:
+            tuple or None: (最低音高, 最高音高)，没有音符时为 None。
+        """
+        return self.stats().pitch_range()
+
+    def tempo_map(self):
+        """
+        返回:
+            TempoMap: 由文档速度变化构建的速度图。
+        """
+        # 音符编辑不影响速度图，只有整个文档被修改时才重新构建
+        return self._memo('tempo_map', lambda: TempoMap.from_tempo_changes(
+            [(tc.time, tc.tempo) for tc in self.midi.tempo_changes], self.midi.ticks_per_beat),
+            lambda tempo_map, change: tempo_map)
+
+    def tick_to_seconds(self, ticks):
+        """按文档速度图将 tick 换算为秒（支持数组）。"""
+        return self.tempo_map().ticks_to_seconds(ticks, max(self.midi.ticks_per_beat, 1))
+
+    def duration_seconds(self):
+        """
+        返回:
+            float: 最后一个音符结束的时间（秒）。
+        """
+        return self._memo('duration', lambda: float(self.tick_to_seconds(self.end_tick())))
+
+    def track_stats(self):
+        """
+        返回:
+            list: 每个乐器一个字典，包含名称、音色、是否鼓组、音符数、音高/力度范围、平均力度和起止 tick。
+        """
+        stats = self.stats()
+        result = []
+        for index, instrument in enumerate(self.midi.instruments):
+            count = int(stats.note_counts[index]) if index < len(stats.note_counts) else 0
+            pitch_range = stats.pitch_range(index) if count else None
+            velocity_range = stats.velocity_range(index) if count else None
+            start, end = stats.instrument_span(index) if count else (None, None)
+            result.append({
+                'name': instrument.name,
+                'program': instrument.program,
+                'is_drum': instrument.is_drum,
+                'note_count': count,
+                'pitch_min': pitch_range and pitch_range[0],
+                'pitch_max': pitch_range and pitch_range[1],
+                'velocity_min': velocity_range and velocity_range[0],
+                'velocity_max': velocity_range and velocity_range[1],
+                'velocity_mean': float(stats.velocity_sums[index]) / count if count else None,
+                'start': start,
+                'end': end,
+            })
+        return result
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+from harmony import estimate_key
+from midiloader import parse_midi_arrays
+from tempotracker import TempoMap
+from thumbnails import save_thumbnail, thumbnail_path
+
+'''
+这是 MIDI 曲库索引模块。
+扫描文件夹树中的 MIDI 文件，在进程池中并行解析，提取时长、速度范围、调性、音符数、
+各音轨音色和内容哈希，保存在本地 SQLite 索引中。再次扫描时只解析大小或修改时间变化的文件。
+指定缩略图目录时，工作进程在解析的同时生成按内容哈希缓存的钢琴卷帘缩略图。
+'''
+
+MIDI_EXTENSIONS = ('.mid', '.midi')
+DRUM_CHANNEL = 9
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT,
+    duration REAL,
+    tempo_min REAL,
+    tempo_max REAL,
+    key TEXT,
+    key_signature TEXT,
+    note_count INTEGER,
+    track_count INTEGER,
+    programs TEXT,
+    has_drums INTEGER,
+    error TEXT,
+    indexed_at REAL
+);
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+'''
+
+_COLUMNS = ('path', 'name', 'size', 'mtime_ns', 'hash', 'duration', 'tempo_min', 'tempo_max', 'key',
+            'key_signature', 'note_count', 'track_count', 'programs', 'has_drums', 'error', 'indexed_at')
+
+
+def file_hash(data):
+    """返回文件内容的哈希（SHA-1 十六进制），用于识别内容相同的文件。"""
+    return hashlib.sha1(data).hexdigest()
+
+
+def scan_file(path, thumbnail_dir=None):
+    """
+    解析一个 MIDI 文件并提取索引信息（在工作进程中运行）。
+    参数:
+        path (str): MIDI 文件路径。
+        thumbnail_dir (str, optional): 缩略图缓存目录，指定时同时生成缩略图。
+    返回:
+        dict: 与 files 表各列对应的字典；解析失败时 error 列为错误信息。
+    """
+    record = dict.fromkeys(_COLUMNS)
+    record.update(path=path, name=os.path.basename(path), size=0, mtime_ns=0, indexed_at=time.time())
+    try:
+        # 文件在扫描期间被删除或无法访问时记为错误行，不让整个扫描中断
+        stat = os.stat(path)
+        record.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        with open(path, 'rb') as f:
+            data = f.read()
+        # 只读取一次文件，哈希与解析共用同一份内容
+        record['hash'] = file_hash(data)
+        arrays = parse_midi_arrays(data)
+        arrays.validate()
+    except (OSError, ValueError) as e:
+        record['error'] = str(e)
+        return record
+
+    notes = arrays.notes
+    tempos = arrays.tempo_changes()
+    bpms = [bpm for tick, bpm in tempos if not len(notes) or tick <= notes['end'].max()]
+    end_tick = int(notes['end'].max()) if len(notes) else 0
+    tempo_map = TempoMap.from_tempo_changes(tempos, arrays.ticks_per_beat)
+    melodic = notes[notes['channel'] != DRUM_CHANNEL]
+    key_signatures = arrays.key_signatures()
+    record.update(
+        duration=float(tempo_map.ticks_to_seconds(end_tick, arrays.ticks_per_beat)),
+        tempo_min=round(min(bpms), 2),
+        tempo_max=round(max(bpms), 2),
+        key=estimate_key(melodic['pitch'], melodic['end'] - melodic['start']),
+        key_signature=key_signatures[0][1] if key_signatures else None,
+        note_count=len(notes),
+        track_count=len(np.unique(notes['track'])),
+        programs=json.dumps(np.unique(melodic['program']).tolist()),
+        has_drums=int(len(melodic) < len(notes)),
+    )
+    if thumbnail_dir:
+        try:
+            save_thumbnail(notes, thumbnail_dir, record['hash'])
+        except OSError as e:
+            print(f"生成缩略图失败: {path}, 错误: {str(e)}")
+    return record
+
+
+def find_midi_files(root):
+    """
+    遍历文件夹树，返回所有 MIDI 文件的 {路径: (大小, 修改时间)}。
+    参数:
+        root (str): 根目录。
+    """
+    found = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if name.lower().endswith(MIDI_EXTENSIONS):
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found[path] = (stat.st_size, stat.st_mtime_ns)
+    return found
+
+
+class MidiLibrary:
+    """
+    SQLite 曲库索引。每个线程使用各自的 MidiLibrary 实例（sqlite3 连接不能跨线程共享）。
+    """
+    def __init__(self, db_path):
+        """
+        参数:
+            db_path (str): 索引数据库路径，不存在时自动创建。
+        """
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')  # 扫描写入时界面仍可查询
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        """关闭数据库连接。"""
+        self.connection.close()
+
+    def scan(self, root, workers=None, progress=None, thumbnail_dir=None):
+        """
+        增量扫描文件夹树：新增或大小/修改时间变化的文件在进程池中解析，已删除的文件从索引中移除。
+        参数:
+            root (str): 根目录。
+            workers (int, optional): 工作进程数，默认为 CPU 核数。
+            progress (callable, optional): progress(已完成数, 待解析总数)，每解析完一个文件调用一次。
+            thumbnail_dir (str, optional): 缩略图缓存目录；缩略图缺失的文件即使未变化也会重新处理。
+        返回:
+            tuple: (新增或更新的文件数, 移除的文件数)。
+        """
+        root = os.path.abspath(root)
+        found = find_midi_files(root)
+        prefix = os.path.join(root, '')
+        rows = self.connection.execute('SELECT path, size, mtime_ns, hash, error FROM files WHERE substr(path, 1, ?) = ?',
+                                       (len(prefix), prefix)).fetchall()
+        indexed = {row['path']: (row['size'], row['mtime_ns']) for row in rows}
+        changed = {path for path, stamp in found.items() if indexed.get(path) != stamp}
+        if thumbnail_dir:
+            changed.update(row['path'] for row in rows if row['path'] in found and row['hash'] and not row['error']
+                           and not os.path.exists(thumbnail_path(thumbnail_dir, row['hash'])))
+        changed = sorted(changed)
+        removed = [path for path in indexed if path not in found]
+        scan = partial(scan_file, thumbnail_dir=thumbnail_dir)
+
+        insert = 'INSERT OR REPLACE INTO files ({}) VALUES ({})'.format(', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS)))
+        if len(changed) > 1:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            records = executor.map(scan, changed, chunksize=max(1, len(changed) // 64))
+        else:
+            executor = None
+            records = map(scan, changed)  # 只有一个文件时不值得启动进程池
+        try:
+            for done, record in enumerate(records, start=1):
+                self.connection.execute(insert, [record[column] for column in _COLUMNS])
+                if done % 64 == 0:
+                    self.connection.commit()
+                if progress is not None:
+                    progress(done, len(changed))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self.connection.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in removed])
+        self.connection.commit()
+        return len(changed), len(removed)
+
+    def search(self, text='', limit=1000):
+        """
+        按文件名、路径、调性或调号搜索。
+        参数:
+            text (str): 搜索文本（空格分隔的多个词须全部匹配），为空时返回全部。
+            limit (int): 最多返回的条数。
+        返回:
+            list: sqlite3.Row 列表，按文件名排序。
+        """
+        conditions, values = [], []
+        for word in text.split():
+            conditions.append('(name LIKE ? OR path LIKE ? OR key = ? OR key_signature = ?)')
+            values += ['%' + word + '%', '%' + word + '%', word, word]
+        query = 'SELECT * FROM files'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY name COLLATE NOCASE LIMIT ?'
+        return self.connection.execute(query, values + [limit]).fetchall()
+
+    def get(self, path):
+        """返回指定文件的索引记录，不存在时返回 None。"""
+        return self.connection.execute('SELECT * FROM files WHERE path = ?', (os.path.abspath(path),)).fetchone()
@@ -0,0 +1,711 @@
+import struct
+from array import array
+import numpy as np
+import miditoolkit
+from miditoolkit import Instrument, Note, ControlChange, PitchBend, TempoChange
+from miditoolkit.midi.containers import TimeSignature, KeySignature, Lyric, Marker
+
+'''
+这是列式 (NumPy) 的 MIDI 文件加载模块。
+标准 MIDI 文件的音轨数据直接解析为结构化数组，音符按 (开始, 结束, 音高, 力度, 音轨, 通道) 保存，
+不经过 mido 的逐事件对象；元事件、控制器和歌词等只记录位置，需要时才解码。
+'''
+
+# 音符记录: 开始/结束 tick、音高、力度、所在音轨、MIDI 通道、音符结束时通道上的音色
+NOTE_DTYPE = [('start', '<i8'), ('end', '<i8'), ('pitch', 'u1'), ('velocity', 'u1'),
+              ('track', '<u2'), ('channel', 'u1'), ('program', 'u1')]
+# 非音符事件记录: 通道消息直接保存数据字节；元事件/SysEx 的 data1 为元事件类型，数据按 offset/length 延迟解码
+EVENT_DTYPE = [('tick', '<i8'), ('track', '<u2'), ('status', 'u1'), ('data1', 'u1'), ('data2', 'u1'),
+               ('offset', '<i8'), ('length', '<u4')]
+
+META_TRACK_NAME = 0x03
+META_LYRIC = 0x05
+META_MARKER = 0x06
+META_END_OF_TRACK = 0x2F
+META_TEMPO = 0x51
+META_TIME_SIGNATURE = 0x58
+META_KEY_SIGNATURE = 0x59
+
+# 调号 (升降号数, 是否小调) -> miditoolkit 使用的调名
+_MAJOR_KEYS = ['Cb', 'Gb', 'Db', 'Ab', 'Eb', 'Bb', 'F', 'C', 'G', 'D', 'A', 'E', 'B', 'F#', 'C#']
+_MINOR_KEYS = ['Abm', 'Ebm', 'Bbm', 'Fm', 'Cm', 'Gm', 'Dm', 'Am', 'Em', 'Bm', 'F#m', 'C#m', 'G#m', 'D#m', 'A#m']
+
+
+class MidiArrays:
+    """
+    列式的 MIDI 文档。
+    - notes: NOTE_DTYPE 数组，按 (音轨, 开始 tick) 排序。
+    - events: 非音符事件的 EVENT_DTYPE 数组，按 (音轨, 文件中的顺序) 排列。
+    元事件和 SysEx 的内容保留在原始文件数据中，调用对应方法时才解码。
+    """
+    def __init__(self, ticks_per_beat, num_tracks, notes, events, data, track_end_ticks):
+        """
+        参数:
+            ticks_per_beat (int): 每拍的刻度数。
+            num_tracks (int): 音轨数。
+            notes (numpy.ndarray): NOTE_DTYPE 数组。
+            events (numpy.ndarray): EVENT_DTYPE 数组。
+            data (bytes): 原始文件数据（用于延迟解码）。
+            track_end_ticks (list): 每条音轨最后一个事件的 tick。
+        """
+        self.ticks_per_beat = ticks_per_beat
+        self.num_tracks = num_tracks
+        self.notes = notes
+        self.events = events
+        self._data = data
+        self.track_end_ticks = track_end_ticks
+
+    @property
+    def max_tick(self):
+        """最后一个事件（或音符结束）的 tick。"""
+        end = max(self.track_end_ticks, default=0)
+        if len(self.notes):
+            end = max(end, int(self.notes['end'].max()))
+        return end
+
+    def _meta(self, meta_type, track=None):
+        """返回指定类型元事件的 (tick, 音轨, 数据) 列表（延迟解码）。"""
+        events = self.events
+        mask = (events['status'] == 0xFF) & (events['data1'] == meta_type)
+        if track is not None:
+            mask &= events['track'] == track
+        data = self._data
+        return [(int(tick), int(trk), bytes(data[offset:offset + length]))
+                for tick, trk, offset, length in zip(events['tick'][mask], events['track'][mask],
+                                                     events['offset'][mask], events['length'][mask])]
+
+    def channel_events(self, kind, track=None, channel=None):
+        """
+        返回指定类型的通道消息（不创建逐事件对象）。
+        参数:
+            kind (int): 状态字节高 4 位，如 0xB0 表示控制器。
+            track (int, optional): 只返回该音轨的事件。
+            channel (int, optional): 只返回该通道的事件。
+        返回:
+            numpy.ndarray: EVENT_DTYPE 数组。
+        """
+        status = self.events['status']
+        mask = (status & 0xF0) == kind
+        if track is not None:
+            mask &= self.events['track'] == track
+        if channel is not None:
+            mask &= (status & 0x0F) == channel
+        return self.events[mask]
+
+    def control_changes(self, track=None, channel=None):
+        """返回控制器事件（EVENT_DTYPE 数组，data1 为控制器号，data2 为数值）。"""
+        return self.channel_events(0xB0, track, channel)
+
+    def track_names(self):
+        """返回每条音轨的名称（没有名称的音轨为空字符串）。"""
+        names = [''] * self.num_tracks
+        for tick, track, data in reversed(self._meta(META_TRACK_NAME)):
+            names[track] = data.decode('latin-1')
+        return names
+
+    def tempo_changes(self):
+        """
+        返回 [(tick, bpm), ...]，按 tick 排序。与 miditoolkit 一致：默认从 120 BPM 开始，
+        tick 0 处的速度替换默认值，与前一个速度相同的变化被忽略。
+        """
+        tempos = [(0, 120.0)]
+        for tick, track, data in sorted(self._meta(META_TEMPO)):
+            if len(data) < 3:
+                continue
+            bpm = 60_000_000 / max(int.from_bytes(data[:3], 'big'), 1)
+            if tick == 0:
+                tempos = [(0, bpm)]
+            elif bpm != tempos[-1][1]:
+                tempos.append((tick, bpm))
+        return tempos
+
+    def time_signatures(self):
+        """返回 [(tick, 分子, 分母), ...]。"""
+        return sorted((tick, data[0], 2 ** data[1])
+                      for tick, track, data in self._meta(META_TIME_SIGNATURE) if len(data) >= 2)
+
+    def key_signatures(self):
+        """返回 [(tick, 调名), ...]。"""
+        keys = []
+        for tick, track, data in self._meta(META_KEY_SIGNATURE):
+            if len(data) < 2:
+                continue
+            sharps = struct.unpack('b', data[:1])[0]
+            if -7 <= sharps <= 7:
+                keys.append((tick, (_MINOR_KEYS if data[1] else _MAJOR_KEYS)[sharps + 7]))
+        return sorted(keys)
+
+    def lyrics(self):
+        """返回 [(tick, 歌词文本), ...]。"""
+        return sorted((tick, data.decode('latin-1')) for tick, track, data in self._meta(META_LYRIC))
+
+    def markers(self):
+        """返回 [(tick, 标记文本), ...]。"""
+        return sorted((tick, data.decode('latin-1')) for tick, track, data in self._meta(META_MARKER))
+
+    def validate(self):
+        """
+        向量化检查音符数据。
+        异常:
+            ValueError: 存在无效音高、力度或起止时间错误的音符，或通道消息的数据字节超出 0-127。
+        """
+        if self.ticks_per_beat <= 0:
+            raise ValueError(f"无效的ticks_per_beat值: {self.ticks_per_beat}")
+        bad = np.flatnonzero(self.notes['pitch'] > 127)
+        if len(bad):
+            raise ValueError(f"无效的音高值: {self.notes['pitch'][bad[0]]}")
+        bad = np.flatnonzero(self.notes['velocity'] > 127)
+        if len(bad):
+            raise ValueError(f"无效的力度值: {self.notes['velocity'][bad[0]]}")
+        is_channel = self.events['status'] < 0xF0
+        bad = np.flatnonzero(is_channel & ((self.events['data1'] > 127) | (self.events['data2'] > 127)))
+        if len(bad):
+            event = self.events[bad[0]]
+            raise ValueError(f"无效的数据字节: 状态 0x{event['status']:02X}, 数据 {event['data1']} {event['data2']}")
+        bad = np.flatnonzero(self.notes['start'] > self.notes['end'])
+        if len(bad):
+            note = self.notes[bad[0]]
+            raise ValueError(f"音符起止时间错误: start={note['start']}, end={note['end']}")
+
+    def to_miditoolkit(self):
+        """
+        转换为编辑器使用的 miditoolkit.MidiFile，每个 (音轨, 通道) 一个乐器。
+        返回:
+            miditoolkit.MidiFile: 文档。
+        """
+        midi = miditoolkit.MidiFile(ticks_per_beat=self.ticks_per_beat)
+        midi.max_tick = self.max_tick + 1
+        midi.tempo_changes = [TempoChange(bpm, tick) for tick, bpm in self.tempo_changes()]
+        midi.time_signature_changes = [TimeSignature(n, d, tick) for tick, n, d in self.time_signatures()]
+        midi.key_signature_changes = [KeySignature(name, tick) for tick, name in self.key_signatures()]
+        midi.lyrics = [Lyric(text, tick) for tick, text in self.lyrics()]
+        midi.markers = [Marker(text, tick) for tick, text in self.markers()]
+
+        notes = self.notes
+        events = self.events
+        names = self.track_names()
+        # 与 miditoolkit 一致：每个 (音色, 通道, 音轨) 一个乐器，按第一个音符出现的顺序排列；
+        # 控制器和弯音归入同一 (音轨, 通道) 的第一个乐器，没有音符的通道不生成乐器
+        instrument_key = (notes['track'].astype(np.int64) * 16 + notes['channel']) * 128 + notes['program']
+        keys, first = np.unique(instrument_key, return_index=True)
+        keys = keys[np.argsort(first, kind='stable')]
+        status = events['status']
+        event_kind = np.where(status < 0xF0, status & 0xF0, 0)
+        event_channel = events['track'].astype(np.int64) * 16 + (status & 0x0F)
+        attached = set()
+        for key in keys.tolist():
+            ch, program = divmod(key, 128)
+            track, channel = divmod(ch, 16)
+            instrument = Instrument(program=program, is_drum=(channel == 9), name=names[track])
+            selected = notes[instrument_key == key]
+            instrument.notes = [
+                Note(v, p, s, e) for v, p, s, e in zip(selected['velocity'].tolist(), selected['pitch'].tolist(),
+                                                       selected['start'].tolist(), selected['end'].tolist())
+            ]
+            if ch not in attached:
+                attached.add(ch)
+                cc = events[(event_kind == 0xB0) & (event_channel == ch)]
+                instrument.control_changes = [
+                    ControlChange(n, v, t) for n, v, t in zip(cc['data1'].tolist(), cc['data2'].tolist(), cc['tick'].tolist())
+                ]
+                bends = events[(event_kind == 0xE0) & (event_channel == ch)]
+                values = ((bends['data2'].astype(np.int64) << 7) | bends['data1']) - 8192
+                instrument.pitch_bends = [PitchBend(v, t) for v, t in zip(values.tolist(), bends['tick'].tolist())]
+            midi.instruments.append(instrument)
+        return midi
+
+
+class _CorruptEvent(ValueError):
+    """音轨中无法解析的事件，记录出错的位置和此前的 tick，供修复加载时重新同步。"""
+    def __init__(self, message, position, tick):
+        super().__init__(message)
+        self.position = position
+        self.tick = tick
+
+
+def _parse_track(data, pos, end, note_tick, note_status, note_data, ev_tick, ev_status, ev_data, ev_offset, ev_length,
+                 program_changes, tick=0, running=0):
+    """
+    解析一条音轨的事件，追加到各列中。音色变化另外记录为 (通道, 音色, 此前的音符事件数)，
+    用于确定每个音符所属的乐器。
+    参数:
+        tick (int): 起始位置的 tick（从音轨中间继续解析时使用）。
+        running (int): 起始位置的运行状态。
+    返回:
+        int: 音轨最后一个事件的 tick。
+    异常:
+        ValueError: 缺少状态字节、存在未知的状态字节、可变长度数值过长或事件长度超出音轨（_CorruptEvent）。
+        IndexError: 音轨数据被截断。
+    """
+    while pos < end:
+        # 可变长度的 delta time（最多 4 个字节）
+        b = data[pos]
+        pos += 1
+        if b & 0x80:
+            value = b & 0x7F
+            for _ in range(3):
+                b = data[pos]
+                pos += 1
+                value = (value << 7) | (b & 0x7F)
+                if not b & 0x80:
+                    break
+            else:
+                raise _CorruptEvent(f"delta time 超过 4 个字节 (位置 {pos})", pos, tick)
+            tick += value
+        else:
+            tick += b
+
+        status = data[pos]
+        if status & 0x80:
+            pos += 1
+            if status < 0xF0:
+                running = status
+        elif running:
+            status = running  # 运行状态：当前字节是数据字节
+        else:
+            raise _CorruptEvent(f"缺少状态字节 (位置 {pos})", pos, tick)
+
+        kind = status & 0xF0
+        if kind == 0x90 or kind == 0x80:
+            note_tick.append(tick)
+            note_status.append(status)
+            note_data += data[pos:pos + 2]
+            pos += 2
+        elif status < 0xF0:
+            ev_tick.append(tick)
+            ev_status.append(status)
+            if kind == 0xC0 or kind == 0xD0:
+                if kind == 0xC0:
+                    program_changes.append((status & 0x0F, data[pos], len(note_tick)))
+                ev_data.append(data[pos])
+                ev_data.append(0)
+                pos += 1
+            else:
+                ev_data += data[pos:pos + 2]
+                pos += 2
+            ev_offset.append(0)
+            ev_length.append(0)
+        elif status == 0xFF or status == 0xF0 or status == 0xF7:
+            meta_type = 0
+            if status == 0xFF:
+                meta_type = data[pos]
+                pos += 1
+            # 数据长度（最多 4 个字节），不能超出音轨末尾
+            b = data[pos]
+            pos += 1
+            length = b & 0x7F
+            if b & 0x80:
+                for _ in range(3):
+                    b = data[pos]
+                    pos += 1
+                    length = (length << 7) | (b & 0x7F)
+                    if not b & 0x80:
+                        break
+                else:
+                    raise _CorruptEvent(f"事件长度超过 4 个字节 (位置 {pos})", pos, tick)
+            if pos + length > end:
+                raise _CorruptEvent(f"事件长度 {length} 超出音轨末尾 (位置 {pos})", pos, tick)
+            ev_tick.append(tick)
+            ev_status.append(status)
+            ev_data.append(meta_type)
+            ev_data.append(0)
+            ev_offset.append(pos)
+            ev_length.append(length)
+            pos += length
+            if status == 0xFF and meta_type == META_END_OF_TRACK:
+                break
+        else:
+            raise _CorruptEvent(f"未知的状态字节 0x{status:02X} (位置 {pos - 1})", pos - 1, tick)
+    if pos > end:
+        raise IndexError("音轨数据被截断")
+    return tick
+
+
+def _pair_notes(note_tick, note_status, note_data, note_track, program_changes, close_at=None):
+    """
+    将 note-on/note-off 事件向量化配对为音符，规则与 miditoolkit 相同：
+    同一音轨同一通道同一音高的事件按文件顺序分组，每个 note-off 关闭该组中最早的未结束音符（先进先出），
+    没有未结束音符时的 note-off 被忽略，直到文件结束都没有 note-off 的音符被丢弃。
+    参数:
+        program_changes (list): [(音轨, 通道, 音色, 此前的音符事件数), ...]，按文件顺序。
+        close_at (numpy.ndarray, optional): 每条音轨的结束 tick；提供时没有 note-off 的音符不丢弃，
+            而是在所在音轨的结束位置结束（修复加载时使用）。
+    返回:
+        numpy.ndarray: 按 (音轨, 开始 tick) 排序的 NOTE_DTYPE 数组；
+            提供 close_at 时返回 (音符数组, 在音轨末尾结束的音符数)。
+    """
+    if not len(note_tick):
+        empty = np.empty(0, dtype=NOTE_DTYPE)
+        return empty if close_at is None else (empty, 0)
+    ticks = np.frombuffer(note_tick, dtype=np.int64)
+    status = np.frombuffer(bytes(note_status), dtype=np.uint8)
+    pair = np.frombuffer(bytes(note_data), dtype=np.uint8).reshape(-1, 2)
+    pitch = pair[:, 0]
+    velocity = pair[:, 1]
+    track = np.frombuffer(note_track, dtype=np.uint16)
+    channel = status & 0x0F
+    is_on = ((status & 0xF0) == 0x90) & (velocity > 0)
+
+    # 中间数组使用 int32 并及时释放，百万级音符时峰值内存只有几十 MB
+    key = (track.astype(np.int32) * 16 + channel) * 128 + pitch
+    order = np.argsort(key, kind='stable')  # 稳定排序：组内保持文件顺序
+    sorted_key = key[order]
+    del key
+    on = is_on[order].astype(np.int32)
+    off = 1 - on
+    is_start = np.empty(len(order), dtype=bool)
+    is_start[0] = True
+    np.not_equal(sorted_key[1:], sorted_key[:-1], out=is_start[1:])
+    del sorted_key
+    group_start = np.flatnonzero(is_start)
+    group = np.cumsum(is_start, dtype=np.int32) - 1
+    del is_start
+    # 组内累计的 note-on / note-off 数
+    on_count = np.cumsum(on, dtype=np.int32)
+    on_count -= (on_count - on)[group_start][group]
+    off_count = np.cumsum(off, dtype=np.int32)
+    off_count -= (off_count - off)[group_start][group]
+    # 被忽略的 note-off 数 = 组内 (off 数 - on 数) 前缀最大值（不小于 0）
+    span = np.int64(2 * len(order) + 2)
+    offset = group * span
+    excess = (off_count - on_count) + offset
+    ignored = np.maximum.accumulate(excess)
+    del excess
+    ignored -= offset
+    del offset
+    np.maximum(ignored, 0, out=ignored)
+    closed = (off_count - ignored).astype(np.int32)  # 组内已关闭的音符数
+    del ignored, off_count
+    previous = np.empty_like(closed)
+    previous[0] = 0
+    previous[1:] = closed[:-1]
+    previous[group_start] = 0
+    valid_off = (off == 1) & (closed > previous)
+    del previous, off
+    # 第 k 个有效 note-off 关闭组内第 k 个 note-on；两者都已按 (组, k) 排序
+    group_end = np.append(group_start[1:] - 1, len(order) - 1)
+    total_closed = closed[group_end]  # closed 在组内单调不减，组末即该组关闭的音符总数
+    valid_on = (on == 1) & (on_count <= total_closed[group])
+    del closed, on_count, group
+    on_index = order[valid_on]
+    off_index = order[valid_off]
+    end_tick = ticks[off_index]
+    if close_at is not None:
+        # 未结束的音符在音轨末尾结束；其音色取音轨结束时的音色
+        open_index = order[(on == 1) & ~valid_on]
+        on_index = np.concatenate((on_index, open_index))
+        off_index = np.concatenate((off_index, np.full(len(open_index), len(ticks), dtype=off_index.dtype)))
+        end_tick = np.concatenate((end_tick, np.asarray(close_at, dtype=np.int64)[track[open_index]]))
+    del order, on
+
+    notes = np.empty(len(on_index), dtype=NOTE_DTYPE)
+    notes['start'] = ticks[on_index]
+    notes['end'] = end_tick
+    notes['pitch'] = pitch[on_index]
+    notes['velocity'] = velocity[on_index]
+    notes['track'] = track[on_index]
+    notes['channel'] = channel[on_index]
+    # 音色取 note-off 时通道上的当前音色（音色变化很少，逐个处理）
+    program = np.zeros(len(on_index), dtype=np.uint8)
+    for change_track, change_channel, change_program, position in program_changes:
+        program[(notes['track'] == change_track) & (notes['channel'] == change_channel) & (off_index >= position)] = change_program
+    notes['program'] = program
+    notes = notes[np.lexsort((notes['start'], notes['track']))]
+    return notes if close_at is None else (notes, len(on_index) - int(valid_off.sum()))
+
+
+class SalvageReport:
+    """
+    修复加载的记录：每一项为 (音轨序号或 None, 说明)。
+    """
+    def __init__(self):
+        self.entries = []
+
+    def add(self, track, message):
+        """记录一项修复（track 为 None 表示整个文件）。"""
+        self.entries.append((track, message))
+
+    def __bool__(self):
+        return bool(self.entries)
+
+    def format_text(self, max_lines=None):
+        """
+        生成可读的修复说明（用于界面显示和日志）。
+        参数:
+            max_lines (int, optional): 最多列出的条数，其余的只给出数量。
+        返回:
+            str: 多行文本。
+        """
+        if not self.entries:
+            return "文件完好，没有需要修复的内容"
+        lines = [message if track is None else f"音轨 {track}: {message}" for track, message in self.entries]
+        if max_lines is not None and len(lines) > max_lines:
+            lines = lines[:max_lines] + [f"……另有 {len(lines) - max_lines} 项修复"]
+        return "\n".join(lines)
+
+
+def _resync(data, pos, end):
+    """
+    从损坏的位置向后寻找下一个看起来有效的事件：单字节 delta time 后跟通道消息状态字节或元事件。
+    返回:
+        int or None: 新事件的起始位置（delta time 所在字节），找不到时为 None。
+    """
+    for position in range(pos, end - 1):
+        if data[position] & 0x80:
+            continue
+        status = data[position + 1]
+        if 0x80 <= status < 0xF0 and position + 2 < end and not data[position + 2] & 0x80:
+            return position
+        if status == 0xFF and position + 2 < end and not data[position + 2] & 0x80:
+            return position
+    return None
+
+
+def _trim_columns(note_tick, note_status, note_data, ev_tick, ev_status, ev_data, ev_offset, ev_length):
+    """音轨中途截断时，去掉最后一个只追加了一部分列的事件，使各列长度一致。"""
+    notes = min(len(note_tick), len(note_status), len(note_data) // 2)
+    del note_tick[notes:], note_status[notes:], note_data[notes * 2:]
+    events = min(len(ev_tick), len(ev_status), len(ev_data) // 2, len(ev_offset), len(ev_length))
+    del ev_tick[events:], ev_status[events:], ev_data[events * 2:], ev_offset[events:], ev_length[events:]
+
+
+def _read_midi(data, report=None):
+    """
+    解析标准 MIDI 文件的数据。report 为 SalvageReport 时以修复模式解析：
+    损坏的事件被跳过并在之后重新同步，截断的音轨保留已解析的部分，未结束的音符在音轨末尾结束，
+    无效的音符和数据字节被批量丢弃或截断到有效范围，每项修复都记录在 report 中。
+    返回:
+        MidiArrays: 列式文档。
+    异常:
+        ValueError: 文件不是有效的标准 MIDI 文件，或（非修复模式下）数据损坏。
+    """
+    if len(data) < 14 or data[:4] != b'MThd':
+        raise ValueError("不是有效的MIDI文件：缺少 MThd 文件头")
+    header_length = struct.unpack('>I', data[4:8])[0]
+    midi_format, num_tracks, division = struct.unpack('>HHH', data[8:14])
+    if division & 0x8000:
+        raise ValueError("不支持 SMPTE 时间格式的MIDI文件")
+    if midi_format > 2:
+        if report is None:
+            raise ValueError(f"不支持的MIDI格式: {midi_format}")
+        report.add(None, f"文件头中的格式 {midi_format} 无效，按格式 1 读取")
+    if report is not None:
+        if header_length < 6 or header_length > 64:
+            report.add(None, f"文件头长度 {header_length} 无效，按 6 字节读取")
+            header_length = 6
+        if division == 0:
+            report.add(None, "ticks_per_beat 为 0，改为 480")
+            division = 480
+
+    note_tick, note_status, note_data, note_track = array('q'), bytearray(), bytearray(), array('H')
+    ev_tick, ev_status, ev_data, ev_offset, ev_length = array('q'), bytearray(), bytearray(), array('q'), array('I')
+    columns = (note_tick, note_status, note_data, ev_tick, ev_status, ev_data, ev_offset, ev_length)
+    ev_track = array('H')
+    program_changes = []
+    track_end_ticks = []
+    pos = 8 + header_length
+    track = 0
+    while pos + 8 <= len(data) and track < num_tracks:
+        chunk_type = data[pos:pos + 4]
+        chunk_length = struct.unpack('>I', data[pos + 4:pos + 8])[0]
+        if report is not None and chunk_type != b'MTrk' and not chunk_type.isalpha():
+            # 块头损坏：跳到下一个音轨块
+            found = data.find(b'MTrk', pos + 1)
+            if found < 0:
+                report.add(None, f"位置 {pos} 之后的数据无法识别，已忽略")
+                break
+            report.add(None, f"跳过位置 {pos} 处 {found - pos} 个无法识别的字节")
+            pos = found
+            continue
+        start = pos + 8
+        end = min(start + chunk_length, len(data))
+        pos = start + chunk_length
+        if chunk_type != b'MTrk':
+            continue  # 跳过未知的块
+        if report is not None and start + chunk_length > len(data):
+            report.add(track, f"音轨块声明 {chunk_length} 字节，文件中只有 {end - start} 字节")
+        notes_before, events_before = len(note_tick), len(ev_tick)
+        track_programs = []
+        if report is None:
+            try:
+                last_tick = _parse_track(data, start, end, *columns, track_programs)
+            except IndexError:
+                raise ValueError(f"音轨 {track} 数据不完整")
+        else:
+            last_tick = _salvage_track(data, start, end, columns, track_programs, track, report)
+        program_changes.extend((track,) + change for change in track_programs)
+        note_track.extend(array('H', [track]) * (len(note_tick) - notes_before))
+        ev_track.extend(array('H', [track]) * (len(ev_tick) - events_before))
+        track_end_ticks.append(last_tick)
+        track += 1
+    if track == 0 and num_tracks:
+        raise ValueError("无效的MIDI结构：缺少音轨数据")
+    if report is not None and track < num_tracks:
+        report.add(None, f"文件头声明 {num_tracks} 条音轨，只找到 {track} 条")
+
+    if report is None:
+        notes = _pair_notes(note_tick, note_status, note_data, note_track, program_changes)
+    else:
+        note_tick, note_status, note_data, note_track, program_changes = _drop_invalid_note_events(
+            note_tick, note_status, note_data, note_track, program_changes, report)
+        notes, closed = _pair_notes(note_tick, note_status, note_data, note_track, program_changes,
+                                    np.array(track_end_ticks, dtype=np.int64))
+        if closed:
+            report.add(None, f"{closed} 个没有 note-off 的音符在所在音轨的末尾结束")
+    events = np.empty(len(ev_tick), dtype=EVENT_DTYPE)
+    if len(ev_tick):
+        events['tick'] = np.frombuffer(ev_tick, dtype=np.int64)
+        events['track'] = np.frombuffer(ev_track, dtype=np.uint16)
+        events['status'] = np.frombuffer(bytes(ev_status), dtype=np.uint8)
+        pair = np.frombuffer(bytes(ev_data), dtype=np.uint8).reshape(-1, 2)
+        events['data1'] = pair[:, 0]
+        events['data2'] = pair[:, 1]
+        events['offset'] = np.frombuffer(ev_offset, dtype=np.int64)
+        events['length'] = np.frombuffer(ev_length, dtype=np.uint32)
+    if report is not None:
+        notes, events = _repair_values(notes, events, len(data), report)
+    return MidiArrays(division, track, notes, events, data, track_end_ticks)
+
+
+def _salvage_track(data, start, end, columns, track_programs, track, report):
+    """
+    以修复模式解析一条音轨：遇到损坏的事件时重新同步后继续，数据被截断时保留已解析的部分。
+    返回:
+        int: 音轨最后一个事件的 tick。
+    """
+    notes_before, events_before = len(columns[0]), len(columns[3])
+    pos, tick, running = start, 0, 0
+    while True:
+        try:
+            return _parse_track(data, pos, end, *columns, track_programs, tick=tick, running=running)
+        except _CorruptEvent as e:
+            resume = _resync(data, e.position, end)
+            if resume is None:
+                report.add(track, f"位置 {e.position} 之后的 {end - e.position} 个字节无法解析，已忽略")
+                return e.tick
+            report.add(track, f"{e}，跳过 {resume - e.position} 个字节后继续解析")
+            pos, tick, running = resume, e.tick, 0
+        except IndexError:
+            _trim_columns(*columns)
+            last_tick = max(max(columns[0][notes_before:], default=tick), max(columns[3][events_before:], default=tick))
+            report.add(track, f"数据在 tick {last_tick} 之后被截断，保留已解析的事件")
+            return last_tick
+
+
+def _drop_invalid_note_events(note_tick, note_status, note_data, note_track, program_changes, report):
+    """
+    在配对之前批量丢弃音高无效（数据字节 >127，通常意味着事件错位）的 note-on/note-off，
+    避免它们与其他音高的事件错误配对。音色变化记录的位置随之调整。
+    返回:
+        tuple: 过滤后的 (note_tick, note_status, note_data, note_track, program_changes)。
+    """
+    if not len(note_tick):
+        return note_tick, note_status, note_data, note_track, program_changes
+    pair = np.frombuffer(bytes(note_data), dtype=np.uint8).reshape(-1, 2)
+    keep = pair[:, 0] <= 127
+    if keep.all():
+        return note_tick, note_status, note_data, note_track, program_changes
+    report.add(None, f"丢弃 {int((~keep).sum())} 个音高无效的音符事件")
+    kept_before = np.concatenate(([0], np.cumsum(keep)))  # 每个位置之前保留的音符事件数
+    return (np.frombuffer(note_tick, dtype=np.int64)[keep].tobytes(),
+            np.frombuffer(bytes(note_status), dtype=np.uint8)[keep].tobytes(),
+            pair[keep].tobytes(),
+            np.frombuffer(note_track, dtype=np.uint16)[keep].tobytes(),
+            [(track, channel, program, int(kept_before[position]))
+             for track, channel, program, position in program_changes])
+
+
+def _repair_values(notes, events, size, report):
+    """
+    批量修复无效的音符和事件数据（数据字节越界通常意味着事件错位）。
+    返回:
+        tuple: (notes, events)。
+    """
+    bad_velocity = notes['velocity'] > 127
+    if bad_velocity.any():
+        report.add(None, f"{int(bad_velocity.sum())} 个音符的力度超出范围，已改为 127")
+        notes['velocity'][bad_velocity] = 127
+    is_channel = events['status'] < 0xF0
+    bad_data = is_channel & ((events['data1'] > 127) | (events['data2'] > 127))
+    if bad_data.any():
+        report.add(None, f"{int(bad_data.sum())} 个控制器/音色/弯音事件的数据超出范围，已截断到 0-127")
+        events['data1'][bad_data] &= 0x7F
+        events['data2'][bad_data] &= 0x7F
+    bad_length = ~is_channel & (events['offset'] + events['length'] > size)
+    if bad_length.any():
+        report.add(None, f"{int(bad_length.sum())} 个元事件的数据被截断")
+        events['length'][bad_length] = size - events['offset'][bad_length]
+    return notes, events
+
+
+def parse_midi_arrays(data):
+    """
+    将内存中的标准 MIDI 数据（如剪贴板中的 MIDI 片段）解析为列式文档。
+    参数:
+        data (bytes): 标准 MIDI 文件内容。
+    返回:
+        MidiArrays: 列式文档。
+    异常:
+        ValueError: 数据不是有效的标准 MIDI 文件或已损坏。
+    """
+    return _read_midi(bytes(data))
+
+
+def load_midi_arrays(path):
+    """
+    将标准 MIDI 文件解析为列式文档。
+    参数:
+        path (str): MIDI 文件路径。
+    返回:
+        MidiArrays: 列式文档。
+    异常:
+        ValueError: 文件不是有效的标准 MIDI 文件或数据损坏。
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    return parse_midi_arrays(data)
+
+
+def salvage_midi_arrays(path):
+    """
+    以修复模式解析损坏或被截断的 MIDI 文件（如录制时断电留下的文件）。
+    参数:
+        path (str): MIDI 文件路径。
+    返回:
+        tuple: (MidiArrays, SalvageReport)。
+    异常:
+        ValueError: 文件头损坏或找不到任何音轨，无法修复。
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    report = SalvageReport()
+    return _read_midi(data, report), report
+
+
+def load_midi_document(path):
+    """
+    加载 MIDI 文件并向量化校验，返回编辑器使用的 miditoolkit.MidiFile。
+    参数:
+        path (str): MIDI 文件路径。
+    返回:
+        miditoolkit.MidiFile: 文档。
+    异常:
+        ValueError: 文件损坏或格式不支持。
+    """
+    arrays = load_midi_arrays(path)
+    arrays.validate()
+    return arrays.to_miditoolkit()
+
+
+def salvage_midi_document(path):
+    """
+    以修复模式加载 MIDI 文件，返回编辑器使用的 miditoolkit.MidiFile 和修复记录。
+    参数:
+        path (str): MIDI 文件路径。
+    返回:
+        tuple: (miditoolkit.MidiFile, SalvageReport)。
+    异常:
+        ValueError: 文件无法修复。
+    """
+    arrays, report = salvage_midi_arrays(path)
+    return arrays.to_miditoolkit(), report
@@ -1,30 +1,866 @@
+import os
 import time
 import rtmidi
 import mido
-from mido import MidiFile, MidiTrack, Message
-from threading import Lock
+import numpy as np
+import miditoolkit
+from mido import MidiFile
+from miditoolkit import Instrument, Note, ControlChange, PitchBend, TempoChange
+from threading import Lock, Thread, Event
+from collections import deque
+from bisect import bisect_right
 import logging
+from capturejournal import CaptureJournal, read_journal, find_journals
+from smfwriter import SmfWriter
+from tempotracker import TempoTracker, TempoMap
+
+# 多端口录制时，各端口时间轴相对共享时钟允许的最大偏差（秒）
+MAX_CLOCK_SKEW = 0.001
+# 录制时供实时显示的速度图最短更新间隔（录制时间，秒）
+LIVE_TEMPO_INTERVAL = 0.5
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# 录制事件的定长记录格式：相对录制开始的时间（秒）+ 输入端口序号 + 最多 3 个 MIDI 字节 + 实际字节数
+EVENT_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('port', 'u1'),
+    ('status', 'u1'),
+    ('data1', 'u1'),
+    ('data2', 'u1'),
+    ('length', 'u1'),
+])
+
+
+class EventRingBuffer:
+    """
+    预分配的单生产者/单消费者环形缓冲区，用于在 rtmidi 回调与消费线程之间传递事件。
+    生产者（回调）只修改写指针，消费者只修改读指针，因此双方都无需加锁。
+    缓冲区写满时新事件会被丢弃并计入 overruns，回调永远不会阻塞。
+    """
+    def __init__(self, capacity=1 << 16, port=0):
+        """
+        参数:
+            capacity (int): 缓冲区容量（记录数），会向上取整为 2 的幂。
+            port (int): 写入记录的输入端口序号。
+        """
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self.capacity = size
+        self.port = port
+        self._mask = size - 1
+        self._buffer = np.zeros(size, dtype=EVENT_DTYPE)
+        self._write = 0  # 只由生产者递增
+        self._read = 0   # 只由消费者递增
+        self.overruns = 0  # 因缓冲区已满而丢弃的事件数
+
+    def push(self, event_time, message):
+        """
+        写入一条事件（由 rtmidi 回调线程调用）。
+        参数:
+            event_time (float): 相对录制开始的时间（秒）。
+            message (list): MIDI 消息字节，超过 3 字节的消息（SysEx）不支持。
+        返回:
+            bool: 是否写入成功。
+        """
+        length = len(message)
+        if length == 0 or length > 3:
+            return False
+        write = self._write
+        if write - self._read >= self.capacity:
+            self.overruns += 1
+            return False
+        self._buffer[write & self._mask] = (
+            event_time,
+            self.port,
+            message[0],
+            message[1] if length > 1 else 0,
+            message[2] if length > 2 else 0,
+            length,
+        )
+        # 先写数据再发布写指针，消费者只会看到完整的记录
+        self._write = write + 1
+        return True
+
+    def drain(self):
+        """
+        取出当前所有可读事件（由消费线程调用）。
+        返回:
+            numpy.ndarray: EVENT_DTYPE 数组的拷贝，无事件时为空数组。
+        """
+        read = self._read
+        write = self._write
+        count = write - read
+        if count <= 0:
+            return np.empty(0, dtype=EVENT_DTYPE)
+        start = read & self._mask
+        end = start + count
+        if end <= self.capacity:
+            chunk = self._buffer[start:end].copy()
+        else:
+            chunk = np.concatenate((self._buffer[start:], self._buffer[:end - self.capacity]))
+        self._read = write
+        return chunk
+
+    def reset(self):
+        """清空缓冲区（仅在生产者停止时调用）。"""
+        self._write = 0
+        self._read = 0
+        self.overruns = 0
+
+
+class RetroactiveBuffer:
+    """
+    后台持续捕获使用的定长历史缓冲区。容量在创建时一次性分配，写满后覆盖最旧的事件，
+    因此无论程序运行多久，内存占用都保持不变。只由消费线程写入，读取时加锁复制。
+    """
+    def __init__(self, capacity=1 << 19, max_age=600.0):
+        """
+        参数:
+            capacity (int): 最多保存的事件数。
+            max_age (float): 保留的时长（秒），更早的事件在查询时被忽略。
+        """
+        self.capacity = capacity
+        self.max_age = max_age
+        self._buffer = np.zeros(capacity, dtype=EVENT_DTYPE)
+        self._count = 0  # 累计写入的事件数（写入位置为 _count % capacity）
+        self.port_names = []  # 事件 port 字段对应的端口名称
+        self._lock = Lock()
+
+    def append(self, records):
+        """
+        追加一批按时间排序的事件，超出容量时覆盖最旧的事件。
+        参数:
+            records (numpy.ndarray): EVENT_DTYPE 数组。
+        """
+        if len(records) > self.capacity:
+            records = records[-self.capacity:]
+        n = len(records)
+        if not n:
+            return
+        with self._lock:
+            start = self._count % self.capacity
+            first = min(n, self.capacity - start)
+            self._buffer[start:start + first] = records[:first]
+            if first < n:
+                self._buffer[:n - first] = records[first:]
+            self._count += n
+
+    def clear(self):
+        """清空历史。"""
+        with self._lock:
+            self._count = 0
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def latest_time(self):
+        """
+        返回:
+            float or None: 最新事件的时间，缓冲区为空时为 None。
+        """
+        with self._lock:
+            if not self._count:
+                return None
+            return float(self._buffer[(self._count - 1) % self.capacity]['time'])
+
+    def window(self, start, end):
+        """
+        复制时间落在 [start, end) 内（且不早于 max_age 之前）的事件。
+        参数:
+            start (float): 起始时间（秒，捕获时钟）。
+            end (float): 结束时间（秒，捕获时钟）。
+        返回:
+            numpy.ndarray: 按时间排序的 EVENT_DTYPE 数组。
+        """
+        with self._lock:
+            count = min(self._count, self.capacity)
+            if not count:
+                return np.empty(0, dtype=EVENT_DTYPE)
+            head = self._count % self.capacity
+            if self._count <= self.capacity:
+                ordered = self._buffer[:count]
+            else:
+                ordered = np.concatenate((self._buffer[head:], self._buffer[:head]))
+            times = ordered['time']
+            newest = float(times[-1])
+            start = max(start, newest - self.max_age)
+            lo = np.searchsorted(times, start, side='left')
+            hi = np.searchsorted(times, end, side='left')
+            return ordered[lo:hi].copy()
+
+
+class LatencyHistogram:
+    """
+    对数分桶的延迟直方图（1 微秒 ~ 100 毫秒），用于统计 MIDI 监听的回调到发送延迟。
+    每个端口的回调线程各自写入一个直方图，读取时再合并，因此写入无需加锁。
+    """
+    def __init__(self, min_latency=1e-6, max_latency=0.1, bins_per_decade=8):
+        """
+        参数:
+            min_latency (float): 最小分桶边界（秒）。
+            max_latency (float): 最大分桶边界（秒），超出的计入最后一个桶。
+            bins_per_decade (int): 每个数量级的分桶数。
+        """
+        decades = np.log10(max_latency / min_latency)
+        self.edges = np.logspace(np.log10(min_latency), np.log10(max_latency),
+                                 int(round(decades * bins_per_decade)) + 1).tolist()
+        self.counts = [0] * (len(self.edges) + 1)  # 第 0 个桶为小于 min_latency，最后一个桶为超过 max_latency
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def record(self, latency):
+        """
+        记录一次延迟（在回调线程中调用，开销为一次二分查找）。
+        参数:
+            latency (float): 延迟（秒）。
+        """
+        self.counts[bisect_right(self.edges, latency)] += 1
+        self.total += latency
+        if latency > self.maximum:
+            self.maximum = latency
+
+    def reset(self):
+        """清空统计。"""
+        self.counts = [0] * (len(self.edges) + 1)
+        self.total = 0.0
+        self.maximum = 0.0
+
+    @classmethod
+    def merged(cls, histograms):
+        """
+        合并多个直方图（分桶参数相同）。
+        参数:
+            histograms (list): LatencyHistogram 列表。
+        返回:
+            LatencyHistogram: 合并后的新直方图。
+        """
+        result = cls()
+        for histogram in histograms:
+            result.counts = [a + b for a, b in zip(result.counts, histogram.counts)]
+            result.total += histogram.total
+            result.maximum = max(result.maximum, histogram.maximum)
+        return result
+
+    def count(self):
+        """返回记录的总次数。"""
+        return sum(self.counts)
+
+    def percentile(self, q):
+        """
+        估算分位数（取所在桶的上边界）。
+        参数:
+            q (float): 分位数 (0-100)。
+        返回:
+            float: 延迟（秒），无记录时为 0。
+        """
+        count = self.count()
+        if not count:
+            return 0.0
+        cumulative = np.cumsum(self.counts)
+        index = int(np.searchsorted(cumulative, count * q / 100.0))
+        if index >= len(self.edges):
+            return self.maximum
+        return self.edges[index]
+
+    def summary(self):
+        """
+        返回:
+            dict: count, mean, p50, p90, p99, max（延迟单位为秒）。
+        """
+        count = self.count()
+        return {
+            'count': count,
+            'mean': self.total / count if count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.maximum,
+        }
+
+    def format_text(self, bar_width=30):
+        """
+        生成可读的直方图文本（用于界面显示和日志）。
+        参数:
+            bar_width (int): 最长柱的字符数。
+        返回:
+            str: 多行文本。
+        """
+        stats = self.summary()
+        if not stats['count']:
+            return "暂无监听延迟数据"
+        lines = [
+            f"事件数: {stats['count']}",
+            f"平均: {stats['mean'] * 1e6:.1f} µs  P50: ≤{stats['p50'] * 1e6:.1f} µs  "
+            f"P90: ≤{stats['p90'] * 1e6:.1f} µs  P99: ≤{stats['p99'] * 1e6:.1f} µs  最大: {stats['max'] * 1e6:.1f} µs",
+        ]
+        peak = max(self.counts)
+        lower = [0.0] + self.edges
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            bar = '#' * max(1, int(bar_width * count / peak))
+            upper = f"{self.edges[index] * 1e6:.1f}" if index < len(self.edges) else "∞"
+            lines.append(f"{lower[index] * 1e6:9.1f} - {upper:>9} µs | {bar} {count}")
+        return "\n".join(lines)
+
+
+# 可过滤的消息类型: 名称 -> 状态字节（通道消息为高 4 位）
+FILTERABLE_TYPES = {
+    'note': (0x80, 0x90),
+    'poly_aftertouch': (0xA0,),
+    'control_change': (0xB0,),
+    'program_change': (0xC0,),
+    'channel_aftertouch': (0xD0,),
+    'pitch_bend': (0xE0,),
+    'clock': (0xF8,),
+    'transport': (0xFA, 0xFB, 0xFC),
+    'active_sensing': (0xFE,),
+}
+
+
+class CaptureFilter:
+    """
+    录制回调中的事件过滤与精简规则，在事件写入缓冲区之前执行。
+    - drop_types: 直接丢弃的消息类型（见 FILTERABLE_TYPES）。
+    - 连续控制器（控制器、弯音、触后）精简：只有当数值变化 ≥ min_delta，
+      或数值有变化且距上次保留已过 min_interval 秒时才保留；数值不变的重复消息总是丢弃。
+      数值到达端点（0、最大值或弯音中心）时总是保留，保证控制器能回到静止位置。
+      被精简掉的最后一个数值会暂存，若 min_interval 秒内没有更新的消息，由消费线程通过
+      take_settled 补发，保证手势结束时的最终数值（如停在 64 的踏板）被录下。
+    每个输入端口使用独立的副本（见 clone）。精简状态由该端口的回调线程和消费线程共享，
+    用一把只在精简连续控制器时获取的锁保护。
+    """
+    def __init__(self, drop_types=('active_sensing', 'clock', 'transport', 'poly_aftertouch'),
+                 thin_continuous=True, min_delta=2, min_interval=0.02):
+        """
+        参数:
+            drop_types (iterable): 要丢弃的消息类型名称。
+            thin_continuous (bool): 是否精简连续控制器。
+            min_delta (int): 7 位数值的最小变化量（弯音按 14 位数值等比放大）。
+            min_interval (float): 数值有变化时保留消息的最小时间间隔（秒）。
+        """
+        self.drop_types = set(drop_types)
+        self.thin_continuous = thin_continuous
+        self.min_delta = min_delta
+        self.min_interval = min_interval
+        self._drop = bytearray(256)  # 按状态字节查表，1 表示丢弃
+        for name in self.drop_types:
+            for status in FILTERABLE_TYPES[name]:
+                if status < 0xF0:
+                    for channel in range(16):
+                        self._drop[status | channel] = 1
+                else:
+                    self._drop[status] = 1
+        self._last = {}  # (状态字节, 控制器号) -> (保留时间, 数值)
+        self._held = {}  # (状态字节, 控制器号) -> (时间, 消息字节, 数值)，被精简掉的最后一个数值
+        self._held_lock = Lock()
+        self.dropped = 0  # 被过滤或精简的事件数
+        self.kept = 0
+
+    def clone(self):
+        """返回配置相同、状态独立的副本（每个输入端口一个）。"""
+        return CaptureFilter(self.drop_types, self.thin_continuous, self.min_delta, self.min_interval)
+
+    def drops(self, name):
+        """返回指定类型的消息是否会被丢弃。"""
+        return name in self.drop_types
+
+    def accept(self, event_time, message):
+        """
+        判断一条消息是否应写入录制缓冲区（在 rtmidi 回调线程中调用）。
+        参数:
+            event_time (float): 事件时间（秒）。
+            message (list): MIDI 消息字节。
+        返回:
+            bool: True 表示保留。
+        """
+        status = message[0]
+        if self._drop[status]:
+            self.dropped += 1
+            return False
+        kind = status & 0xF0
+        if self.thin_continuous and len(message) >= 2 and kind in (0xA0, 0xB0, 0xD0, 0xE0):
+            if kind == 0xB0 or kind == 0xA0:
+                key = (status, message[1])
+                value = message[2] if len(message) > 2 else 0
+                scale, rest, top = 1, 0, 127
+            elif kind == 0xD0:
+                key = (status, 0)
+                value = message[1]
+                scale, rest, top = 1, 0, 127
+            else:
+                key = (status, 0)
+                value = (message[2] << 7 | message[1]) if len(message) > 2 else 0
+                scale, rest, top = 128, 8192, 16383
+            with self._held_lock:
+                last = self._last.get(key)
+                if last is not None:
+                    delta = abs(value - last[1])
+                    if delta == 0:
+                        # 回到已保留的数值，之前暂存的中间值不再需要补发
+                        self._held.pop(key, None)
+                        self.dropped += 1
+                        return False
+                    if (delta < self.min_delta * scale and event_time - last[0] < self.min_interval
+                            and value not in (rest, 0, top)):
+                        self._held[key] = (event_time, tuple(message), value)
+                        self.dropped += 1
+                        return False
+                self._held.pop(key, None)
+                self._last[key] = (event_time, value)
+        self.kept += 1
+        return True
+
+    def take_settled(self, now, force=False):
+        """
+        取出已稳定的暂存数值：距最后一次被精简已过 min_interval 秒且之后没有更新的消息（由消费线程调用）。
+        参数:
+            now (float): 当前的捕获时钟时间（秒）。
+            force (bool): 是否不论时间取出全部暂存数值（停止捕获时）。
+        返回:
+            list: (事件时间, 消息字节) 列表，补发的消息计为保留。
+        """
+        if not self._held:
+            return []
+        settled = []
+        with self._held_lock:
+            for key, (event_time, message, value) in list(self._held.items()):
+                if force or now - event_time >= self.min_interval:
+                    del self._held[key]
+                    self._last[key] = (event_time, value)
+                    settled.append((event_time, message))
+            self.dropped -= len(settled)
+            self.kept += len(settled)
+        return settled
+
+
+def event_bytes(record):
+    """
+    将一条 EVENT_DTYPE 记录还原为 MIDI 消息字节。
+    参数:
+        record (numpy.void): EVENT_DTYPE 记录。
+    返回:
+        list: MIDI 消息字节。
+    """
+    return [int(record['status']), int(record['data1']), int(record['data2'])][:int(record['length'])]
+
+
+class LiveNotePairer:
+    """
+    增量地将 note-on/note-off 事件配对为音符，用于录制时的实时显示。
+    同一端口、同一通道、同一音高的重复 note-on 会先结束之前未结束的音符。
+    """
+    def __init__(self):
+        self.open_notes = {}  # (port, channel, pitch) -> (开始时间, 力度)
+
+    def reset(self):
+        """清除所有未结束的音符。"""
+        self.open_notes.clear()
+
+    def feed(self, events):
+        """
+        处理一批新事件。
+        参数:
+            events (numpy.ndarray): 按时间排序的 EVENT_DTYPE 数组。
+        返回:
+            tuple: (started, finished)
+                started: 本批中开始且仍未结束的音符 [(port, channel, pitch, start, velocity)]
+                finished: 本批中结束的音符 [(port, channel, pitch, start, end, velocity)]，按结束顺序排列
+        """
+        started = {}
+        finished = []
+        if not len(events):
+            return [], finished
+        kind = events['status'] & 0xF0
+        # 先用向量化掩码筛出音符事件，控制器等密集事件不进入 Python 循环
+        notes = events[((kind == 0x90) | (kind == 0x80)) & (events['length'] == 3)]
+        for t, port, status, pitch, velocity in zip(notes['time'].tolist(), notes['port'].tolist(),
+                                                    notes['status'].tolist(), notes['data1'].tolist(),
+                                                    notes['data2'].tolist()):
+            key = (port, status & 0x0F, pitch)
+            opened = self.open_notes.pop(key, None)
+            if opened is not None:
+                started.pop(key, None)
+                finished.append(key + (opened[0], t, opened[1]))
+            if status & 0xF0 == 0x90 and velocity > 0:
+                self.open_notes[key] = (t, velocity)
+                started[key] = key + (t, velocity)
+        return list(started.values()), finished
+
+
+def _latin1(text):
+    """MIDI 文件中的文本按 latin-1 编码保存，无法编码的字符替换为 '?'。"""
+    return text.encode('latin-1', errors='replace').decode('latin-1')
+
+
+def events_to_document(events, ticks_per_beat=480, bpm=120, port_names=None, tempo_map=None):
+    """
+    将录制事件批量转换为编辑器使用的 miditoolkit.MidiFile 文档，无需经过文件保存和重新解析。
+    时间换算与音符配对均以 NumPy 向量化完成：同一端口同一通道同一音高的事件按时间排序后，
+    每个 note-on 与其后的第一个同键事件（note-off 或重新按下）配对。
+    参数:
+        events (numpy.ndarray): EVENT_DTYPE 数组（可以是内存映射）。
+        ticks_per_beat (int): 每拍的刻度数。
+        bpm (float): 秒到 tick 换算使用的 BPM（未提供 tempo_map 时）。
+        port_names (list, optional): 端口序号对应的端口名称，用于音轨命名。
+        tempo_map (TempoMap, optional): 速度图，提供时按速度图换算并写入 tempo_changes。
+    返回:
+        miditoolkit.MidiFile: 每个 (端口, MIDI 通道) 一个乐器的文档。
+    """
+    midi = miditoolkit.MidiFile(ticks_per_beat=ticks_per_beat)
+    if tempo_map is None:
+        tempo_map = TempoMap.constant(bpm)
+    midi.tempo_changes = [TempoChange(b, t) for t, b in tempo_map.tempo_changes(ticks_per_beat)]
+    if not len(events):
+        return midi
+
+    events = np.asarray(events)
+    events = events[np.argsort(events['time'], kind='stable')]
+    ticks = tempo_map.seconds_to_ticks(events['time'], ticks_per_beat)
+    status = events['status'].astype(np.int64)
+    kind = status & 0xF0
+    # 不同端口的同号通道视为不同的通道，以便分配到各自的音轨
+    channel = events['port'].astype(np.int64) * 16 + (status & 0x0F)
+    data1 = events['data1'].astype(np.int64)
+    data2 = events['data2'].astype(np.int64)
+    complete = events['length'] == 3
+    last_tick = int(ticks[-1])
+
+    # --- 音符配对 ---
+    is_on = (kind == 0x90) & (data2 > 0) & complete
+    is_off = ((kind == 0x80) | ((kind == 0x90) & (data2 == 0))) & complete
+    note_index = np.flatnonzero(is_on | is_off)
+    key = channel[note_index] * 128 + data1[note_index]
+    order = np.lexsort((note_index, key))  # 按 (通道, 音高) 分组，组内保持时间顺序
+    sorted_index = note_index[order]
+    sorted_key = key[order]
+    on_pos = np.flatnonzero(is_on[sorted_index])
+    next_pos = np.minimum(on_pos + 1, len(sorted_index) - 1)
+    has_next = (on_pos + 1 < len(sorted_index)) & (sorted_key[next_pos] == sorted_key[on_pos])
+    on_index = sorted_index[on_pos]
+    note_start = ticks[on_index]
+    # 没有对应 note-off 的音符持续到录制结束
+    note_end = np.where(has_next, ticks[sorted_index[next_pos]], last_tick)
+    note_end = np.maximum(note_end, note_start + 1)
+    note_channel = channel[on_index]
+    note_order = np.argsort(note_start, kind='stable')
+
+    cc_index = np.flatnonzero((kind == 0xB0) & complete)
+    bend_index = np.flatnonzero((kind == 0xE0) & complete)
+    program_index = np.flatnonzero((kind == 0xC0) & (events['length'] >= 2))
+
+    channels = np.unique(np.concatenate((note_channel, channel[cc_index], channel[bend_index])))
+    multi_port = len(np.unique(channels // 16)) > 1
+    for ch in channels.tolist():
+        programs = data1[program_index[channel[program_index] == ch]]
+        port, midi_channel = divmod(ch, 16)
+        name = f"Channel {midi_channel + 1}"
+        if multi_port:
+            port_name = port_names[port] if port_names and port < len(port_names) else f"Port {port + 1}"
+            name = f"{port_name} - {name}"
+        instrument = Instrument(program=int(programs[0]) if len(programs) else 0,
+                                is_drum=(midi_channel == 9), name=_latin1(name))
+        selected = note_order[note_channel[note_order] == ch]
+        instrument.notes = [
+            Note(velocity=v, pitch=p, start=s, end=e)
+            for v, p, s, e in zip(data2[on_index[selected]].tolist(), data1[on_index[selected]].tolist(),
+                                  note_start[selected].tolist(), note_end[selected].tolist())
+        ]
+        cc = cc_index[channel[cc_index] == ch]
+        instrument.control_changes = [
+            ControlChange(number=n, value=v, time=t)
+            for n, v, t in zip(data1[cc].tolist(), data2[cc].tolist(), ticks[cc].tolist())
+        ]
+        bends = bend_index[channel[bend_index] == ch]
+        bend_values = ((data2[bends] << 7) | data1[bends]) - 8192
+        instrument.pitch_bends = [
+            PitchBend(pitch=v, time=t) for v, t in zip(bend_values.tolist(), ticks[bends].tolist())
+        ]
+        midi.instruments.append(instrument)
+
+    midi.max_tick = max(last_tick, int(note_end.max()) if len(note_end) else 0) + 1
+    return midi
+
+
+def write_events_to_midi(events, filename, ticks_per_beat, bpm, port_names=None, chunk_size=1 << 16,
+                         tempo_map=None):
+    """
+    将录制事件按块流式写入 MIDI 文件，每个输入端口一条音轨（单端口时为格式 0 的单音轨文件）。
+    参数:
+        events (numpy.ndarray): EVENT_DTYPE 数组（可以是内存映射），同一端口的事件按时间排序。
+        filename (str): 输出文件路径。
+        ticks_per_beat (int): 每拍的刻度数。
+        bpm (float): 秒到 tick 换算使用的 BPM（未提供 tempo_map 时）。
+        port_names (list, optional): 端口序号对应的端口名称，写入音轨名。
+        chunk_size (int): 每次读取的事件数。
+        tempo_map (TempoMap, optional): 速度图，速度变化写入第一条音轨。
+    """
+    if tempo_map is None:
+        tempo_map = TempoMap.constant(bpm)
+    tempo_changes = tempo_map.tempo_changes(ticks_per_beat)
+    ports = set()
+    for offset in range(0, len(events), chunk_size):
+        ports.update(np.unique(np.asarray(events['port'][offset:offset + chunk_size])).tolist())
+    ports = sorted(ports) or [0]
+    with open(filename, 'wb') as f:
+        writer = SmfWriter(f, ticks_per_beat=ticks_per_beat, num_tracks=len(ports))
+        for track_index, port in enumerate(ports):
+            writer.begin_track()
+            if len(ports) > 1:
+                port_name = port_names[port] if port_names and port < len(port_names) else f"Port {port + 1}"
+                writer.write_meta(0, 0x03, _latin1(port_name).encode('latin-1'))
+            # 速度变化只写入第一条音轨，与事件按 tick 交错写入
+            pending = list(tempo_changes) if track_index == 0 else []
+            pending.reverse()
+            last_tick = 0
+            # 每条音轨单独扫描一遍事件，内存占用只与 chunk_size 有关
+            for offset in range(0, len(events), chunk_size):
+                chunk = np.asarray(events[offset:offset + chunk_size])
+                # 系统实时消息（时钟、活动感知等）不能写入 MIDI 文件
+                chunk = chunk[(chunk['status'] < 0xF0) & (chunk['port'] == port)]
+                # 使用绝对 tick 计算间隔，避免逐事件四舍五入的误差累积
+                ticks = tempo_map.seconds_to_ticks(chunk['time'], ticks_per_beat)
+                for record, tick in zip(chunk, ticks.tolist()):
+                    tick = max(tick, last_tick)
+                    while pending and pending[-1][0] <= tick:
+                        tempo_tick, tempo_bpm = pending.pop()
+                        tempo_tick = max(tempo_tick, last_tick)
+                        writer.write_tempo(tempo_tick - last_tick, mido.bpm2tempo(tempo_bpm))
+                        last_tick = tempo_tick
+                    writer.write_event(tick - last_tick, event_bytes(record))
+                    last_tick = tick
+            while pending:
+                tempo_tick, tempo_bpm = pending.pop()
+                tempo_tick = max(tempo_tick, last_tick)
+                writer.write_tempo(tempo_tick - last_tick, mido.bpm2tempo(tempo_bpm))
+                last_tick = tempo_tick
+            writer.end_track()
+
+
+class _PortInput:
+    """
+    一个已打开的 MIDI 输入端口，拥有独立的 rtmidi.MidiIn、回调和环形缓冲区。
+    所有端口共享录制器的 perf_counter 时钟原点（捕获时钟，打开端口时确定）。
+    """
+    def __init__(self, recorder, port, port_index, capacity):
+        """
+        参数:
+            recorder (MidiRecorder): 所属录制器（提供共享时钟原点和捕获状态）。
+            port (int): 在本次捕获中的端口序号（写入记录的 port 字段）。
+            port_index (int or None): rtmidi 端口索引，None 表示虚拟端口。
+            capacity (int): 环形缓冲区容量。
+        """
+        self.recorder = recorder
+        self.port = port
+        self.port_index = port_index
+        self.midiin = rtmidi.MidiIn()
+        self.ring = EventRingBuffer(capacity, port)
+        self.latency = LatencyHistogram()  # 本端口的监听延迟统计
+        self.filter = recorder.capture_filter.clone() if recorder.capture_filter is not None else None
+        self.name = "虚拟端口"
+        self._clock = None
+
+    def open(self):
+        """打开端口并注册回调。"""
+        if self.filter is not None:
+            # 让 rtmidi 在底层直接忽略被过滤的主动感应消息，减少回调次数。
+            # rtmidi 的 timing 开关会同时忽略时钟 (0xF8) 和 MIDI 时间码 (0xF1)，
+            # 因此时钟不在底层忽略，而是由 CaptureFilter 按状态字节丢弃
+            self.midiin.ignore_types(sysex=True, timing=False,
+                                     active_sense=self.filter.drops('active_sensing'))
+        else:
+            self.midiin.ignore_types(sysex=True, timing=False, active_sense=False)
+        if self.port_index is None:
+            self.midiin.open_virtual_port("My Virtual Input")
+        else:
+            self.name = self.midiin.get_ports(encoding="auto")[self.port_index]
+            self.midiin.open_port(self.port_index)
+        self.midiin.set_callback(self._midi_callback)
+
+    def take_settled(self, now, floor, force=False):
+        """
+        取出过滤器中已稳定的暂存数值（由消费线程调用）。
+        参数:
+            now (float): 当前的捕获时钟时间（秒）。
+            floor (float): 补发事件的最早时间，不早于上一次取出的时刻，保证事件块之间时间有序。
+            force (bool): 是否取出全部暂存数值。
+        返回:
+            numpy.ndarray: EVENT_DTYPE 数组。
+        """
+        settled = self.filter.take_settled(now, force) if self.filter is not None else []
+        events = np.zeros(len(settled), dtype=EVENT_DTYPE)
+        for index, (event_time, message) in enumerate(settled):
+            length = len(message)
+            events[index] = (max(event_time, floor), self.port, message[0], message[1],
+                             message[2] if length > 2 else 0, length)
+        return events
+
+    def close(self):
+        """注销回调并关闭端口。"""
+        self.midiin.cancel_callback()
+        self.midiin.close_port()
+
+    def _midi_callback(self, event, data=None):
+        """
+        MIDI 事件回调函数（运行在 rtmidi 线程中，不加锁、不分配列表）。
+        参数:
+            event (tuple): 包含 MIDI 消息字节和 delta_time 的元组。
+            data (any): 用户数据（未使用）。
+        rtmidi 的 delta_time 是相对于本端口上一个事件的设备时间。首个事件没有参照，
+        以共享时钟定位，其后累积 delta_time 得到单调递增的时间轴。累积时间不允许
+        超前于共享时钟，落后超过 MAX_CLOCK_SKEW 时重新对齐，保证各端口之间的偏差不超过 1 毫秒。
+        启用监听时，事件先立即转发到监听输出，再写入缓冲区，并记录回调到发送完成的延迟。
+        被过滤的事件仍参与时间累积，但不写入缓冲区。
+        """
+        recorder = self.recorder
+        if not recorder.capturing:
+            return
+        message, delta_time = event
+        callback_time = time.perf_counter()
+        thru = recorder.thru_output
+        if thru is not None:
+            try:
+                thru.send_message(message)
+                self.latency.record(time.perf_counter() - callback_time)
+            except Exception:
+                pass  # 监听失败不能影响录制
+        now = callback_time - recorder._clock_origin
+        clock = self._clock
+        if clock is None:
+            clock = now
+        else:
+            clock += delta_time
+            if clock > now or now - clock > MAX_CLOCK_SKEW:
+                clock = now
+        self._clock = clock
+        if self.filter is not None and not self.filter.accept(clock, message):
+            return
+        self.ring.push(clock, message)
+
+
 class MidiRecorder:
     """
     一个用于从 MIDI 输入设备录制 MIDI 事件并导出为 MIDI 文件的类。
+    rtmidi 回调只把事件写入预分配的环形缓冲区，由后台消费线程批量取出。
     """
-    def __init__(self, ticks_per_beat=480):
+    def __init__(self, ticks_per_beat=480, buffer_capacity=1 << 16, drain_interval=0.01,
+                 journal_dir='./output/journal', fsync_interval=1.0):
         """
         初始化 MidiRecorder。
         参数:
             ticks_per_beat (int): MIDI 文件中每拍的刻度数。
+            buffer_capacity (int): 回调环形缓冲区的容量（记录数）。
+            drain_interval (float): 消费线程取出缓冲区的间隔（秒）。
+            journal_dir (str or None): 录制日志目录；为 None 时事件只保存在内存中。
+            fsync_interval (float): 录制日志 fsync 的间隔（秒）。
         """
-        self.midiin = rtmidi.MidiIn()
+        self.midiin = rtmidi.MidiIn()  # 仅用于枚举端口，每个录制端口使用独立的 MidiIn
         self.recording = False
+        self.capturing = False  # 输入端口是否已打开（录制或后台捕获）
         self.start_time = 0  # 录制开始的系统时间
-        self.events = []  # 存储 (相对时间, MIDI 消息字节) 元组
-        self.lock = Lock()  # 用于线程安全的事件列表访问
+        self.buffer_capacity = buffer_capacity
+        self.inputs = []  # 当前打开的端口 (_PortInput)，下标即事件记录中的 port 序号
+        self._port_indices = []  # 当前打开的 rtmidi 端口索引
+        self.drain_interval = drain_interval
+        self._chunks = []  # 未启用日志时，消费线程取出的事件块 (EVENT_DTYPE 数组)
+        self.journal_dir = journal_dir
+        self.fsync_interval = fsync_interval
+        self.journal = None  # 当前录制的磁盘日志
+        self.live_feed = deque(maxlen=4096)  # 供界面实时显示的事件块，由消费线程追加
+        self.lock = Lock()  # 保护 _chunks，回调线程不会获取该锁
+        self._clock_origin = 0.0  # 打开端口时的 perf_counter 值（捕获时钟原点，所有端口共享）
+        self._record_from = None  # 录制窗口在捕获时钟上的起点，None 表示未在录制
+        self._record_until = None  # 录制窗口的终点（停止录制后、最后一次取出前设置）
+        self._start_perf = 0.0  # 录制开始时的 perf_counter 值
+        self._stop_perf = 0.0  # 录制停止时的 perf_counter 值
+        self.retro = None  # 后台持续捕获的历史缓冲区 (RetroactiveBuffer)，None 表示未开启
+        self._stop_event = Event()
+        self._consumer = None
+        self._drained_until = 0.0  # 消费线程上一次取出缓冲区时的捕获时钟时间
         self.ticks_per_beat = ticks_per_beat
-        self.export_bpm = 120  # 导出时使用的 BPM，默认为 120
+        self.export_bpm = 120  # 导出时使用的 BPM（关闭速度跟踪或起音不足时），默认为 120
+        self.tempo_tracking = True  # 录制时是否在线估计速度，导出时写入速度图
+        self.tempo_tracker = TempoTracker(initial_bpm=self.export_bpm)
+        # 录制时实时显示使用的速度图（跟踪器当前的估计，由消费线程定期更新，界面线程只读取）
+        self.live_tempo_map = TempoMap.constant(self.export_bpm)
+        self._live_tempo_state = None  # 上次更新 live_tempo_map 时跟踪器的 (已确认拍点数, 拍长)
+        self._live_tempo_time = 0.0  # 上次更新 live_tempo_map 的录制时间
+        self.capture_filter = CaptureFilter()  # 录制时的事件过滤规则，None 表示保留所有事件
+        self.thru_output = None  # 监听输出，任何具有 send_message(message) 方法的对象
+        self._thru_midiout = None  # 由 set_thru_port 打开的 rtmidi.MidiOut
+        self.thru_name = None
+
+    def set_capture_filter(self, capture_filter):
+        """
+        设置录制时的事件过滤规则（在下一次开始录制时生效）。
+        参数:
+            capture_filter (CaptureFilter or None): 过滤规则，None 表示保留所有事件。
+        """
+        self.capture_filter = capture_filter
+
+    def list_output_ports(self):
+        """
+        列出所有可用的 MIDI 输出端口（用于监听）。
+        返回:
+            list: 输出端口名称的列表。
+        """
+        midiout = rtmidi.MidiOut()
+        try:
+            return midiout.get_ports(encoding="auto")
+        finally:
+            del midiout
+
+    def set_thru_port(self, port_index):
+        """
+        将录制的输入事件实时转发到指定的 MIDI 输出端口。
+        参数:
+            port_index (int): 输出端口索引。
+        返回:
+            bool: 是否成功打开端口。
+        """
+        midiout = rtmidi.MidiOut()
+        try:
+            name = midiout.get_ports(encoding="auto")[port_index]
+            midiout.open_port(port_index)
+        except Exception as e:
+            logging.error(f"无法打开监听输出端口 {port_index}: {e}")
+            return False
+        self.disable_thru()
+        self._thru_midiout = midiout
+        self.thru_output = midiout
+        self.thru_name = name
+        logging.info(f"MIDI 监听已转发到输出端口: {name}")
+        return True
+
+    def set_thru_sink(self, sink, name="内置合成器"):
+        """
+        将录制的输入事件实时转发到进程内的合成器。
+        参数:
+            sink: 具有 send_message(message) 方法的对象，在 rtmidi 回调线程中调用，必须快速返回。
+            name (str): 用于显示和日志的名称。
+        """
+        self.disable_thru()
+        self.thru_output = sink
+        self.thru_name = name
+        logging.info(f"MIDI 监听已转发到: {name}")
+
+    def disable_thru(self):
+        """关闭 MIDI 监听。"""
+        self.thru_output = None
+        self.thru_name = None
+        if self._thru_midiout is not None:
+            self._thru_midiout.close_port()
+            self._thru_midiout = None
+
+    def thru_latency(self):
+        """
+        返回:
+            LatencyHistogram: 本次（或上次）录制中所有端口合并后的监听延迟直方图。
+        """
+        return LatencyHistogram.merged([port_input.latency for port_input in self.inputs])
 
     def list_input_ports(self):
         """
@@ -34,75 +870,344 @@ class MidiRecorder:
         """
         return self.midiin.get_ports(encoding="auto")
 
-    def start_recording(self, port_index=0):
+    def port_names(self):
         """
-        开始从指定的 MIDI 输入端口录制。
-        参数:
-            port_index (int): 要打开的 MIDI 输入端口的索引。
+        返回:
+            list: 本次（或上次）录制中各端口序号对应的端口名称。
         """
-        if self.recording:
-            logging.warning("录制已在进行中。")
-            return
+        return [port_input.name for port_input in self.inputs]
 
+    def _resolve_ports(self, port_index):
+        """
+        将端口参数规范化为 rtmidi 端口索引列表。
+        参数:
+            port_index (int or list): 端口索引或索引列表。
+        返回:
+            list or None: 端口索引列表（无可用端口时为 [None] 表示虚拟端口），参数无效时为 None。
+        """
+        port_indices = list(port_index) if isinstance(port_index, (list, tuple)) else [port_index]
         ports = self.midiin.get_ports()
         if not ports:
             logging.warning("无可用输入端口，尝试开启虚拟端口。")
+            return [None]
+        invalid = [i for i in port_indices if i >= len(ports) or i < 0]
+        if invalid or not port_indices:
+            logging.error(f"无效的端口索引: {invalid}。可用端口数量: {len(ports)}")
+            return None
+        return list(dict.fromkeys(port_indices))  # 去重并保持顺序
+
+    def _open_inputs(self, port_indices):
+        """
+        打开输入端口并启动消费线程，建立新的捕获时钟。
+        参数:
+            port_indices (list): rtmidi 端口索引列表。
+        返回:
+            bool: 是否全部打开成功。
+        """
+        inputs = []
+        for port, index in enumerate(port_indices):
+            port_input = _PortInput(self, port, index, self.buffer_capacity)
             try:
-                self.midiin.open_virtual_port("My Virtual Input")
+                port_input.open()
             except Exception as e:
-                logging.error(f"无法开启虚拟端口: {e}")
-                return
-        elif port_index >= len(ports) or port_index < 0:
-            logging.error(f"无效的端口索引: {port_index}。可用端口数量: {len(ports)}")
+                logging.error(f"无法打开端口 {index if index is not None else '虚拟端口'}: {e}")
+                for opened in inputs:
+                    opened.close()
+                return False
+            inputs.append(port_input)
+        self.inputs = inputs
+        self._port_indices = list(port_indices)
+        self._clock_origin = time.perf_counter()
+        self._drained_until = 0.0
+        self._stop_event.clear()
+        self._consumer = Thread(target=self._consume_loop, name="MidiRecorderConsumer", daemon=True)
+        self._consumer.start()
+        self.capturing = True
+        return True
+
+    def _close_inputs(self):
+        """关闭所有输入端口，停止消费线程（停止前会取出缓冲区中剩余的事件）。"""
+        self.capturing = False
+        for port_input in self.inputs:
+            port_input.close()
+        self._stop_consumer()
+
+    def _stop_consumer(self):
+        """停止并等待消费线程（线程退出前会最后取出一次缓冲区）。"""
+        self._stop_event.set()
+        if self._consumer is not None:
+            self._consumer.join()
+            self._consumer = None
+
+    def start_recording(self, port_index=0):
+        """
+        开始从一个或多个 MIDI 输入端口同时录制。
+        开启后台持续捕获时，如果端口相同则直接沿用已打开的端口，录制从当前时刻开始。
+        参数:
+            port_index (int or list): 要打开的 MIDI 输入端口索引，传入列表时同时打开多个端口。
+        """
+        if self.recording:
+            logging.warning("录制已在进行中。")
             return
-        else:
-            try:
-                self.midiin.open_port(port_index)
-            except Exception as e:
-                logging.error(f"无法打开端口 {port_index}: {e}")
+
+        port_indices = self._resolve_ports(port_index)
+        if port_indices is None:
+            return
+        if self.capturing and port_indices != self._port_indices:
+            # 后台捕获使用的端口与本次录制不同：按录制的端口重新打开
+            self._close_inputs()
+            if self.retro is not None:
+                self.retro.clear()
+        if not self.capturing:
+            if not self._open_inputs(port_indices):
                 return
+            if self.retro is not None:
+                self.retro.port_names = self.port_names()
 
-        self.recording = True
+        self.live_feed.clear()
+        with self.lock:
+            self._chunks = []
+        self.tempo_tracker.initial_bpm = self.export_bpm
+        self.tempo_tracker.reset()
+        self.live_tempo_map = TempoMap.constant(self.export_bpm)
+        self._live_tempo_state = None
+        self._live_tempo_time = 0.0
         self.start_time = time.time()
-        self.events = []
-        # 设置回调函数
-        self.midiin.set_callback(self._midi_callback)
-        logging.info(f"开始录制，端口: {ports[port_index] if ports else '虚拟端口'}")
+        self._discard_journal()
+        if self.journal_dir:
+            try:
+                self.journal = CaptureJournal.create(self.journal_dir, EVENT_DTYPE, self.start_time, self.fsync_interval)
+            except OSError as e:
+                logging.error(f"无法创建录制日志，录制内容仅保存在内存中: {e}")
+                self.journal = None
+        self._start_perf = time.perf_counter()
+        # 最后设置录制窗口起点，消费线程看到它时录制所需的状态都已就绪
+        self._record_until = None
+        self._record_from = self._start_perf - self._clock_origin
+        self.recording = True
+        logging.info(f"开始录制，端口: {', '.join(self.port_names())}")
 
-    def _midi_callback(self, event, data=None):
+    def _consume_loop(self):
+        """消费线程：周期性取出各端口环形缓冲区中的事件，不会阻塞回调。"""
+        while not self._stop_event.wait(self.drain_interval):
+            self._drain_ring()
+        self._drain_ring(final=True)
+
+    def _drain_ring(self, final=False):
         """
-        MIDI 事件回调函数。
+        取出所有端口环形缓冲区中的事件以及精简过滤器中已稳定的暂存数值，并按时间合并。
+        开启后台捕获时写入历史缓冲区；录制中时，落在录制窗口内的事件换算为录制时间后
+        写入录制日志或追加到内存事件块列表。
         参数:
-            event (tuple): 包含 MIDI 消息字节和 delta_time 的元组。
-            data (any): 用户数据（未使用）。
-        注意：rtmidi 的 delta_time 是相对于上一个事件的时间。
-        为了简化，这里仍使用 time.time() 计算相对录制开始的时间。
-        更精确的实现需要累积 delta_time 并转换为 MIDI ticks。
+            final (bool): 是否为消费线程退出前的最后一次取出（补发全部暂存数值）。
         """
-        message, delta_time_rtmidi = event # delta_time_rtmidi 是 rtmidi 提供的相对时间
-        
-        if self.recording:
-            # 计算相对于录制开始的精确时间戳
-            current_relative_time = time.time() - self.start_time 
-            with self.lock:
-                self.events.append((current_relative_time, message))
-            # logging.debug(f"录制事件: {message} @ {current_relative_time:.4f}s")
+        chunks = [port_input.ring.drain() for port_input in self.inputs]
+        # 在取出缓冲区之后读取时钟，已取出的事件都不晚于该时刻
+        now = time.perf_counter() - self._clock_origin
+        floor = self._drained_until
+        chunks += [port_input.take_settled(now, floor, final) for port_input in self.inputs]
+        self._drained_until = now
+        chunks = [chunk for chunk in chunks if len(chunk)]
+        if not chunks:
+            return
+        if len(chunks) == 1:
+            chunk = chunks[0]
+        else:
+            chunk = np.concatenate(chunks)
+            chunk = chunk[np.argsort(chunk['time'], kind='stable')]
+        if self.retro is not None:
+            self.retro.append(chunk)
+        record_from = self._record_from
+        if record_from is None:
+            return
+        record_until = self._record_until
+        if record_until is not None:
+            chunk = chunk[chunk['time'] < record_until]
+        if record_from > 0.0:
+            chunk = chunk[chunk['time'] >= record_from]
+            chunk['time'] -= record_from
+        if not len(chunk):
+            return
+        self.live_feed.append(chunk)
+        if self.tempo_tracking:
+            self._track_tempo(chunk)
+        with self.lock:
+            if self.journal is not None:
+                try:
+                    self.journal.append(chunk)
+                    return
+                except OSError as e:
+                    logging.error(f"写入录制日志失败，后续事件仅保存在内存中: {e}")
+                    self._chunks.append(self.journal.events().copy())
+                    self.journal.close()
+                    self.journal = None
+            self._chunks.append(chunk)
+
+    def start_background_capture(self, port_index=0, minutes=10, capacity=1 << 19):
+        """
+        开启后台持续捕获：保持输入端口打开，把最近 minutes 分钟的输入保存在定长历史缓冲区中，
+        之后可以用 retro_to_document 把任意最近的时间段直接转换为文档。
+        参数:
+            port_index (int or list): 要捕获的 MIDI 输入端口索引（录制中时沿用录制的端口）。
+            minutes (float): 保留的时长（分钟）。
+            capacity (int): 历史缓冲区最多保存的事件数（决定固定的内存占用）。
+        返回:
+            bool: 是否成功开启。
+        """
+        if self.retro is not None:
+            logging.info("后台捕获已开启。")
+            return True
+        retro = RetroactiveBuffer(capacity, minutes * 60.0)
+        if not self.capturing:
+            port_indices = self._resolve_ports(port_index)
+            if port_indices is None or not self._open_inputs(port_indices):
+                return False
+        retro.port_names = self.port_names()
+        self.retro = retro
+        logging.info(f"已开启后台捕获（最近 {minutes} 分钟，最多 {capacity} 个事件），端口: {', '.join(retro.port_names)}")
+        return True
+
+    def stop_background_capture(self):
+        """关闭后台持续捕获并释放历史缓冲区；不在录制时关闭输入端口。"""
+        if self.retro is None:
+            return
+        self.retro = None
+        if not self.recording and self.capturing:
+            self._close_inputs()
+        logging.info("已关闭后台捕获。")
+
+    def retro_to_document(self, seconds=None):
+        """
+        将后台捕获中最近 seconds 秒的输入转换为文档，时间从该段的第一个事件开始。
+        参数:
+            seconds (float, optional): 时间段长度（秒），默认为整个历史缓冲区。
+        返回:
+            miditoolkit.MidiFile or None: 文档，未开启后台捕获或该时间段内没有事件时返回 None。
+        """
+        if self.retro is None:
+            logging.info("未开启后台捕获。")
+            return None
+        now = time.perf_counter() - self._clock_origin
+        start = now - seconds if seconds is not None else -np.inf
+        events = self.retro.window(start, np.inf)
+        events = events[events['status'] < 0xF0]
+        if not len(events):
+            logging.info("后台捕获中没有可用的事件。")
+            return None
+        events['time'] -= events['time'][0]
+        return events_to_document(events, self.ticks_per_beat, self.export_bpm, self.retro.port_names,
+                                  tempo_map=self._estimate_tempo_map(events))
+
+    def _track_tempo(self, chunk):
+        """将一批事件中的 note-on 起音时间输入速度跟踪器（在消费线程中调用）。"""
+        onsets = chunk['time'][((chunk['status'] & 0xF0) == 0x90) & (chunk['data2'] > 0)]
+        for onset in onsets.tolist():
+            self.tempo_tracker.feed(onset)
+        # 节拍估计有变化时更新实时显示的速度图，与导出使用的速度图一致，停止录制时音符不会跳动
+        tracker = self.tempo_tracker
+        state = (len(tracker.beats), tracker.period)
+        now = float(chunk['time'][-1])
+        if state != self._live_tempo_state and now - self._live_tempo_time >= LIVE_TEMPO_INTERVAL:
+            self._live_tempo_state = state
+            self._live_tempo_time = now
+            self.live_tempo_map = tracker.tempo_map()
+
+    def set_tempo_tracking(self, enabled):
+        """
+        开启或关闭录制时的速度跟踪（在下一次开始录制时生效）。
+        参数:
+            enabled (bool): True 时导出使用估计的速度图，False 时使用固定的 export_bpm。
+        """
+        self.tempo_tracking = enabled
+
+    def tempo_map(self):
+        """
+        返回:
+            TempoMap: 本次录制导出时使用的速度图；关闭速度跟踪时为 export_bpm 的固定速度。
+        """
+        if not self.tempo_tracking:
+            return TempoMap.constant(self.export_bpm)
+        return self.tempo_tracker.tempo_map(self.current_time())
+
+    def pop_live_events(self):
+        """
+        取出自上次调用以来新录制的事件（供界面实时显示）。
+        返回:
+            numpy.ndarray: 按时间排序的 EVENT_DTYPE 数组。
+        """
+        chunks = []
+        while self.live_feed:
+            chunks.append(self.live_feed.popleft())
+        if not chunks:
+            return np.empty(0, dtype=EVENT_DTYPE)
+        return chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+
+    def current_time(self):
+        """
+        返回:
+            float: 当前录制时间轴上的时间（秒），录制停止后为录制的总时长。
+        """
+        end = time.perf_counter() if self.recording else self._stop_perf
+        return max(0.0, end - self._start_perf)
+
+    def ticks_per_second(self):
+        """
+        返回:
+            float: 按导出 BPM 换算的每秒 tick 数。
+        """
+        return self.ticks_per_beat * self.export_bpm / 60.0
+
+    def get_events(self):
+        """
+        获取目前已录制的所有事件。启用日志时返回内存映射的数组，不占用额外内存。
+        返回:
+            numpy.ndarray: EVENT_DTYPE 数组，同一端口的事件按时间排序。
+        """
+        with self.lock:
+            if self.journal is not None:
+                return self.journal.events()
+            if not self._chunks:
+                return np.empty(0, dtype=EVENT_DTYPE)
+            if len(self._chunks) > 1:
+                # 合并为单个数组，避免重复拼接
+                self._chunks = [np.concatenate(self._chunks)]
+            return self._chunks[0]
 
     def stop_recording(self):
         """
-        停止录制并关闭 MIDI 端口。
+        停止录制并关闭所有 MIDI 端口。
         """
         if self.recording:
             self.recording = False
-            self.midiin.cancel_callback()
-            self.midiin.close_port()
+            self._stop_perf = time.perf_counter()
+            if self.retro is not None:
+                # 后台捕获继续运行：暂停消费线程取出录制窗口内剩余的事件，再关闭录制窗口
+                self._record_until = self._stop_perf - self._clock_origin
+                self._stop_consumer()
+                self._record_from = None
+                self._stop_event.clear()
+                self._consumer = Thread(target=self._consume_loop, name="MidiRecorderConsumer", daemon=True)
+                self._consumer.start()
+            else:
+                self._close_inputs()
+                self._record_from = None
+            if self.journal is not None:
+                self.journal.close()
+            for port_input in self.inputs:
+                if port_input.filter is not None and port_input.filter.dropped:
+                    logging.info(f"端口 {port_input.name}: 过滤/精简了 {port_input.filter.dropped} 个事件，"
+                                 f"保留 {port_input.filter.kept} 个。")
+                if port_input.ring.overruns:
+                    logging.warning(f"端口 {port_input.name} 的环形缓冲区已满，丢弃了 {port_input.ring.overruns} 个事件。")
+            if self.thru_output is not None:
+                logging.info(f"MIDI 监听延迟 ({self.thru_name}):\n{self.thru_latency().format_text()}")
             logging.info("录制已停止，MIDI 端口已关闭。")
         else:
             logging.info("当前没有进行中的录制。")
 
     def set_export_bpm(self, bpm):
         """
-        设置导出 MIDI 文件时使用的 BPM。
+        设置导出 MIDI 文件时使用的 BPM（开启速度跟踪时，作为起音不足以估计速度时的默认值）。
         参数:
             bpm (int): 每分钟节拍数。
         """
@@ -112,53 +1217,114 @@ class MidiRecorder:
         else:
             logging.warning(f"无效的 BPM 值: {bpm}。BPM 应在 20 到 300 之间。")
 
-    def export_to_midi(self, filename=None):
+    def export_to_midi(self, filename):
         """
-        将录制的 MIDI 事件导出为 MIDI 文件。
+        将录制的 MIDI 事件流式导出为 MIDI 文件。
+        事件按块从录制日志（或内存）中读取并直接写入文件，不会构建完整的 MidiFile 对象。
+        导出成功后删除本次录制的日志。
         参数:
-            filename (str, optional): 导出 MIDI 文件的路径。如果为 None，则不保存文件。
+            filename (str): 导出 MIDI 文件的路径。
         返回:
-            MidiFile or None: 导出的 MidiFile 对象，如果无录制内容则返回 None。
+            str or None: 导出的文件路径，如果无录制内容或保存失败则返回 None。
         """
-        if not self.events:
+        events = self.get_events()
+        if not len(events):
             logging.info("无录制内容可导出！")
             return None
 
-        mid = MidiFile(ticks_per_beat=self.ticks_per_beat)
-        track = MidiTrack()
-        mid.tracks.append(track)
+        try:
+            write_events_to_midi(events, filename, self.ticks_per_beat, self.export_bpm, self.port_names(),
+                                 tempo_map=self.tempo_map())
+            logging.info(f"已导出 MIDI 文件到: {filename}")
+        except Exception as e:
+            logging.error(f"保存 MIDI 文件失败: {e}")
+            return None
+        finally:
+            del events  # 释放内存映射，之后才能删除日志文件
+
+        self._discard_journal()
+        return filename
+
+    def export_to_document(self):
+        """
+        将录制内容直接转换为内存中的 miditoolkit.MidiFile 文档（不写文件、不重新解析）。
+        录制日志保留在磁盘上，文档尚未保存时程序崩溃仍可恢复；调用方用 detach_journal 取得日志，
+        在文档保存或被放弃后删除。
+        返回:
+            miditoolkit.MidiFile or None: 录制文档，如果无录制内容则返回 None。
+        """
+        events = self.get_events()
+        if not len(events):
+            logging.info("无录制内容可导出！")
+            return None
+        midi = events_to_document(events, self.ticks_per_beat, self.export_bpm, self.port_names(),
+                                  tempo_map=self.tempo_map())
+        del events  # 释放内存映射，之后才能删除日志文件
+        return midi
 
-        last_time = 0  # 上一个事件的相对时间 (秒)
-        # 根据设定的 BPM 计算 tempo (微秒/拍)
-        tempo = mido.bpm2tempo(self.export_bpm)
+    def detach_journal(self):
+        """
+        取出当前录制的日志（已导出为内存文档），之后开始新的录制不会删除它。
+        返回:
+            CaptureJournal or None: 录制日志，未启用日志时为 None。
+        """
+        journal, self.journal = self.journal, None
+        return journal
 
-        # 对事件按时间排序，确保顺序正确
-        sorted_events = sorted(self.events, key=lambda x: x[0])
+    def _discard_journal(self):
+        """删除当前录制的日志（录制内容已导出或被新的录制替换）。"""
+        if self.journal is not None:
+            self.journal.discard()
+            self.journal = None
 
-        for event_time, message_bytes in sorted_events:
-            delta_seconds = event_time - last_time
-            
-            # 将秒数转换为 MIDI 刻度，并四舍五入以减少精度损失
-            # 确保 delta_ticks 至少为 0，避免负时间
-            delta_ticks = max(0, int(mido.second2tick(delta_seconds, self.ticks_per_beat, tempo) + 0.5))
-            
+    def recover_journals(self, output_dir='./output'):
+        """
+        恢复上次运行遗留的录制日志（程序崩溃或录制后未导出）。
+        每个日志导出为 output_dir 下的 recovered-*.mid 文件，成功后删除日志。
+        参数:
+            output_dir (str): 恢复文件的输出目录。
+        返回:
+            list: 恢复出的 MIDI 文件路径列表。
+        """
+        recovered = []
+        current = self.journal.path if self.journal is not None else None
+        for path in find_journals(self.journal_dir):
+            if path == current:
+                continue
             try:
-                msg = Message.from_bytes(message_bytes)
-                # mido 消息的 time 参数是 delta ticks
-                track.append(msg.copy(time=delta_ticks))
-                last_time = event_time
+                start_time, events = read_journal(path, EVENT_DTYPE)
+                if len(events):
+                    os.makedirs(output_dir, exist_ok=True)
+                    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(start_time))
+                    filename = os.path.join(output_dir, f"recovered-{stamp}.mid")
+                    write_events_to_midi(events, filename, self.ticks_per_beat, self.export_bpm,
+                                         tempo_map=self._estimate_tempo_map(events))
+                    recovered.append(filename)
+                    logging.info(f"已从录制日志恢复 {len(events)} 个事件到: {filename}")
+                del events
+                os.remove(path)
             except Exception as e:
-                logging.error(f"跳过无效 MIDI 消息: {message_bytes}, 错误: {e}")
+                logging.error(f"恢复录制日志失败: {path}, 错误: {e}")
+        return recovered
 
-        if filename:
-            try:
-                mid.save(filename)
-                logging.info(f"已导出 MIDI 文件到: {filename}")
-            except Exception as e:
-                logging.error(f"保存 MIDI 文件失败: {e}")
-                return None
-        
-        return mid
+    def _estimate_tempo_map(self, events, chunk_size=1 << 16):
+        """
+        对已保存的事件离线运行速度跟踪（用于恢复的录制日志）。
+        参数:
+            events (numpy.ndarray): EVENT_DTYPE 数组（可以是内存映射）。
+        返回:
+            TempoMap: 估计的速度图；关闭速度跟踪时为 export_bpm 的固定速度。
+        """
+        if not self.tempo_tracking or not len(events):
+            return TempoMap.constant(self.export_bpm)
+        tracker = TempoTracker(initial_bpm=self.export_bpm)
+        for offset in range(0, len(events), chunk_size):
+            chunk = np.asarray(events[offset:offset + chunk_size])
+            chunk = chunk[np.argsort(chunk['time'], kind='stable')]
+            onsets = chunk['time'][((chunk['status'] & 0xF0) == 0x90) & (chunk['data2'] > 0)]
+            for onset in onsets.tolist():
+                tracker.feed(onset)
+        return tracker.tempo_map(float(np.max(events['time'])))
 
     def close(self):
         """
@@ -166,6 +1332,8 @@ class MidiRecorder:
         推荐在应用程序关闭时调用此方法。
         """
         self.stop_recording()
+        self.stop_background_capture()
+        self.disable_thru()
         if self.midiin:
             self.midiin.close_port()
             del self.midiin
@@ -217,7 +1385,7 @@ if __name__ == "__main__":
 
         if exported_midi:
             print(f"成功导出 MIDI 文件: {output_midi_file}")
-            print(f"导出 MIDI 文件包含 {len(exported_midi.tracks[0].notes)} 个音符事件。")
+            print(f"导出 MIDI 文件包含 {len(MidiFile(exported_midi).tracks[0])} 个事件。")
         else:
             print("MIDI 文件导出失败或无录制内容。")
         
@@ -0,0 +1,462 @@
+import mmap
+import struct
+from array import array
+from bisect import bisect_right
+from collections import deque
+import numpy as np
+from midiloader import NOTE_DTYPE, META_END_OF_TRACK, META_TEMPO
+from tempotracker import TempoMap
+from thumbnails import BACKGROUND_COLOR, NOTE_COLOR, DRUM_COLOR, shade
+
+'''
+这是超大 MIDI 文件（“黑乐谱”）的流式读取模块。
+打开文件时只做一次索引：内存映射文件，逐音轨扫描一遍事件，每隔固定数量的事件记录一个检查点
+（tick、字节位置、运行状态、各通道音色和尚未结束的音符），同时统计速度变化、音色变化的位置和音符密度概览。
+之后按需从最近的检查点解析一个 tick 区间内的音符（窗口），内存占用与文件大小无关，只与窗口大小有关。
+播放时把文件分块复制为应用了预览音色的临时文件交给 FluidSynth，不在内存中建立文档。
+'''
+
+STREAMING_THRESHOLD = 16 << 20  # 大于此大小（字节）的文件以流式模式打开
+CHECKPOINT_EVENTS = 4096  # 每条音轨每隔多少个事件记录一个检查点
+LOOKAHEAD_EVENTS = 200_000  # 窗口结束后为寻找未结束音符的 note-off 最多继续解析的事件数
+OVERVIEW_MAX_BINS = 4096  # 密度概览的最大列数，超过时相邻两列合并
+DRUM_CHANNEL = 9
+_FLUSH_NOTES = 1 << 16  # 累积多少个音符后批量计入密度概览
+_COPY_CHUNK = 1 << 20
+
+
+class _TrackIndex:
+    """一条音轨的索引：数据位置、检查点和统计信息。"""
+    __slots__ = ('start', 'end', 'checkpoint_ticks', 'checkpoints', 'end_tick', 'channels')
+
+    def __init__(self, start, end):
+        self.start = start  # 音轨数据的起止字节位置（不含块头）
+        self.end = end
+        self.checkpoint_ticks = array('q')
+        self.checkpoints = []  # [(字节位置, 运行状态, 各通道音色, [(通道<<7|音高, 开始 tick, 力度), ...]), ...]
+        self.end_tick = 0
+        self.channels = 0  # 使用过的通道（位掩码）
+
+
+class StreamingMidiIndex:
+    """
+    超大 MIDI 文件的只读索引。
+    - notes_in_range(start, end): 解析一个 tick 区间内的音符（NOTE_DTYPE 数组）。
+    - overview_image(): 整首乐曲的音符密度概览图。
+    - write_render_copy(path, program): 写出应用了预览音色的副本，用于渲染音频。
+    """
+    def __init__(self, path):
+        """
+        参数:
+            path (str): MIDI 文件路径。
+        异常:
+            ValueError: 文件不是有效的标准 MIDI 文件或数据损坏。
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError("不是有效的MIDI文件：文件为空")
+        try:
+            self._build()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        """关闭内存映射和文件。"""
+        if not self._data.closed:
+            self._data.close()
+        self._file.close()
+
+    def _build(self):
+        """扫描全部音轨，建立检查点和统计信息。"""
+        data = self._data
+        if len(data) < 14 or data[:4] != b'MThd':
+            raise ValueError("不是有效的MIDI文件：缺少 MThd 文件头")
+        header_length = struct.unpack('>I', data[4:8])[0]
+        midi_format, num_tracks, division = struct.unpack('>HHH', data[8:14])
+        if division & 0x8000:
+            raise ValueError("不支持 SMPTE 时间格式的MIDI文件")
+        if midi_format > 2:
+            raise ValueError(f"不支持的MIDI格式: {midi_format}")
+        self.ticks_per_beat = division
+        self.header_end = 8 + header_length
+        self.tracks = []
+        self.note_count = 0
+        self.pitch_low, self.pitch_high = 127, 0
+        self.program_offsets = array('q')  # 旋律通道音色变化数据字节的位置
+        self._tempo_events = []
+        # 密度概览: 每列 _bin_ticks 个 tick，_grid[0/1] 为旋律/鼓组按 (127 - 音高, 列) 的覆盖数，_starts 为每列开始的音符数
+        self._bin_ticks = max(division, 1)
+        self._grid = np.zeros((2, 128, 0), dtype=np.int64)
+        self._starts = np.zeros(0, dtype=np.int64)
+        self._pending = (array('q'), array('q'), bytearray(), bytearray())  # 待计入概览的 (开始, 结束, 音高, 是否鼓组)
+
+        pos = self.header_end
+        while pos + 8 <= len(data) and len(self.tracks) < num_tracks:
+            chunk_type = data[pos:pos + 4]
+            chunk_length = struct.unpack('>I', data[pos + 4:pos + 8])[0]
+            start = pos + 8
+            pos = start + chunk_length
+            if chunk_type != b'MTrk':
+                continue  # 跳过未知的块
+            track = _TrackIndex(start, min(pos, len(data)))
+            try:
+                self._index_track(track)
+            except IndexError:
+                raise ValueError(f"音轨 {len(self.tracks)} 数据不完整")
+            self.tracks.append(track)
+        if not self.tracks and num_tracks:
+            raise ValueError("无效的MIDI结构：缺少音轨数据")
+        self._flush_overview()
+        self._pending = None
+        self.end_tick = max((track.end_tick for track in self.tracks), default=0)
+
+        # 与 miditoolkit 一致：默认从 120 BPM 开始，tick 0 处的速度替换默认值，与前一个速度相同的变化被忽略
+        tempos = [(0, 120.0)]
+        for tick, bpm in sorted(self._tempo_events):
+            if tick == 0:
+                tempos = [(0, bpm)]
+            elif bpm != tempos[-1][1]:
+                tempos.append((tick, bpm))
+        self.tempo_changes = tempos
+        self._tempo_events = None
+        self.tempo_map = TempoMap.from_tempo_changes(tempos, division)
+
+    def _index_track(self, track):
+        """扫描一条音轨：配对音符（先进先出，与 midiloader 相同）并定期记录检查点。"""
+        data = self._data
+        pos, end = track.start, track.end
+        tick = 0
+        running = 0
+        programs = bytearray(16)
+        active = {}  # 通道<<7|音高 -> deque[(开始 tick, 力度)]
+        channels = 0
+        events = 0
+        pending_start, pending_end, pending_pitch, pending_drum = self._pending
+        low, high = self.pitch_low, self.pitch_high
+        count = self.note_count
+        while pos < end:
+            if not events % CHECKPOINT_EVENTS:
+                track.checkpoint_ticks.append(tick)
+                track.checkpoints.append((pos, running, bytes(programs),
+                                          [(key, start, velocity) for key, queue in active.items()
+                                           for start, velocity in queue]))
+            events += 1
+            b = data[pos]
+            pos += 1
+            if b & 0x80:
+                value = b & 0x7F
+                while True:
+                    b = data[pos]
+                    pos += 1
+                    value = (value << 7) | (b & 0x7F)
+                    if not b & 0x80:
+                        break
+                tick += value
+            else:
+                tick += b
+
+            status = data[pos]
+            if status & 0x80:
+                pos += 1
+                if status < 0xF0:
+                    running = status
+            elif running:
+                status = running
+            else:
+                raise ValueError(f"缺少状态字节 (位置 {pos})")
+
+            kind = status & 0xF0
+            if kind == 0x90 or kind == 0x80:
+                pitch = data[pos]
+                velocity = data[pos + 1]
+                pos += 2
+                channel = status & 0x0F
+                key = (channel << 7) | pitch
+                if kind == 0x90 and velocity:
+                    queue = active.get(key)
+                    if queue is None:
+                        queue = active[key] = deque()
+                    queue.append((tick, velocity))
+                    channels |= 1 << channel
+                else:
+                    queue = active.get(key)
+                    if queue:
+                        pending_start.append(queue.popleft()[0])
+                        pending_end.append(tick)
+                        pending_pitch.append(pitch)
+                        pending_drum.append(channel == DRUM_CHANNEL)
+                        count += 1
+                        if pitch < low:
+                            low = pitch
+                        if pitch > high:
+                            high = pitch
+                        if len(pending_end) >= _FLUSH_NOTES:
+                            self._flush_overview()
+            elif status < 0xF0:
+                channels |= 1 << (status & 0x0F)
+                if kind == 0xC0:
+                    if status & 0x0F != DRUM_CHANNEL:
+                        self.program_offsets.append(pos)
+                    programs[status & 0x0F] = data[pos]
+                    pos += 1
+                elif kind == 0xD0:
+                    pos += 1
+                else:
+                    pos += 2
+            elif status == 0xFF or status == 0xF0 or status == 0xF7:
+                meta_type = 0
+                if status == 0xFF:
+                    meta_type = data[pos]
+                    pos += 1
+                length = 0
+                while True:
+                    b = data[pos]
+                    pos += 1
+                    length = (length << 7) | (b & 0x7F)
+                    if not b & 0x80:
+                        break
+                if status == 0xFF and meta_type == META_TEMPO and length >= 3:
+                    self._tempo_events.append((tick, 60_000_000 / max(int.from_bytes(data[pos:pos + 3], 'big'), 1)))
+                pos += length
+                if status == 0xFF and meta_type == META_END_OF_TRACK:
+                    break
+            else:
+                raise ValueError(f"未知的状态字节 0x{status:02X} (位置 {pos - 1})")
+        if pos > end:
+            raise IndexError("音轨数据被截断")
+        # 直到音轨结束都没有 note-off 的音符被丢弃（与 midiloader 相同）
+        track.end_tick = tick
+        track.channels = channels
+        self.pitch_low, self.pitch_high = low, high
+        self.note_count = count
+
+    def _flush_overview(self):
+        """把累积的音符计入密度概览（向量化的区间累加），列数超过上限时合并相邻列。"""
+        pending_start, pending_end, pending_pitch, pending_drum = self._pending
+        if not len(pending_end):
+            return
+        starts = np.frombuffer(pending_start, dtype=np.int64).copy()  # 复制后才能清空缓冲
+        ends = np.frombuffer(pending_end, dtype=np.int64).copy()
+        rows = 127 - np.frombuffer(bytes(pending_pitch), dtype=np.uint8).astype(np.int64)
+        layers = np.frombuffer(bytes(pending_drum), dtype=np.uint8).astype(np.int64)
+        while int(ends.max()) // self._bin_ticks >= OVERVIEW_MAX_BINS:
+            self._merge_bins()
+        first = starts // self._bin_ticks
+        last = np.maximum(ends - 1, starts) // self._bin_ticks
+        width = max(self._grid.shape[2], int(last.max()) + 1)
+        if width > self._grid.shape[2]:
+            self._grid = np.pad(self._grid, ((0, 0), (0, 0), (0, width - self._grid.shape[2])))
+            self._starts = np.pad(self._starts, (0, width - len(self._starts)))
+        # 差分数组：区间起点 +1，终点后一格 -1，按列累加得到覆盖数
+        diff = np.zeros((2, 128, width + 1), dtype=np.int64)
+        np.add.at(diff, (layers, rows, first), 1)
+        np.add.at(diff, (layers, rows, last + 1), -1)
+        self._grid += np.cumsum(diff[:, :, :width], axis=2)
+        self._starts += np.bincount(first, minlength=width)
+        for column in self._pending:
+            del column[:]
+
+    def _merge_bins(self):
+        """概览的列宽加倍：相邻两列合并。"""
+        width = self._grid.shape[2]
+        if width % 2:
+            self._grid = np.pad(self._grid, ((0, 0), (0, 0), (0, 1)))
+            self._starts = np.pad(self._starts, (0, 1))
+        self._grid = self._grid[:, :, 0::2] + self._grid[:, :, 1::2]
+        self._starts = self._starts[0::2] + self._starts[1::2]
+        self._bin_ticks *= 2
+
+    def pitch_range(self):
+        """返回 (最低音高, 最高音高)，没有音符时为 None。"""
+        return (self.pitch_low, self.pitch_high) if self.note_count else None
+
+    def duration_seconds(self):
+        """返回乐曲结束位置对应的时间（秒）。"""
+        return float(self.tempo_map.ticks_to_seconds(self.end_tick, self.ticks_per_beat))
+
+    def estimate_notes(self, start, end):
+        """
+        估计在 [start, end) 内开始的音符数（按概览的列统计，不解析文件）。
+        参数:
+            start (int): 起始 tick。
+            end (int): 结束 tick。
+        """
+        first = max(int(start) // self._bin_ticks, 0)
+        last = int(end) // self._bin_ticks + 1
+        return int(self._starts[first:last].sum())
+
+    def overview_image(self):
+        """
+        返回整首乐曲的音符密度概览。
+        返回:
+            tuple: ((128, 列数, 3) 的 uint8 RGB 图像，第 0 行为音高 127；每列对应的 tick 数)。
+        """
+        image = np.empty(self._grid.shape[1:] + (3,), dtype=np.float64)
+        image[:] = BACKGROUND_COLOR
+        for layer, color in ((0, NOTE_COLOR), (1, DRUM_COLOR)):
+            if self._grid[layer].any():
+                shade(image, self._grid[layer], color)
+        return np.rint(image).astype(np.uint8), self._bin_ticks
+
+    def notes_in_range(self, start, end, lookahead=LOOKAHEAD_EVENTS):
+        """
+        解析与 [start, end) 相交的音符。
+        每条音轨从 start 之前最近的检查点开始解析；到达 end 之后继续寻找窗口内未结束音符的 note-off，
+        最多再解析 lookahead 个事件，仍未结束的音符截断在最后解析到的位置。
+        参数:
+            start (int): 起始 tick。
+            end (int): 结束 tick。
+            lookahead (int): 窗口之后最多继续解析的事件数。
+        返回:
+            numpy.ndarray: NOTE_DTYPE 数组，按 (音轨, 开始 tick) 排序。
+        """
+        data = self._data
+        starts, ends, tracks = array('q'), array('q'), array('H')
+        pitches, velocities, channels, programs_out = bytearray(), bytearray(), bytearray(), bytearray()
+
+        def emit(track_number, note_start, note_end, key, velocity, program):
+            starts.append(note_start)
+            ends.append(note_end)
+            pitches.append(key & 0x7F)
+            velocities.append(velocity)
+            tracks.append(track_number)
+            channels.append(key >> 7)
+            programs_out.append(program)
+
+        for track_number, track in enumerate(self.tracks):
+            if track.end_tick <= start or not track.checkpoints:
+                continue
+            checkpoint = bisect_right(track.checkpoint_ticks, start) - 1
+            tick = track.checkpoint_ticks[checkpoint]
+            pos, running, programs, open_notes = track.checkpoints[checkpoint]
+            programs = bytearray(programs)
+            active = {}
+            for key, note_start, velocity in open_notes:
+                active.setdefault(key, deque()).append((note_start, velocity))
+            open_count = len(open_notes)
+            closing = False  # 已越过窗口，只寻找未结束音符的 note-off
+            budget = lookahead
+            track_end = track.end
+            while pos < track_end:
+                b = data[pos]
+                pos += 1
+                if b & 0x80:
+                    value = b & 0x7F
+                    while True:
+                        b = data[pos]
+                        pos += 1
+                        value = (value << 7) | (b & 0x7F)
+                        if not b & 0x80:
+                            break
+                    tick += value
+                else:
+                    tick += b
+                if tick >= end and not closing:
+                    closing = True
+                    if not open_count:
+                        break
+                if closing:
+                    budget -= 1
+                    if budget < 0:
+                        break
+
+                status = data[pos]
+                if status & 0x80:
+                    pos += 1
+                    if status < 0xF0:
+                        running = status
+                else:
+                    status = running
+
+                kind = status & 0xF0
+                if kind == 0x90 or kind == 0x80:
+                    pitch = data[pos]
+                    velocity = data[pos + 1]
+                    pos += 2
+                    key = ((status & 0x0F) << 7) | pitch
+                    if kind == 0x90 and velocity:
+                        if not closing:
+                            queue = active.get(key)
+                            if queue is None:
+                                queue = active[key] = deque()
+                            queue.append((tick, velocity))
+                            open_count += 1
+                    else:
+                        queue = active.get(key)
+                        if queue:
+                            note_start, note_velocity = queue.popleft()
+                            open_count -= 1
+                            if tick > start:
+                                emit(track_number, note_start, tick, key, note_velocity, programs[status & 0x0F])
+                            if closing and not open_count:
+                                break
+                elif status < 0xF0:
+                    if kind == 0xC0:
+                        programs[status & 0x0F] = data[pos]
+                        pos += 1
+                    elif kind == 0xD0:
+                        pos += 1
+                    else:
+                        pos += 2
+                else:
+                    meta_type = 0
+                    if status == 0xFF:
+                        meta_type = data[pos]
+                        pos += 1
+                    length = 0
+                    while True:
+                        b = data[pos]
+                        pos += 1
+                        length = (length << 7) | (b & 0x7F)
+                        if not b & 0x80:
+                            break
+                    pos += length
+                    if status == 0xFF and meta_type == META_END_OF_TRACK:
+                        break
+            if closing and budget < 0:
+                # 超出预读范围仍未结束的音符：至少延续到最后解析的位置
+                for key, queue in active.items():
+                    for note_start, velocity in queue:
+                        emit(track_number, note_start, max(tick, end), key, velocity, programs[key >> 7])
+
+        notes = np.empty(len(starts), dtype=NOTE_DTYPE)
+        if len(starts):
+            notes['start'] = np.frombuffer(starts, dtype=np.int64)
+            notes['end'] = np.frombuffer(ends, dtype=np.int64)
+            notes['pitch'] = np.frombuffer(bytes(pitches), dtype=np.uint8)
+            notes['velocity'] = np.frombuffer(bytes(velocities), dtype=np.uint8)
+            notes['track'] = np.frombuffer(tracks, dtype=np.uint16)
+            notes['channel'] = np.frombuffer(bytes(channels), dtype=np.uint8)
+            notes['program'] = np.frombuffer(bytes(programs_out), dtype=np.uint8)
+        return notes[np.lexsort((notes['start'], notes['track']))]
+
+    def write_render_copy(self, output_path, program):
+        """
+        分块复制文件并把所有旋律通道的音色改为 program（用于渲染预览音频，不修改原文件）：
+        已有的音色变化直接改写数据字节，每条音轨开头为其使用的旋律通道插入一个音色变化。
+        鼓组通道保持不变。
+        参数:
+            output_path (str): 输出路径。
+            program (int): 音色号 (0-127)。
+        """
+        data = self._data
+        offsets = self.program_offsets
+        with open(output_path, 'wb') as out:
+            out.write(data[:self.header_end])
+            for track in self.tracks:
+                prefix = b''.join(bytes((0, 0xC0 | channel, program)) for channel in range(16)
+                                  if track.channels >> channel & 1 and channel != DRUM_CHANNEL)
+                out.write(b'MTrk' + struct.pack('>I', track.end - track.start + len(prefix)) + prefix)
+                patch = bisect_right(offsets, track.start - 1)
+                for chunk_start in range(track.start, track.end, _COPY_CHUNK):
+                    chunk_end = min(chunk_start + _COPY_CHUNK, track.end)
+                    chunk = bytearray(data[chunk_start:chunk_end])
+                    while patch < len(offsets) and offsets[patch] < chunk_end:
+                        chunk[offsets[patch] - chunk_start] = program
+                        patch += 1
+                    out.write(chunk)
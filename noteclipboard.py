@@ -0,0 +1,204 @@
+import io
+import struct
+import numpy as np
+from PyQt5.QtCore import QMimeData
+from midiloader import parse_midi_arrays
+from smfwriter import SmfWriter, encode_channel_events
+
+'''
+这是音符剪贴板模块。
+复制的音符以两种格式放入系统剪贴板 (QMimeData)：
+- 紧凑的二进制格式：固定长度的文件头 + 每个音符 12 字节的打包记录，用于在本程序的多个实例之间复制粘贴；
+- 标准 MIDI 片段 (audio/midi)：可以直接粘贴到宿主软件 (DAW) 中，粘贴时也能读取其他软件复制的 MIDI 片段。
+两种格式都由 NumPy 整体编码和解码，不逐个构建音符对象。
+'''
+
+NOTES_MIME_TYPE = 'application/x-raspmamba-notes'
+MIDI_MIME_TYPE = 'audio/midi'
+
+# 文件头: 标识、格式版本、ticks_per_beat、音轨数、音符数
+_HEADER = struct.Struct('<4sHHHI')
+_MAGIC = b'RMNT'
+_FORMAT_VERSION = 1
+# 音符记录: 相对于第一个音符的开始 tick、时长、音高、力度、相对音轨序号
+CLIP_NOTE_DTYPE = np.dtype([('start', '<u4'), ('duration', '<u4'), ('pitch', 'u1'), ('velocity', 'u1'),
+                            ('track', '<u2')])
+
+DEFAULT_BPM = 120
+DRUM_CHANNEL = 9
+_MELODIC_CHANNELS = [channel for channel in range(16) if channel != DRUM_CHANNEL]
+
+
+class NoteClip:
+    """
+    剪贴板中的一组音符。
+    - notes: CLIP_NOTE_DTYPE 数组，按 (开始 tick, 音轨, 音高) 排序，开始 tick 相对于第一个音符。
+    - drums: 每个相对音轨是否为鼓组。
+    音轨序号是相对的：复制时第一个涉及的乐器为 0，粘贴时从目标乐器开始依次对应。
+    """
+    def __init__(self, notes, ticks_per_beat, drums, bpm=DEFAULT_BPM):
+        """
+        参数:
+            notes (numpy.ndarray): CLIP_NOTE_DTYPE 音符数组。
+            ticks_per_beat (int): 每拍的刻度数。
+            drums (list): 每个相对音轨是否为鼓组。
+            bpm (float): 第一个音符处的速度，只写入 MIDI 片段。
+        """
+        self.notes = notes
+        self.ticks_per_beat = int(ticks_per_beat)
+        self.drums = [bool(drum) for drum in drums]
+        self.bpm = bpm
+
+    @classmethod
+    def from_columns(cls, columns, ticks_per_beat, drums, bpm=DEFAULT_BPM):
+        """
+        由选中音符的数值创建剪贴板内容。
+        参数:
+            columns (numpy.ndarray): (n, 5) 的 (开始, 结束, 音高, 力度, 乐器序号)。
+            ticks_per_beat (int): 每拍的刻度数。
+            drums (list): 文档中每个乐器是否为鼓组。
+            bpm (float): 第一个音符处的速度。
+        返回:
+            NoteClip: 剪贴板内容（只保留涉及的乐器，按乐器顺序重新编号）。
+        """
+        columns = np.asarray(columns, dtype=np.int64).reshape(-1, 5)
+        instruments, tracks = np.unique(columns[:, 4], return_inverse=True)
+        notes = np.empty(len(columns), dtype=CLIP_NOTE_DTYPE)
+        start = columns[:, 0] - (columns[:, 0].min() if len(columns) else 0)
+        notes['start'] = start.clip(0, 0xFFFFFFFF)
+        notes['duration'] = (columns[:, 1] - columns[:, 0]).clip(0, 0xFFFFFFFF)
+        notes['pitch'] = columns[:, 2].clip(0, 127)
+        notes['velocity'] = columns[:, 3].clip(0, 127)
+        notes['track'] = tracks
+        notes = notes[np.lexsort((notes['pitch'], notes['track'], notes['start']))]
+        return cls(notes, ticks_per_beat, [drums[index] for index in instruments], bpm)
+
+    def __len__(self):
+        return len(self.notes)
+
+    def rescaled(self, ticks_per_beat):
+        """
+        返回换算到另一分辨率的剪贴板内容（分辨率相同时返回自身）。
+        参数:
+            ticks_per_beat (int): 目标文档每拍的刻度数。
+        """
+        if ticks_per_beat == self.ticks_per_beat or self.ticks_per_beat <= 0:
+            return self
+        scale = ticks_per_beat / self.ticks_per_beat
+        notes = self.notes.copy()
+        notes['start'] = np.rint(self.notes['start'] * scale)
+        notes['duration'] = np.maximum(np.rint(self.notes['duration'] * scale), 1)
+        return NoteClip(notes, ticks_per_beat, self.drums, self.bpm)
+
+    def to_bytes(self):
+        """
+        返回:
+            bytes: 紧凑的二进制格式（文件头 + 打包的音符记录）。
+        """
+        header = _HEADER.pack(_MAGIC, _FORMAT_VERSION, self.ticks_per_beat, len(self.drums), len(self.notes))
+        flags = np.array(self.drums, dtype=np.uint8)
+        return header + flags.tobytes() + self.notes.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        解析紧凑的二进制格式。
+        参数:
+            data (bytes): to_bytes 的结果。
+        返回:
+            NoteClip: 剪贴板内容。
+        异常:
+            ValueError: 数据不完整或格式不支持。
+        """
+        data = bytes(data)
+        if len(data) < _HEADER.size:
+            raise ValueError("剪贴板数据不完整")
+        magic, version, ticks_per_beat, track_count, count = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != _FORMAT_VERSION:
+            raise ValueError("不支持的剪贴板数据格式")
+        offset = _HEADER.size + track_count
+        if len(data) != offset + count * CLIP_NOTE_DTYPE.itemsize:
+            raise ValueError("剪贴板数据不完整")
+        drums = np.frombuffer(data, dtype=np.uint8, count=track_count, offset=_HEADER.size)
+        notes = np.frombuffer(data, dtype=CLIP_NOTE_DTYPE, count=count, offset=offset).copy()
+        if count and int(notes['track'].max()) >= track_count:
+            raise ValueError("剪贴板数据中的音轨序号无效")
+        return cls(notes, ticks_per_beat, drums.tolist())
+
+    def to_midi(self):
+        """
+        编码为标准 MIDI 片段（格式 1：速度音轨 + 每个相对音轨一条音轨，第一个音符位于 tick 0）。
+        返回:
+            bytes: MIDI 文件内容。
+        """
+        buffer = io.BytesIO()
+        writer = SmfWriter(buffer, ticks_per_beat=self.ticks_per_beat, num_tracks=1 + len(self.drums),
+                           midi_format=1)
+        writer.begin_track()
+        writer.write_tempo(0, int(round(6e7 / self.bpm)))
+        writer.end_track()
+        for track, drum in enumerate(self.drums):
+            channel = DRUM_CHANNEL if drum else _MELODIC_CHANNELS[track % len(_MELODIC_CHANNELS)]
+            notes = self.notes[self.notes['track'] == track]
+            start = notes['start'].astype(np.int64)
+            # 每个音符的开/关交替排列，同一 tick 上先关后开
+            ticks = np.column_stack((start, start + notes['duration'])).ravel()
+            is_on = np.tile([1, 0], len(notes))
+            sort = np.lexsort((is_on, ticks))
+            status = np.where(is_on, 0x90, 0x80) | channel
+            data1 = np.repeat(notes['pitch'], 2)
+            data2 = np.repeat(notes['velocity'], 2)
+            writer.begin_track()
+            writer.write_encoded(encode_channel_events(ticks[sort], status[sort], data1[sort], data2[sort]))
+            writer.end_track()
+        return buffer.getvalue()
+
+    @classmethod
+    def from_midi(cls, data):
+        """
+        解析标准 MIDI 片段（如从宿主软件复制的音符），第一个音符移到 tick 0。
+        参数:
+            data (bytes): MIDI 文件内容。
+        返回:
+            NoteClip: 剪贴板内容（每条含音符的音轨对应一个相对音轨）。
+        异常:
+            ValueError: 数据不是有效的 MIDI 文件。
+        """
+        arrays = parse_midi_arrays(data)
+        notes = arrays.notes
+        tracks, inverse = np.unique(notes['track'], return_inverse=True)
+        columns = np.column_stack((notes['start'], notes['end'], notes['pitch'], notes['velocity'], inverse))
+        drums = [bool(np.any(notes['channel'][inverse == index] == DRUM_CHANNEL)) for index in range(len(tracks))]
+        first = int(notes['start'].min()) if len(notes) else 0
+        # 第一个音符处的速度
+        bpm = [bpm for tick, bpm in arrays.tempo_changes() if tick <= first][-1]
+        return cls.from_columns(columns, arrays.ticks_per_beat, drums, bpm)
+
+    def to_mime_data(self):
+        """
+        返回:
+            QMimeData: 同时包含二进制格式和 MIDI 片段的剪贴板数据。
+        """
+        mime = QMimeData()
+        mime.setData(NOTES_MIME_TYPE, self.to_bytes())
+        mime.setData(MIDI_MIME_TYPE, self.to_midi())
+        return mime
+
+    @classmethod
+    def from_mime_data(cls, mime):
+        """
+        从剪贴板数据中读取音符，优先使用二进制格式，其次是 MIDI 片段。
+        参数:
+            mime (QMimeData): 剪贴板数据。
+        返回:
+            NoteClip or None: 剪贴板内容，没有可用的音符数据时为 None。
+        异常:
+            ValueError: 数据损坏。
+        """
+        if mime is None:
+            return None
+        if mime.hasFormat(NOTES_MIME_TYPE):
+            return cls.from_bytes(mime.data(NOTES_MIME_TYPE))
+        if mime.hasFormat(MIDI_MIME_TYPE):
+            return cls.from_midi(mime.data(MIDI_MIME_TYPE))
+        return None
@@ -0,0 +1,213 @@
+import gc
+import json
+import os
+import shutil
+import struct
+import numpy as np
+from miditoolkit import MidiFile, Instrument, Note, ControlChange, PitchBend, TempoChange
+from miditoolkit.midi.containers import TimeSignature, KeySignature, Lyric, Marker
+from mididocument import MidiDocument, DOCUMENT_NOTE_DTYPE, write_atomically
+
+'''
+这是工程文件模块。
+工程文件保存在 MIDI 文件旁边 (song.mid -> song.mid.rmproj)，记录已解析的文档和编辑器状态，
+再次打开同一个 MIDI 文件时直接映射其中的数组，跳过解析、校验和音频渲染。
+文件布局:
+    8 字节标识 | 头部偏移 (u64) | 头部长度 (u64) | 填充到 64 字节
+    各数组的原始数据（按 64 字节对齐，可直接内存映射）
+    JSON 头部（来源文件的大小和修改时间、音轨信息、元事件、视图状态、音色、预览音频）
+'''
+
+PROJECT_SUFFIX = '.rmproj'
+AUDIO_SUFFIX = '.rmproj.wav'  # 工程引用的预览音频缓存
+PROJECT_MAGIC = b'RMPROJ\x00\x01'
+PROJECT_VERSION = 1
+_PREAMBLE = struct.Struct('<8sQQ')
+_ALIGN = 64
+
+# 工程文件中各数组的结构（音符沿用文档的列式视图）
+CONTROL_DTYPE = [('tick', '<i8'), ('instrument', '<u2'), ('number', 'u1'), ('value', 'u1')]
+BEND_DTYPE = [('tick', '<i8'), ('instrument', '<u2'), ('pitch', '<i2')]
+TEMPO_DTYPE = [('tick', '<i8'), ('bpm', '<f8')]
+
+
+def project_path(midi_path):
+    """返回 MIDI 文件对应的工程文件路径。"""
+    return midi_path + PROJECT_SUFFIX
+
+
+def _file_stamp(path):
+    """文件的大小和修改时间，用于判断工程文件是否仍与之对应。"""
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _per_instrument(arrays, dtype, fields):
+    """将每个乐器的 (tick, ...) 数组合并为带乐器序号的结构化数组。"""
+    merged = np.empty(sum(len(a) for a in arrays), dtype=dtype)
+    position = 0
+    for index, values in enumerate(arrays):
+        end = position + len(values)
+        merged['tick'][position:end] = values[:, 0]
+        merged['instrument'][position:end] = index
+        for column, field in enumerate(fields, start=1):
+            merged[field][position:end] = values[:, column]
+        position = end
+    return merged
+
+
+def save_project(midi_path, snapshot, state=None, audio_path=None):
+    """
+    保存 midi_path 对应的工程文件（在 MIDI 文件写入之后调用）。
+    参数:
+        midi_path (str): 已保存的 MIDI 文件路径。
+        snapshot (DocumentSnapshot): 与该 MIDI 文件内容一致的文档快照。
+        state (dict, optional): 编辑器状态，如 {'view': {...}, 'program': 0}。
+        audio_path (str, optional): 与快照一致的预览音频，复制到工程旁边作为缓存。
+    异常:
+        OSError: 写入失败。
+    """
+    arrays = {
+        'notes': snapshot.notes,
+        'controls': _per_instrument(snapshot.controls, CONTROL_DTYPE, ('number', 'value')),
+        'bends': _per_instrument(snapshot.bends, BEND_DTYPE, ('pitch',)),
+        'tempos': np.array(snapshot.tempos, dtype=TEMPO_DTYPE),
+    }
+    audio = None
+    target = midi_path + AUDIO_SUFFIX
+    if audio_path and os.path.exists(audio_path):
+        if os.path.abspath(audio_path) != os.path.abspath(target):
+            with open(audio_path, 'rb') as source:
+                write_atomically(target, lambda f: shutil.copyfileobj(source, f, 1 << 20))
+        audio = dict(_file_stamp(target), file=os.path.basename(target),
+                     program=(state or {}).get('program'))
+    elif os.path.exists(target):
+        os.remove(target)  # 旧版本的预览音频不再对应工程内容
+
+    layout = {}
+    offset = _ALIGN
+    for name, values in arrays.items():
+        layout[name] = {'offset': offset, 'count': len(values)}
+        offset += -(-values.nbytes // _ALIGN) * _ALIGN
+    header = json.dumps({
+        'version': PROJECT_VERSION,
+        'source': _file_stamp(midi_path),
+        'ticks_per_beat': snapshot.ticks_per_beat,
+        'max_tick': snapshot.max_tick,
+        'instruments': snapshot.instruments,
+        'time_signatures': snapshot.time_signatures,
+        'keys': snapshot.keys,
+        'lyrics': snapshot.lyrics,
+        'markers': snapshot.markers,
+        'arrays': layout,
+        'state': state or {},
+        'audio': audio,
+    }, ensure_ascii=False).encode('utf-8')
+
+    def write(f):
+        f.write(_PREAMBLE.pack(PROJECT_MAGIC, offset, len(header)).ljust(_ALIGN, b'\x00'))
+        for name, values in arrays.items():
+            f.seek(layout[name]['offset'])
+            f.write(np.ascontiguousarray(values).tobytes())
+        f.seek(offset)
+        f.write(header)
+
+    write_atomically(project_path(midi_path), write)
+
+
+def _read_header(path):
+    """读取工程文件的 JSON 头部，格式不符时返回 None。"""
+    with open(path, 'rb') as f:
+        magic, offset, length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != PROJECT_MAGIC:
+            return None
+        f.seek(offset)
+        header = json.loads(f.read(length).decode('utf-8'))
+    return header if header.get('version') == PROJECT_VERSION else None
+
+
+def _map_array(path, spec, dtype):
+    """以只读方式内存映射工程文件中的一个数组。"""
+    if not spec['count']:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=spec['offset'], shape=(spec['count'],))
+
+
+def load_project(midi_path):
+    """
+    打开 midi_path 对应的工程文件。
+    参数:
+        midi_path (str): MIDI 文件路径。
+    返回:
+        tuple or None: (MidiDocument, 状态字典)；状态中 'audio_path' 为仍然有效的预览音频缓存。
+            工程文件不存在、已损坏或 MIDI 文件在保存工程之后被修改过时返回 None。
+    """
+    path = project_path(midi_path)
+    try:
+        if not os.path.exists(path):
+            return None
+        header = _read_header(path)
+        if header is None or header['source'] != _file_stamp(midi_path):
+            return None
+        layout = header['arrays']
+        notes = _map_array(path, layout['notes'], DOCUMENT_NOTE_DTYPE)
+        controls = _map_array(path, layout['controls'], CONTROL_DTYPE)
+        bends = _map_array(path, layout['bends'], BEND_DTYPE)
+        tempos = _map_array(path, layout['tempos'], TEMPO_DTYPE)
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        print(f"读取工程文件失败，改为解析 MIDI 文件: {e}")
+        return None
+
+    midi = MidiFile(ticks_per_beat=header['ticks_per_beat'])
+    midi.max_tick = header['max_tick']
+    midi.instruments = [Instrument(program=program, is_drum=is_drum, name=name)
+                        for name, program, is_drum in header['instruments']]
+    # 批量创建大量对象时暂停循环垃圾回收，否则分代回收会反复扫描新建的音符（耗时约为创建本身的三倍）
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        # 音符按乐器顺序连续存放，按乐器切片后批量创建
+        bounds = np.searchsorted(notes['instrument'], np.arange(len(midi.instruments) + 1))
+        velocity, pitch = notes['velocity'].tolist(), notes['pitch'].tolist()
+        start, end = notes['start'].tolist(), notes['end'].tolist()
+        for index, instrument in enumerate(midi.instruments):
+            a, b = bounds[index], bounds[index + 1]
+            instrument.notes = list(map(Note, velocity[a:b], pitch[a:b], start[a:b], end[a:b]))
+        for tick, index, number, value in controls.tolist():
+            midi.instruments[index].control_changes.append(ControlChange(number, value, tick))
+        for tick, index, bend in bends.tolist():
+            midi.instruments[index].pitch_bends.append(PitchBend(bend, tick))
+    finally:
+        if gc_enabled:
+            gc.enable()
+    midi.tempo_changes = [TempoChange(bpm, tick) for tick, bpm in tempos.tolist()]
+    midi.time_signature_changes = [TimeSignature(numerator, denominator, tick)
+                                   for tick, numerator, denominator in header['time_signatures']]
+    midi.key_signature_changes = [KeySignature(key_name, tick) for tick, key_name in header['keys']]
+    midi.lyrics = [Lyric(text, tick) for tick, text in header['lyrics']]
+    midi.markers = [Marker(text, tick) for tick, text in header['markers']]
+
+    state = dict(header['state'])
+    audio = header.get('audio')
+    if audio:
+        audio_path = os.path.join(os.path.dirname(path), audio['file'])
+        if os.path.exists(audio_path) and _file_stamp(audio_path) == {k: audio[k] for k in ('size', 'mtime_ns')}:
+            state['audio_path'] = audio_path
+            state['audio_program'] = audio['program']
+    return MidiDocument(midi, midi_path, notes=notes), state
+
+
+def open_document(midi_path):
+    """
+    打开 MIDI 文件：工程文件有效时直接映射，否则解析 MIDI 文件。
+    参数:
+        midi_path (str): MIDI 文件路径。
+    返回:
+        tuple: (MidiDocument, 状态字典或 None)。
+    异常:
+        ValueError: MIDI 文件损坏或格式不支持。
+    """
+    project = load_project(midi_path)
+    if project is not None:
+        return project
+    return MidiDocument.load(midi_path), None
@@ -1,21 +1,86 @@
+import bisect
 import miditoolkit
+import numpy as np
 from miditoolkit import MidiFile, Instrument, Note
-from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsRectItem, QGraphicsLineItem, QMenu
-from PyQt5.QtGui import QPainter, QPen, QColor, QBrush, QTransform, QKeySequence
+from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsRectItem, QGraphicsLineItem, QGraphicsPixmapItem, QMenu, QWidget, QApplication
+from PyQt5.QtGui import QPainter, QPen, QColor, QBrush, QTransform, QKeySequence, QImage, QPixmap, QFont
 from PyQt5 import QtCore, QtGui
+from mididocument import MidiDocument
+from midianalysis import repair_overlaps
+from noteclipboard import NoteClip
+from tempotracker import TempoMap
 
 ''' 
 这是一个钢琴卷帘视图类，用于显示和编辑 MIDI 音符。
 经过重构以获得高性能的渲染和流畅的编辑体验。
+超大文件以流式模式显示（只读）：只绘制视口附近一个窗口内的音符，平移时按需从索引中读取，
+视口内音符过多时改为显示整首乐曲的密度概览图。
+视图上方的标尺显示每个小节的调性（或五声调式）与和弦，随编辑增量更新。
 '''
 
+STREAM_WINDOW_NOTES = 20000 # 流式模式下窗口内最多绘制的音符数，超过时显示密度概览
+RULER_HEIGHT = 30 # 调性/和弦标尺的高度（像素）
+MIN_CHORD_LABEL_WIDTH = 24 # 小节窄于此宽度（像素）时不显示和弦名
+
+class HarmonyRuler(QWidget):
+    """
+    钢琴卷帘上方的标尺：上行显示调性（只在变化处标出），下行显示每个小节的和弦。
+    小节位置与视图的水平缩放和滚动同步。
+    """
+    def __init__(self, view):
+        """
+        参数:
+            view (PianoRollView): 所属的钢琴卷帘视图。
+        """
+        super().__init__(view)
+        self.view = view
+        self.setFont(QFont(self.font().family(), 8))
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor(245, 245, 245))
+        painter.setPen(QPen(QColor(190, 190, 190)))
+        painter.drawLine(0, self.height() - 1, self.width(), self.height() - 1)
+        document = self.view.document
+        if document is None or self.view.stream is not None or not document.stats().note_count:
+            return
+        harmony = document.harmony()
+        keys, chords = harmony.labels()
+        bars = harmony.bars
+        left = self.view.mapToScene(0, 0).x()
+        right = self.view.mapToScene(self.width(), 0).x()
+        first = max(int(np.searchsorted(bars, left, side='right')) - 1, 0)
+        last = min(int(np.searchsorted(bars, right, side='right')), len(bars) - 1)
+        row = self.height() // 2
+        metrics = painter.fontMetrics()
+        key_label_end = -1 # 上一个调名的右端，避免缩小时调名互相重叠
+        for index in range(first, last):
+            x0 = self.view.mapFromScene(QtCore.QPointF(bars[index], 0)).x()
+            x1 = self.view.mapFromScene(QtCore.QPointF(bars[index + 1], 0)).x()
+            painter.setPen(QPen(QColor(170, 170, 170)))
+            painter.drawLine(x0, row, x0, self.height())
+            key = keys[index]
+            if key is not None and (index == first or key != keys[index - 1]) and x0 > key_label_end:
+                painter.setPen(QPen(QColor(150, 60, 40)))
+                painter.drawText(max(x0, 0) + 3, row - 3, key)
+                key_label_end = max(x0, 0) + 3 + metrics.horizontalAdvance(key)
+            if chords[index] is not None and x1 - x0 >= MIN_CHORD_LABEL_WIDTH:
+                painter.setPen(QPen(QColor(40, 40, 40)))
+                painter.drawText(QtCore.QRect(x0 + 2, row, x1 - x0 - 4, self.height() - row),
+                                 QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter, chords[index])
+
+
 class PianoRollView(QGraphicsView):
+    document_changed = QtCore.pyqtSignal() # 编辑操作修改了文档内容
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.scene = QGraphicsScene()
         self.setScene(self.scene)
         self.setRenderHint(QPainter.Antialiasing) # 启用抗锯齿，使图形更平滑
         self.setDragMode(QGraphicsView.ScrollHandDrag) # 初始设置为拖拽移动视图模式
+        # 按变化区域的外接矩形重绘：一次编辑改变成千上万个音符时，默认的最小区域模式合并重绘区域是平方复杂度
+        self.setViewportUpdateMode(QGraphicsView.BoundingRectViewportUpdate)
         self.setStyleSheet("border-radius:10px; background-color: rgb(232, 232, 232)")
 
         # 时间指示器（播放头）
@@ -27,6 +92,18 @@ class PianoRollView(QGraphicsView):
         self.scene.addItem(self.time_indicator)
 
         self.note_items = []  # 存储所有音符的 QGraphicsRectItem 实例
+        self.drawn_version = None  # 音符图形项对应的 (文档, 版本号)，用于按修改日志增量更新
+        # 已删除音符的图形项隐藏后留作备用，新音符优先复用（从带索引的场景中逐个移除图形项非常慢）
+        self.spare_items = []
+
+        # --- 录制实时显示相关属性 ---
+        self.live_note_items = [] # 录制过程中添加的音符图形项（不可编辑），按开始时间排序
+        self.live_starts = [] # 与 live_note_items 对应的开始时间（秒）
+        self.live_open_items = {} # 尚未结束的音符: {(port, channel, pitch): QGraphicsRectItem}
+        self.live_tempo_map = TempoMap.constant(120) # 录制时间（秒）到场景 X 坐标（tick）的速度图
+        self.live_ticks_per_beat = 480
+        self.live_visible_seconds = 8.0 # 录制时水平方向可见的时长（秒）
+        self.live_recording = False # 是否正在实时显示录制（此时场景中没有文档的音符，文档不可编辑）
 
         # --- 钢琴卷帘参数 ---
         # 【重构核心】: 移除了手动的 time_scale。现在场景坐标系是固定的：
@@ -37,11 +114,18 @@ class PianoRollView(QGraphicsView):
         self.zoom_factor = 1.2 # 每次滚轮事件的缩放系数
 
         # --- 编辑相关属性 ---
-        self.current_midi = None # 当前加载的 MIDI 文件对象
+        self.document = None # 当前文档 (MidiDocument)，与主窗口共享
+        self.current_midi = None # 当前加载的 MIDI 文件对象 (即 document.midi)
         self.editing_mode = 'select'  # 当前模式: 'select' (选择/移动), 'add_note' (添加音符), 'resize_note_end' (调整音符长度)
         self.selected_notes_items = [] # 存储当前选中的 QGraphicsRectItem
         self.selected_miditoolkit_notes = [] # 存储当前选中的 miditoolkit.Note 对象
-        self.clipboard_notes = [] # 用于复制/粘贴的剪贴板
+        self.target_instrument_index = 0 # 粘贴和添加音符的目标乐器（点击音符或在右键菜单中选择）
+        self.playhead_tick = 0 # 播放头所在的 tick，粘贴的音符从这里开始
+
+        # --- 流式模式相关属性 ---
+        self.stream = None # 流式模式下的 StreamingMidiIndex（只读），否则为 None
+        self.stream_window = None # 当前已绘制的窗口 (起始 tick, 结束 tick)
+        self.stream_overview_item = None # 密度概览图的图形项
 
         #用于高效拖动/调整大小的属性
         self.drag_start_pos = None      # 鼠标按下时的场景坐标
@@ -50,24 +134,107 @@ class PianoRollView(QGraphicsView):
         self.drag_notes_original_state = {} # 格式: {note_item: {'start': tick, 'pitch': pitch, 'end': tick}}
 
         self.scene.selectionChanged.connect(self._on_selection_changed) # 连接场景选择变化信号
+        # 流式模式下平移或缩放后按需载入视口附近的音符
+        self.horizontalScrollBar().valueChanged.connect(self._update_stream_window)
+        self.horizontalScrollBar().rangeChanged.connect(self._update_stream_window)
         self.setMouseTracking(True) # 启用鼠标跟踪以实时更新光标样式
 
+        # 调性/和弦标尺，放在为它预留的视口上边距中
+        self.harmony_ruler = HarmonyRuler(self)
+        self.ruler_state = None # 标尺上次绘制时的 (水平缩放, 水平滚动位置, 文档版本)，变化时才重绘
+        self.setViewportMargins(0, RULER_HEIGHT, 0, 0)
+
     def set_midi_data(self, midi_file):
         """
         设置要显示和编辑的MIDI数据。
         参数:
-            midi_file (miditoolkit.MidiFile): 要加载的 MIDI 文件对象。
+            midi_file (MidiDocument or miditoolkit.MidiFile): 要加载的文档；
+                传入 MidiFile 时包装为新的文档。
         """
-        self.current_midi = midi_file
+        if midi_file is not None and not isinstance(midi_file, MidiDocument):
+            midi_file = MidiDocument(midi_file)
+        self.stream = None
+        self.document = midi_file
+        self.current_midi = midi_file.midi if midi_file is not None else None
+        self.target_instrument_index = 0
+        self.playhead_tick = 0
         self.draw_midi(self.current_midi)
         self.fit_to_view() # 【新增】: 加载后自动缩放以适应视图
 
+    def set_stream(self, index):
+        """
+        以流式模式（只读）显示超大文件：场景范围取自索引，音符在平移时按窗口载入。
+        参数:
+            index (StreamingMidiIndex): 文件索引。
+        """
+        self.clear_scene()
+        self.document = None
+        self.current_midi = None
+        self.stream = index
+
+        # 密度概览：每个像素对应概览的一列和一个音高，缩放到场景坐标
+        image, bin_ticks = index.overview_image()
+        height, width = image.shape[:2]
+        data = image.tobytes() # QImage 不复制缓冲区，转换为 QPixmap 之前须保持引用
+        qimage = QImage(data, width, height, width * 3, QImage.Format_RGB888)
+        self.stream_overview_item = QGraphicsPixmapItem(QPixmap.fromImage(qimage))
+        self.stream_overview_item.setTransform(QTransform.fromScale(bin_ticks, self.base_key_height))
+        self.stream_overview_item.setZValue(-5)
+        self.scene.addItem(self.stream_overview_item)
+
+        pitch_range = index.pitch_range() or (48, 84)
+        scene_y_top = (127 - min(127, pitch_range[1] + 12)) * self.base_key_height
+        scene_y_bottom = (127 - max(0, pitch_range[0] - 12)) * self.base_key_height
+        self.scene.setSceneRect(0, scene_y_top, index.end_tick + index.ticks_per_beat * 4, scene_y_bottom - scene_y_top)
+        self.fit_to_view()
+        self._update_stream_window()
+
+    def _update_stream_window(self, *args):
+        """
+        流式模式下确保视口附近的音符已绘制：视口超出已载入的窗口时，
+        载入以视口为中心、左右各多出一个视口宽度的新窗口并替换旧的音符图形项。
+        """
+        if self.stream is None:
+            return
+        visible = self.mapToScene(self.viewport().rect()).boundingRect()
+        left, right = max(0, int(visible.left())), int(visible.right()) + 1
+        if self.stream.estimate_notes(left, right) > STREAM_WINDOW_NOTES:
+            # 视口内音符过多：只显示密度概览
+            self._clear_stream_window()
+            self.stream_overview_item.setVisible(True)
+            return
+        if self.stream_window and self.stream_window[0] <= left and right <= self.stream_window[1]:
+            return
+        span = right - left
+        start, end = max(0, left - span), right + span
+        notes = self.stream.notes_in_range(start, end)
+        self._clear_stream_window()
+        self.stream_overview_item.setVisible(False)
+        pen = QPen(QColor(50, 50, 50), 0.5)
+        brushes = {False: QBrush(QColor(30, 100, 200, 180)), True: QBrush(QColor(200, 50, 50, 180))}
+        for note_start, note_end, pitch, channel in zip(notes['start'].tolist(), notes['end'].tolist(),
+                                                        notes['pitch'].tolist(), notes['channel'].tolist()):
+            rect = QGraphicsRectItem(note_start, (127 - pitch) * self.base_key_height,
+                                     note_end - note_start, self.base_key_height)
+            rect.setBrush(brushes[channel == 9]) # 鼓组通道使用不同颜色
+            rect.setPen(pen)
+            self.scene.addItem(rect)
+            self.note_items.append(rect)
+        self.stream_window = (start, end)
+
+    def _clear_stream_window(self):
+        """移除流式模式下当前窗口的音符图形项。"""
+        for item in self.note_items:
+            self.scene.removeItem(item)
+        self.note_items.clear()
+        self.stream_window = None
+
     def fit_to_view(self):
         """
         调整视图缩放，使整个乐曲在水平方向上完整可见，并设置一个合理的垂直缩放。
         这有助于解决音乐长度过长导致音符过细的问题。
         """
-        if not self.note_items:
+        if not self.note_items and self.stream is None:
             # 如果没有音符，设置一个默认的场景矩形，并调整时间指示器
             # 默认显示 C2 (36) 到 C7 (96) 的范围
             default_min_pitch = 36
@@ -78,8 +245,8 @@ class PianoRollView(QGraphicsView):
             self.time_indicator.setLine(0, 0, 0, self.sceneRect().height())
             return
 
-        # 获取场景中所有图形项的边界矩形
-        items_rect = self.scene.itemsBoundingRect()
+        # 获取场景中所有图形项的边界矩形（流式模式下音符尚未全部载入，使用场景范围）
+        items_rect = QtCore.QRectF(self.sceneRect()) if self.stream is not None else self.scene.itemsBoundingRect()
         # 添加一些边距，以便看得更清楚
         items_rect.adjust(-50, -self.base_key_height * 2, 50, self.base_key_height * 2)
 
@@ -127,9 +294,9 @@ class PianoRollView(QGraphicsView):
 
 
     def clear_scene(self):
-        """清除场景中的所有音乐元素（音符、背景等）。"""
-        # 从场景中移除所有音符图形项
-        for item in self.note_items:
+        """清除场景中的所有音乐元素（音符、背景等），并退出流式模式。"""
+        # 从场景中移除所有音符图形项（包括备用的）
+        for item in self.note_items + self.spare_items:
             self.scene.removeItem(item)
         
         # 清除背景元素（线条和琴键阴影）
@@ -138,10 +305,40 @@ class PianoRollView(QGraphicsView):
                  if item != self.time_indicator: # 不要移除时间指示器
                     self.scene.removeItem(item)
 
+        for item in self.live_note_items:
+            if item.scene() is self.scene:
+                self.scene.removeItem(item)
+
+        if self.stream_overview_item is not None:
+            self.scene.removeItem(self.stream_overview_item)
+            self.stream_overview_item = None
+        self.stream = None
+        self.stream_window = None
+
         self.note_items.clear()
+        self.spare_items.clear()
+        self.drawn_version = None
+        self.live_note_items.clear()
+        self.live_starts.clear()
+        self.live_open_items.clear()
         self.selected_notes_items.clear()
         self.selected_miditoolkit_notes.clear()
 
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        viewport = self.viewport().geometry()
+        self.harmony_ruler.setGeometry(viewport.x(), viewport.y() - RULER_HEIGHT, viewport.width(), RULER_HEIGHT)
+
+    def drawForeground(self, painter, rect):
+        """视口重绘时检查缩放、滚动和文档版本，有变化才重绘标尺（播放头移动不会触发）。"""
+        super().drawForeground(painter, rect)
+        document = self.document
+        state = (self.transform().m11(), self.horizontalScrollBar().value(),
+                 id(document), document.version if document is not None else None, self.stream is None)
+        if state != self.ruler_state:
+            self.ruler_state = state
+            self.harmony_ruler.update()
+
     def wheelEvent(self, event):
         """
         处理鼠标滚轮事件以进行缩放。
@@ -180,11 +377,13 @@ class PianoRollView(QGraphicsView):
         参数:
             position (int): 0-1000 范围内的播放进度值。
         """
-        if self.current_midi and self.current_midi.ticks_per_beat > 0:
-            total_ticks = self.current_midi.max_tick # 获取 MIDI 文件的总 tick 数
+        if self.stream is not None or (self.current_midi and self.current_midi.ticks_per_beat > 0):
+            # 文档的总 tick 数（编辑后随版本更新）；流式模式下取自索引
+            total_ticks = self.stream.end_tick if self.stream is not None else self.document.end_tick()
             
             if total_ticks > 0:
                 current_tick = (position / 1000.0) * total_ticks # 将进度转换为场景中的 tick 坐标
+                self.playhead_tick = int(current_tick)
                 
                 # 获取当前视图的水平缩放比例
                 current_scale_x = self.transform().m11()
@@ -207,6 +406,7 @@ class PianoRollView(QGraphicsView):
                 self.viewport().update() # 更新视图
         else:
             # 如果没有 MIDI 数据，将指示器隐藏或重置
+            self.playhead_tick = 0
             self.time_indicator.setLine(0, 0, 0, 0)
             self.time_indicator.setPen(QPen(QtCore.Qt.red, self.base_indicator_width)) # 恢复默认宽度
             self.viewport().update()
@@ -223,49 +423,132 @@ class PianoRollView(QGraphicsView):
         if not midi:
             return
 
+        if self.document is None or self.document.midi is not midi:
+            self.document = MidiDocument(midi)
         self.current_midi = midi
-        max_tick = 0 # 记录最大 tick 值，用于设置场景宽度
-        min_pitch = 127 # 记录最低音高
-        max_pitch = 0 # 记录最高音高
 
         for instrument in midi.instruments:
-            # 鼓组使用不同颜色，其他乐器使用另一种颜色
-            color = QColor(200, 50, 50, 180) if instrument.is_drum else QColor(30, 100, 200, 180)
-            
             for note in instrument.notes:
-                # 【重构核心】: 场景坐标直接从MIDI数据映射，不再乘以 time_scale。
-                # X 坐标直接对应 MIDI tick
-                x = note.start
-                # Y 坐标通过音高和基准琴键高度计算 (127 - pitch 是因为 Y 轴向下，音高越高 Y 值越小)
-                y = (127 - note.pitch) * self.base_key_height
-                # 宽度直接对应音符持续的 tick 数量
-                w = note.end - note.start
-                # 高度为基准琴键高度
-                h = self.base_key_height
-
-                rect = QGraphicsRectItem(x, y, w, h) # 创建音符的矩形图形项
-                rect.setBrush(QBrush(color)) # 设置填充颜色
-                rect.setPen(QPen(QColor(50,50,50), 0.5)) # 设置边框
-
-                rect.setFlag(QGraphicsRectItem.ItemIsSelectable) # 使音符可被选中
-                
-                # 在图形项中存储对原始 miditoolkit 对象的引用
-                rect.midi_note = note
-                rect.midi_instrument = instrument
-                
-                self.scene.addItem(rect) # 将音符添加到场景
-                self.note_items.append(rect) # 存储音符图形项
-                max_tick = max(max_tick, note.end) # 更新最大 tick
-                min_pitch = min(min_pitch, note.pitch) # 更新最低音高
-                max_pitch = max(max_pitch, note.pitch) # 更新最高音高
+                self.note_items.append(self._create_note_item(note, instrument)) # 存储音符图形项
+        self.drawn_version = (self.document, self.document.version)
+        self._update_scene_rect()
+
+    def _note_rect(self, note):
+        """
+        返回音符在场景中的 (x, y, 宽, 高)。
+        场景坐标直接从MIDI数据映射：X 坐标和宽度对应 MIDI tick，
+        Y 坐标由音高和基准琴键高度计算 (127 - pitch 是因为 Y 轴向下，音高越高 Y 值越小)。
+        """
+        return note.start, (127 - note.pitch) * self.base_key_height, note.end - note.start, self.base_key_height
+
+    def _create_note_item(self, note, instrument):
+        """创建音符的矩形图形项并加入场景（有备用的图形项时直接复用）。"""
+        # 鼓组使用不同颜色，其他乐器使用另一种颜色
+        color = QColor(200, 50, 50, 180) if instrument.is_drum else QColor(30, 100, 200, 180)
+        geometry = self._note_rect(note)
+        if self.spare_items:
+            rect = self.spare_items.pop()
+            rect.setPos(0, 0)
+            rect.setRect(*geometry)
+            rect.setBrush(QBrush(color))
+            rect.setVisible(True)
+            rect.note_rect = geometry
+            rect.midi_note = note
+            rect.midi_instrument = instrument
+            return rect
+        rect = QGraphicsRectItem(*geometry) # 创建音符的矩形图形项
+        rect.note_rect = geometry # 上次同步时的几何数据（读取 Python 属性比调用 rect() 快得多）
+        rect.setBrush(QBrush(color)) # 设置填充颜色
+        rect.setPen(QPen(QColor(50,50,50), 0.5)) # 设置边框
+
+        rect.setFlag(QGraphicsRectItem.ItemIsSelectable) # 使音符可被选中
+
+        # 在图形项中存储对原始 miditoolkit 对象的引用
+        rect.midi_note = note
+        rect.midi_instrument = instrument
+
+        self.scene.addItem(rect) # 将音符添加到场景
+        return rect
+
+    def refresh_notes(self):
+        """
+        文档被修改后，按修改日志更新音符图形项：只处理修改过的音轨中与修改的 tick 范围相交的音符，
+        其余图形项保持不变，仍然存在的音符保持选中状态。整个文档被修改或换了文档时完整重绘。
+        """
+        document = self.document
+        if document is None or self.drawn_version is None or self.drawn_version[0] is not document:
+            self.draw_midi(self.current_midi)
+            return
+        change = document.changes_since(self.drawn_version[1])
+        if change is None:
+            return
+        if change.tracks is None:
+            self.draw_midi(self.current_midi)
+            return
+        self.drawn_version = (document, document.version)
+        instruments = [document.midi.instruments[index] for index in sorted(change.tracks)]
+        changed_ids = {id(instrument) for instrument in instruments}
+        # note_rect 仍是修改前的位置，与修改范围相交的图形项可能已过期
+        stale = {}
+        kept = []
+        start, end = change.start, change.end
+        for item in self.note_items:
+            x, _, width, _ = item.note_rect
+            if x <= end and x + width >= start and id(item.midi_instrument) in changed_ids:
+                stale[id(item.midi_note)] = item
+            else:
+                kept.append(item)
+        for instrument in instruments:
+            for note in instrument.notes:
+                if note.start > end or note.end < start:
+                    continue
+                item = stale.pop(id(note), None)
+                if item is None:
+                    item = self._create_note_item(note, instrument)
+                else:
+                    geometry = self._note_rect(note)
+                    if geometry != item.note_rect:
+                        item.setPos(0, 0) # 清除拖动时的偏移
+                        item.setRect(*geometry)
+                        item.note_rect = geometry
+                kept.append(item)
+        self._retire_items(stale.values()) # 已被删除的音符
+        self.note_items = kept
+        self._update_scene_rect()
+
+    def _retire_items(self, items):
+        """
+        隐藏已删除音符的图形项并放入备用列表，供之后新建的音符复用。
+        隐藏时会取消选中，暂时屏蔽场景信号，避免每个图形项都触发一次选择变化（否则为平方复杂度）。
+        """
+        items = list(items)
+        if not items:
+            return
+        self.scene.blockSignals(True)
+        try:
+            for item in items:
+                item.setVisible(False)
+                del item.midi_note # 不再参与点击检测和选择
+        finally:
+            self.scene.blockSignals(False)
+        self._on_selection_changed()
+        self.spare_items.extend(items)
+
+    def _update_scene_rect(self):
+        """按文档的结束位置和音高范围设置场景范围。"""
+        midi = self.current_midi
+        # 结束位置和音高范围由文档增量维护
+        max_tick = self.document.end_tick()
+        pitch_range = self.document.pitch_range()
 
         # 处理没有音符或音高范围过窄的情况，设置一个默认的显示范围
-        if not self.note_items:
+        if pitch_range is None:
             # 默认显示 C2 (36) 到 C7 (96) 的范围
             effective_min_pitch = 36
             effective_max_pitch = 96
         else:
             # 在实际音高范围的基础上增加一些填充，例如上下各一个八度
+            min_pitch, max_pitch = pitch_range
             effective_min_pitch = max(0, min_pitch - 12) 
             effective_max_pitch = min(127, max_pitch + 12)
 
@@ -285,6 +568,129 @@ class PianoRollView(QGraphicsView):
                                     self.time_indicator.line().x1(), self.scene.sceneRect().bottom())
 
 
+    def begin_live_recording(self, ticks_per_beat, tempo_map):
+        """
+        准备在录制过程中实时显示音符。清空当前场景并设置便于跟随演奏的缩放。
+        参数:
+            ticks_per_beat (int): 录制文档每拍的刻度数。
+            tempo_map (TempoMap): 录制时间（秒）到拍的速度图（录制开始时通常为固定速度）。
+        """
+        self.clear_scene()
+        self.live_recording = True
+        self.live_ticks_per_beat = ticks_per_beat
+        self.live_tempo_map = tempo_map
+        self.fit_to_view() # 没有音符时会设置默认的音高范围
+
+        ticks_per_second = ticks_per_beat * tempo_map.bpms[0] / 60.0
+        view_width = self.viewport().width()
+        visible_ticks = self.live_visible_seconds * ticks_per_second
+        horizontal_scale = view_width / visible_ticks if view_width > 0 else 1.0
+        vertical_scale = 5.0 / self.base_key_height # 与 fit_to_view 的最小琴键高度一致
+        if self.viewport().height() > 0 and self.sceneRect().height() > 0:
+            vertical_scale = max(vertical_scale, self.viewport().height() / self.sceneRect().height())
+        transform = QTransform()
+        transform.scale(horizontal_scale, vertical_scale)
+        self.setTransform(transform)
+        self.centerOn(visible_ticks / 2, self.sceneRect().center().y())
+
+    def _live_ticks(self, seconds):
+        """按当前速度图将录制时间（秒，数组）换算为场景 X 坐标（tick）。"""
+        return self.live_tempo_map.seconds_to_ticks(seconds, self.live_ticks_per_beat)
+
+    def _set_live_tempo_map(self, tempo_map):
+        """
+        速度估计更新后换用新的速度图，并移动受影响的实时音符：
+        两个速度图前面相同的段换算结果不变，只移动从第一个不同的段开始之后的音符。
+        参数:
+            tempo_map (TempoMap): 新的速度图。
+        """
+        old = self.live_tempo_map
+        self.live_tempo_map = tempo_map
+        count = min(len(old), len(tempo_map))
+        same = ((old.times[:count] == tempo_map.times[:count]) & (old.beats[:count] == tempo_map.beats[:count])
+                & (old.bpms[:count] == tempo_map.bpms[:count]))
+        first_changed = count if same.all() else int(np.argmin(same))
+        if first_changed == len(old) == len(tempo_map):
+            return
+        changed_time = min(segments.times[first_changed] for segments in (old, tempo_map)
+                           if first_changed < len(segments))
+        first = bisect.bisect_left(self.live_starts, changed_time)
+        items = self.live_note_items[first:]
+        if not items:
+            return
+        starts = self._live_ticks(np.array(self.live_starts[first:])).tolist()
+        ends = self._live_ticks(np.array([item.live_end if item.live_end is not None else item.live_start
+                                          for item in items])).tolist()
+        for item, start, end in zip(items, starts, ends):
+            rect = item.rect()
+            item.setRect(start, rect.y(), max(1.0, end - start), rect.height())
+
+    def add_live_notes(self, started, finished, now_seconds, tempo_map=None):
+        """
+        将录制中新配对的音符增量添加到场景，并让未结束的音符随时间增长。
+        不会调用 draw_midi 重建场景，每帧的开销只与新事件数和按住的音符数有关。
+        音符按录制器当前的速度估计换算到 tick，与录制结束后导出的文档位置一致。
+        参数:
+            started (list): 新开始的音符 [(port, channel, pitch, start, velocity)]，时间单位为秒。
+            finished (list): 已结束的音符 [(port, channel, pitch, start, end, velocity)]。
+            now_seconds (float): 当前录制时间（秒）。
+            tempo_map (TempoMap, optional): 录制器当前的速度图，变化时移动受影响的音符。
+        """
+        if tempo_map is not None and tempo_map is not self.live_tempo_map:
+            self._set_live_tempo_map(tempo_map)
+        now_tick = float(self._live_ticks(now_seconds))
+        color = QColor(30, 100, 200, 180)
+        pen = QPen(QColor(50, 50, 50), 0.5)
+
+        def create_item(pitch, start):
+            rect = QGraphicsRectItem(float(self._live_ticks(start)), (127 - pitch) * self.base_key_height,
+                                     0, self.base_key_height)
+            rect.setBrush(QBrush(color))
+            rect.setPen(pen)
+            rect.live_start = start
+            rect.live_end = None
+            self.scene.addItem(rect)
+            # 按开始时间插入（通常在末尾），速度图变化时只需移动后面的音符
+            index = bisect.bisect_right(self.live_starts, start)
+            self.live_starts.insert(index, start)
+            self.live_note_items.insert(index, rect)
+            return rect
+
+        # 结束的音符：若之前已作为按住的音符显示，则定格其长度，否则直接创建
+        for port, channel, pitch, start, end, velocity in finished:
+            item = self.live_open_items.pop((port, channel, pitch), None)
+            if item is None:
+                item = create_item(pitch, start)
+            item.live_end = end
+            rect = item.rect()
+            rect.setWidth(max(1.0, float(self._live_ticks(end)) - rect.x()))
+            item.setRect(rect)
+
+        for port, channel, pitch, start, velocity in started:
+            self.live_open_items[(port, channel, pitch)] = create_item(pitch, start)
+
+        # 按住的音符随当前时间增长
+        for item in self.live_open_items.values():
+            rect = item.rect()
+            rect.setWidth(max(1.0, now_tick - rect.x()))
+            item.setRect(rect)
+
+        # 扩展场景宽度并让播放头跟随录制位置
+        tps = self.live_ticks_per_beat * self.live_tempo_map.bpms[-1] / 60.0
+        scene_rect = self.scene.sceneRect()
+        if now_tick + tps > scene_rect.right():
+            scene_rect.setRight(now_tick + tps * self.live_visible_seconds)
+            self.scene.setSceneRect(scene_rect)
+        visible_rect = self.mapToScene(self.viewport().rect()).boundingRect()
+        self.time_indicator.setLine(now_tick, visible_rect.top(), now_tick, visible_rect.bottom())
+        if now_tick > visible_rect.right() - visible_rect.width() * 0.1:
+            self.centerOn(now_tick + visible_rect.width() * 0.3, visible_rect.center().y())
+
+    def end_live_recording(self):
+        """结束实时显示，保留已绘制的音符直到录制内容被加载。"""
+        self.live_recording = False
+        self.live_open_items.clear()
+
     def _draw_piano_background(self):
         """(已废弃) 绘制钢琴卷帘的背景（琴键通道和分割线）。"""
         # # 这个函数现在只在完全重绘时调用一次。
@@ -360,9 +766,17 @@ class PianoRollView(QGraphicsView):
             midi_notes (list): miditoolkit.Note 对象的列表。
         """
         self.scene.clearSelection() # 清除当前所有选择
-        for item in self.note_items:
-            if hasattr(item, 'midi_note') and item.midi_note in midi_notes:
-                item.setSelected(True) # 选中对应的图形项
+        # 按对象查找（Note 按数值比较相等，列表的 in 既慢又会选中数值相同的其他音符）
+        note_ids = {id(note) for note in midi_notes}
+        # 逐个选中时屏蔽场景信号，最后只更新一次选中列表（否则每选中一个都重建列表，为平方复杂度）
+        self.scene.blockSignals(True)
+        try:
+            for item in self.note_items:
+                if hasattr(item, 'midi_note') and id(item.midi_note) in note_ids:
+                    item.setSelected(True) # 选中对应的图形项
+        finally:
+            self.scene.blockSignals(False)
+        self._on_selection_changed()
 
     def mousePressEvent(self, event):
         """处理鼠标按下事件。"""
@@ -389,6 +803,7 @@ class PianoRollView(QGraphicsView):
                         self._select_items_for_notes([top_item.midi_note]) # 只选中当前调整的音符
                     # 否则，是移动/选择操作
                     else:
+                        self.target_instrument_index = self._instrument_index(top_item.midi_instrument) # 之后粘贴到这个音符的乐器
                         self.setDragMode(QGraphicsView.NoDrag) # 【状态管理】禁用视图拖动
                         self.set_editing_mode('move_note') # 进入移动音符模式
                         # 处理选择逻辑 (Ctrl/Cmd 用于多选)
@@ -411,6 +826,8 @@ class PianoRollView(QGraphicsView):
         elif event.button() == QtCore.Qt.RightButton: # 右键按下
             if top_item: # 如果点击了音符
                 self._show_note_context_menu(top_item, event.globalPos()) # 显示音符上下文菜单
+            elif self._editable() and self.current_midi is not None:
+                self._show_paste_context_menu(event.globalPos()) # 显示粘贴菜单
             else:
                 super().mousePressEvent(event) # 将事件传递给父类
 
@@ -472,10 +889,13 @@ class PianoRollView(QGraphicsView):
                 delta_ticks = int(round(delta_x)) # 将 X 轴位移四舍五入为整数 tick
                 delta_pitch = -round(delta_y / self.base_key_height) # 将 Y 轴位移四舍五入为整数音高变化
 
+                # 同一组音符的连续拖动合并为一条撤销记录
+                edit = self.document.begin_edit("移动音符", coalesce_key='move')
                 for item in self.selected_notes_items:
                     original_state = self.drag_notes_original_state[item] # 获取音符的原始状态
                     note = item.midi_note
                     duration = original_state['end'] - original_state['start'] # 保持音符时长不变
+                    edit.change(item.midi_instrument, note) # 修改前记录原值
 
                     # 更新数据模型中的音符起始和结束时间
                     note.start = max(0, original_state['start'] + delta_ticks)
@@ -483,18 +903,22 @@ class PianoRollView(QGraphicsView):
                     # 更新数据模型中的音符音高
                     note.pitch = max(0, min(127, original_state['pitch'] + delta_pitch))
                 
-                # 操作结束后进行一次重绘，以确保视觉与数据完全同步
-                self.draw_midi(self.current_midi)
+                # 操作结束后按修改范围更新图形项，以确保视觉与数据完全同步
+                self._commit_edit(edit)
+                for item in self.selected_notes_items:
+                    item.setPos(0, 0) # 没有实际移动（位移不足一个 tick 或半个琴键）时也清除拖动偏移
                 self._select_items_for_notes(self.selected_miditoolkit_notes) # 重新选中音符
 
             elif self.editing_mode == 'resize_note_end' and self.resizing_note_item: # 调整音符长度模式
                 note = self.resizing_note_item.midi_note
                 new_end_tick = max(note.start + 10, int(scene_pos.x())) # 确保音符有最小长度
                 # 更新数据模型中的音符结束时间
+                edit = self.document.begin_edit("调整音符长度", coalesce_key='resize')
+                edit.change(self.resizing_note_item.midi_instrument, note)
                 note.end = new_end_tick
 
-                # 操作结束后进行一次重绘
-                self.draw_midi(self.current_midi)
+                # 操作结束后更新图形项
+                self._commit_edit(edit)
                 self._select_items_for_notes([note]) # 重新选中被调整的音符
         
         # 重置状态
@@ -509,6 +933,34 @@ class PianoRollView(QGraphicsView):
 
     # --- 音符操作方法 (逻辑基本不变, 但现在受益于高效的后端) ---
 
+    def _commit_edit(self, edit):
+        """
+        编辑操作修改数据模型后调用：提交编辑记录（记入撤销历史和修改日志），更新受影响的音符并通知主窗口。
+        参数:
+            edit (NoteEdit): 由 document.begin_edit 创建的编辑记录。
+        """
+        version = self.document.version
+        self.document.end_edit(edit)
+        self.refresh_notes()
+        if self.document.version != version: # 没有实际修改时不通知
+            self.document_changed.emit()
+
+    def _editable(self):
+        """返回当前文档是否可以编辑：流式模式只读，实时录制时场景中显示的不是文档。"""
+        return self.stream is None and not self.live_recording
+
+    def undo(self):
+        """撤销最近一次编辑。"""
+        if self._editable() and self.document is not None and self.document.undo() is not None:
+            self.refresh_notes()
+            self.document_changed.emit()
+
+    def redo(self):
+        """重做最近一次撤销的编辑。"""
+        if self._editable() and self.document is not None and self.document.redo() is not None:
+            self.refresh_notes()
+            self.document_changed.emit()
+
     def _add_new_note_interactively(self, start_tick, pitch):
         """
         在用户点击的位置添加一个新音符。
@@ -516,36 +968,37 @@ class PianoRollView(QGraphicsView):
             start_tick (int): 音符的起始 tick。
             pitch (int): 音符的音高。
         """
+        if not self._editable():
+            return # 流式模式只读，录制时不编辑
         if not self.current_midi:
             # 如果没有当前 MIDI 文件，则创建一个新的空 MIDI 文件
             self.current_midi = MidiFile(ticks_per_beat=480)
-            new_instrument = Instrument(program=0, is_drum=False, name='新乐器')
-            self.current_midi.instruments.append(new_instrument)
-            
+            self.document = MidiDocument(self.current_midi)
         default_duration = self.current_midi.ticks_per_beat # 默认持续时间为一拍
         new_note = Note(pitch=pitch, velocity=100, start=start_tick, end=start_tick + default_duration)
         
-        # 将音符添加到第一个乐器（或将来可选的乐器）
-        target_instrument = self.current_midi.instruments[0]
-        target_instrument.notes.append(new_note)
-        target_instrument.notes.sort(key=lambda x: x.start) # 保持音符按开始时间排序
+        # 将音符添加到目标乐器，二分查找插入位置，保持音符按开始时间排序
+        target_instrument = self._target_instrument()
+        edit = self.document.begin_edit("添加音符")
+        edit.insert(target_instrument, [new_note])
         
-        self.draw_midi(self.current_midi) # 重绘以显示新音符
+        self._commit_edit(edit) # 显示新音符
         self._select_items_for_notes([new_note]) # 自动选中新添加的音符
 
     def delete_selected_notes(self):
         """删除所有选中的音符。"""
-        if not self.selected_miditoolkit_notes or not self.current_midi:
+        if not self._editable() or not self.selected_miditoolkit_notes or not self.current_midi:
             return
 
-        notes_to_delete = list(self.selected_miditoolkit_notes) # 复制一份待删除音符列表
-        for note in notes_to_delete:
-            for instrument in self.current_midi.instruments:
-                if note in instrument.notes:
-                    instrument.notes.remove(note) # 从乐器中移除音符
-                    break
+        # 按乐器分组，每个乐器的音符列表只遍历一次（按对象删除，并记录位置以便撤销）
+        by_instrument = {}
+        for item in self.selected_notes_items:
+            by_instrument.setdefault(id(item.midi_instrument), (item.midi_instrument, []))[1].append(item.midi_note)
+        edit = self.document.begin_edit("删除音符")
+        for instrument, notes in by_instrument.values():
+            edit.remove(instrument, notes)
         
-        self.draw_midi(self.current_midi) # 删除后重绘
+        self._commit_edit(edit) # 移除被删除音符的图形项
 
     def quantize_selected_notes(self, subdivision_ticks=120):
         """
@@ -553,49 +1006,89 @@ class PianoRollView(QGraphicsView):
         参数:
             subdivision_ticks (int): 量化网格的 tick 间隔。
         """
-        if not self.selected_miditoolkit_notes: return
+        if not self._editable() or not self.selected_miditoolkit_notes: return
 
-        for note in self.selected_miditoolkit_notes:
+        edit = self.document.begin_edit("量化")
+        for item in self.selected_notes_items:
+            note = item.midi_note
             duration = note.end - note.start # 保持音符时长不变
             # 将开始时间吸附到最近的量化网格
             new_start = round(note.start / subdivision_ticks) * subdivision_ticks
+            edit.change(item.midi_instrument, note)
             note.start = int(new_start)
             note.end = int(new_start + duration)
         
-        self.draw_midi(self.current_midi) # 量化后重绘
+        self._commit_edit(edit) # 更新被移动的音符
         self._select_items_for_notes(self.selected_miditoolkit_notes) # 重新选中音符
 
+    def _instrument_index(self, instrument):
+        """返回乐器在当前文档中的序号（按对象查找，Instrument 按数值比较相等）。"""
+        return next(index for index, candidate in enumerate(self.current_midi.instruments) if candidate is instrument)
+
+    def _target_instrument(self):
+        """
+        返回粘贴和添加音符的目标乐器，文档还没有乐器时新建一个。
+        返回:
+            miditoolkit.Instrument: 目标乐器。
+        """
+        instruments = self.current_midi.instruments
+        if not instruments:
+            instruments.append(Instrument(program=0, is_drum=False, name='新乐器'))
+        self.target_instrument_index = max(0, min(self.target_instrument_index, len(instruments) - 1))
+        return instruments[self.target_instrument_index]
+
     def copy_selected_notes(self):
-        """复制选中的音符到内部剪贴板。"""
-        self.clipboard_notes = [note.copy() for note in self.selected_miditoolkit_notes] # 复制音符对象
+        """
+        将选中的音符复制到系统剪贴板（二进制格式和 MIDI 片段），可以粘贴到本程序的其他实例或宿主软件中。
+        """
+        if self.stream is not None or not self.selected_notes_items: return
+
+        instruments = self.current_midi.instruments
+        indices = {id(instrument): index for index, instrument in enumerate(instruments)}
+        columns = np.array([(item.midi_note.start, item.midi_note.end, item.midi_note.pitch, item.midi_note.velocity,
+                             indices[id(item.midi_instrument)]) for item in self.selected_notes_items], dtype=np.int64)
+        # MIDI 片段中写入第一个音符处的速度
+        first = int(columns[:, 0].min())
+        bpm = next((tc.tempo for tc in reversed(self.current_midi.tempo_changes) if tc.time <= first), 120)
+        clip = NoteClip.from_columns(columns, self.current_midi.ticks_per_beat,
+                                     [instrument.is_drum for instrument in instruments], bpm)
+        QApplication.clipboard().setMimeData(clip.to_mime_data())
 
     def paste_notes(self):
-        """从剪贴板粘贴音符。"""
-        if not self.clipboard_notes or not self.current_midi.instruments: return
-
-        # 粘贴到当前视图的左边缘位置
-        visible_scene_rect = self.mapToScene(self.viewport().rect()).boundingRect()
-        paste_time = max(0, int(visible_scene_rect.left())) # 粘贴的起始时间点
-        
-        # 找到剪贴板中最早的音符开始时间，以它为基准进行对齐
-        if not self.clipboard_notes: return
-        first_note_time = min(n.start for n in self.clipboard_notes)
-        time_offset = paste_time - first_note_time # 计算时间偏移量
+        """
+        从系统剪贴板粘贴音符：第一个音符对齐到播放头，放入目标乐器。
+        剪贴板中的音符来自多个乐器时，依次放入目标乐器及其后的乐器（超出时放入最后一个乐器）。
+        """
+        if not self._editable(): return # 流式模式只读，录制时不编辑
+        try:
+            clip = NoteClip.from_mime_data(QApplication.clipboard().mimeData())
+        except ValueError:
+            return # 剪贴板中的数据无法识别
+        if not clip: return
+        if not self.current_midi:
+            # 如果没有当前 MIDI 文件，则创建一个新的空 MIDI 文件
+            self.current_midi = MidiFile(ticks_per_beat=480)
+            self.document = MidiDocument(self.current_midi)
+
+        self._target_instrument()
+        clip = clip.rescaled(self.current_midi.ticks_per_beat) # 换算到当前文档的分辨率
+        notes = clip.notes
+        starts = notes['start'].astype(np.int64) + self.playhead_tick
+        ends = (starts + notes['duration']).tolist()
+        starts = starts.tolist()
+        pitches, velocities = notes['pitch'].tolist(), notes['velocity'].tolist()
+        tracks = np.minimum(notes['track'].astype(np.int64) + self.target_instrument_index,
+                            len(self.current_midi.instruments) - 1)
 
         newly_pasted_notes = [] # 存储新粘贴的音符
-        target_instrument = self.current_midi.instruments[0] # 目标乐器 (第一个乐器)
-
-        for note_copy in self.clipboard_notes:
-            new_note = note_copy.copy() # 复制音符
-            duration = new_note.end - new_note.start # 获取原始音符时长
-            new_note.start = new_note.start + time_offset # 应用时间偏移
-            new_note.end = new_note.start + duration # 更新结束时间
-            
-            target_instrument.notes.append(new_note) # 将新音符添加到目标乐器
-            newly_pasted_notes.append(new_note)
-        
-        target_instrument.notes.sort(key=lambda x: x.start) # 保持排序
-        self.draw_midi(self.current_midi) # 粘贴后重绘
+        edit = self.document.begin_edit("粘贴")
+        for track in np.unique(tracks).tolist():
+            selected = np.flatnonzero(tracks == track).tolist()
+            pasted = [Note(velocity=velocities[i], pitch=pitches[i], start=starts[i], end=ends[i]) for i in selected]
+            # 一次性按开始时间插入目标乐器（大批量时与原列表归并，不重新排序整个列表）
+            edit.insert(self.current_midi.instruments[track], pasted)
+            newly_pasted_notes.extend(pasted)
+        self._commit_edit(edit) # 显示粘贴的音符
         self._select_items_for_notes(newly_pasted_notes) # 选中新粘贴的音符
 
     def adjust_selected_notes_velocity(self, delta_velocity):
@@ -604,13 +1097,46 @@ class PianoRollView(QGraphicsView):
         参数:
             delta_velocity (int): 力度的变化量。
         """
-        if not self.selected_miditoolkit_notes: return
+        if not self._editable() or not self.selected_miditoolkit_notes: return
         
-        for note in self.selected_miditoolkit_notes:
+        # 连续调整同一组音符的力度合并为一条撤销记录
+        edit = self.document.begin_edit("调整力度", coalesce_key='velocity')
+        for item in self.selected_notes_items:
+            note = item.midi_note
+            edit.change(item.midi_instrument, note)
             note.velocity = max(1, min(127, note.velocity + delta_velocity)) # 调整力度，限制在 1-127 之间
-        # 注意：如果需要根据力度改变颜色，需要调用重绘
-        # self.draw_midi(self.current_midi)
-        # self._select_items_for_notes(self.selected_miditoolkit_notes)
+        self._commit_edit(edit) # 力度不影响音符位置，图形项不会被重建
+
+    def repair_overlapping_notes(self, mode='truncate'):
+        """
+        一次性修复所有同音高重叠的音符（整体作为一次编辑，只更新一次视图）。
+        参数:
+            mode (str): 'truncate' 截断、'merge' 合并或 'drop' 删除，见 midianalysis.repair_overlaps。
+        返回:
+            tuple: (修改了结束位置的音符数, 删除的音符数)。
+        """
+        if not self._editable() or self.document is None:
+            return 0, 0 # 流式模式只读，录制时不编辑
+        notes = self.document.notes()
+        new_end, keep = repair_overlaps(notes['start'], notes['end'], notes['pitch'], notes['instrument'], mode)
+        changed = np.flatnonzero((new_end != notes['end']) & keep)
+        removed = len(keep) - int(np.count_nonzero(keep))
+        if not len(changed) and not removed:
+            return 0, 0
+
+        # 列式视图与各乐器的音符列表按相同顺序排列，按下标写回
+        flat_notes = [note for instrument in self.current_midi.instruments for note in instrument.notes]
+        instrument_indices = notes['instrument'].tolist()
+        edit = self.document.begin_edit("修复重叠音符")
+        for index, end in zip(changed.tolist(), new_end[changed].tolist()):
+            edit.change(instrument_indices[index], flat_notes[index])
+            flat_notes[index].end = end
+        dropped = np.flatnonzero(~keep)
+        for instrument in np.unique(notes['instrument'][dropped]).tolist():
+            edit.remove(instrument, [flat_notes[index] for index in dropped[notes['instrument'][dropped] == instrument].tolist()])
+
+        self._commit_edit(edit)
+        return len(changed), removed
 
     def _show_note_context_menu(self, clicked_item, global_pos):
         """
@@ -637,6 +1163,26 @@ class PianoRollView(QGraphicsView):
         elif action == velocity_up_action: self.adjust_selected_notes_velocity(10)
         elif action == velocity_down_action: self.adjust_selected_notes_velocity(-10)
 
+    def _show_paste_context_menu(self, global_pos):
+        """
+        在空白处显示右键菜单：粘贴到播放头，或选择粘贴和添加音符的目标乐器。
+        参数:
+            global_pos (QtCore.QPoint): 鼠标的全局屏幕坐标。
+        """
+        menu = QMenu(self)
+        paste_action = menu.addAction("粘贴到播放头")
+        track_menu = menu.addMenu("目标音轨")
+        track_actions = {}
+        for index, instrument in enumerate(self.current_midi.instruments):
+            track_action = track_menu.addAction(f"{index}: {instrument.name or '未命名'}")
+            track_action.setCheckable(True)
+            track_action.setChecked(index == self.target_instrument_index)
+            track_actions[track_action] = index
+
+        action = menu.exec_(global_pos)
+        if action == paste_action: self.paste_notes()
+        elif action in track_actions: self.target_instrument_index = track_actions[action]
+
     def set_editing_mode(self, mode):
         """
         设置当前的编辑模式并更新光标样式。
@@ -658,6 +1204,10 @@ class PianoRollView(QGraphicsView):
         if event.key() == QtCore.Qt.Key_Delete or event.key() == QtCore.Qt.Key_Backspace:
             self.delete_selected_notes() # 删除选中音符
         # 使用标准的 QKeySequence，可以更好地兼容不同操作系统 (例如 macOS 上的 Cmd+C)
+        elif event.matches(QKeySequence.Undo):
+            self.undo() # 撤销
+        elif event.matches(QKeySequence.Redo):
+            self.redo() # 重做
         elif event.matches(QKeySequence.Copy):
             self.copy_selected_notes() # 复制选中音符
         elif event.matches(QKeySequence.Cut):
@@ -666,9 +1216,10 @@ class PianoRollView(QGraphicsView):
         elif event.matches(QKeySequence.Paste):
             self.paste_notes() # 粘贴音符
         elif event.matches(QKeySequence.SelectAll):
-             # 全选所有音符
-             all_notes = [note for i in self.current_midi.instruments for note in i.notes]
-             self._select_items_for_notes(all_notes)
+            # 全选所有音符（流式模式下没有可选中的文档）
+            if self.stream is None and self.current_midi is not None:
+                all_notes = [note for i in self.current_midi.instruments for note in i.notes]
+                self._select_items_for_notes(all_notes)
         elif event.key() == QtCore.Qt.Key_Q:
             self.quantize_selected_notes() # 量化选中音符
         else:
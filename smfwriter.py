@@ -0,0 +1,163 @@
+import struct
+import numpy as np
+
+'''
+这是一个流式的标准 MIDI 文件 (SMF) 写入模块。
+音轨内容直接按事件写入文件，写完后再回填音轨长度，
+因此导出时不需要在内存中构建完整的 MidiFile 对象。
+'''
+
+
+def encode_varlen(value):
+    """
+    将整数编码为 MIDI 可变长度数值。
+    参数:
+        value (int): 非负整数 (最大 0x0FFFFFFF)。
+    返回:
+        bytes: 编码后的字节。
+    """
+    value = int(value)
+    if value < 0:
+        value = 0
+    buffer = [value & 0x7F]
+    value >>= 7
+    while value:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(buffer))
+
+
+def encode_channel_events(ticks, status, data1, data2, start_tick=0):
+    """
+    将按时间排序的一批通道消息一次性编码为音轨字节（向量化，使用运行状态）。
+    参数:
+        ticks (numpy.ndarray): 每个事件的绝对 tick（非递减）。
+        status (numpy.ndarray): 状态字节 (0x80-0xEF)。
+        data1 (numpy.ndarray): 第一个数据字节。
+        data2 (numpy.ndarray): 第二个数据字节（程序变更和通道触后忽略）。
+        start_tick (int): 音轨中上一个事件的 tick，第一个事件的间隔从这里算起。
+    返回:
+        bytes: 编码后的字节（第一个事件总是带状态字节）。
+    """
+    count = len(ticks)
+    if not count:
+        return b''
+    ticks = np.asarray(ticks, dtype=np.int64)
+    status = np.asarray(status, dtype=np.uint8)
+    deltas = np.diff(ticks, prepend=np.int64(start_tick)).clip(0, 0x0FFFFFFF)
+    # 可变长度数值的字节数 (1-4)
+    var_len = 1 + (deltas >= 1 << 7) + (deltas >= 1 << 14) + (deltas >= 1 << 21)
+    # 与上一事件状态相同时省略状态字节（运行状态）
+    with_status = np.ones(count, dtype=bool)
+    with_status[1:] = status[1:] != status[:-1]
+    two_data = (status & 0xE0) != 0xC0  # 0xC0 程序变更、0xD0 通道触后只有一个数据字节
+    sizes = var_len + with_status + 1 + two_data
+    offsets = np.zeros(count, dtype=np.int64)
+    np.cumsum(sizes[:-1], out=offsets[1:])
+    out = np.empty(int(offsets[-1] + sizes[-1]), dtype=np.uint8)
+    for k in range(4):
+        selected = var_len > k
+        shift = 7 * (var_len[selected] - 1 - k)
+        more = np.where(k < var_len[selected] - 1, 0x80, 0)
+        out[offsets[selected] + k] = ((deltas[selected] >> shift) & 0x7F) | more
+    position = offsets + var_len
+    out[position[with_status]] = status[with_status]
+    position += with_status
+    out[position] = np.asarray(data1, dtype=np.uint8)
+    out[position[two_data] + 1] = np.asarray(data2, dtype=np.uint8)[two_data]
+    return out.tobytes()
+
+
+class SmfWriter:
+    """
+    流式 SMF 写入器。用法:
+        with open(path, 'wb') as f:
+            writer = SmfWriter(f, ticks_per_beat=480, num_tracks=1)
+            writer.begin_track()
+            writer.write_event(delta_ticks, message_bytes)
+            writer.end_track()
+    文件对象必须支持 seek，以便在音轨结束时回填长度。
+    """
+    def __init__(self, fileobj, ticks_per_beat=480, num_tracks=1, midi_format=None):
+        """
+        参数:
+            fileobj: 以二进制写模式打开的文件对象。
+            ticks_per_beat (int): 每拍的刻度数。
+            num_tracks (int): 将要写入的音轨数。
+            midi_format (int, optional): SMF 格式 (0 或 1)，默认单音轨为 0，多音轨为 1。
+        """
+        if midi_format is None:
+            midi_format = 0 if num_tracks == 1 else 1
+        self.file = fileobj
+        self.file.write(b'MThd' + struct.pack('>IHHH', 6, midi_format, num_tracks, ticks_per_beat))
+        self._track_length_pos = None
+        self._track_start = None
+        self._buffer = bytearray()
+
+    def begin_track(self):
+        """开始写入一条新音轨（写入占位长度）。"""
+        self.file.write(b'MTrk')
+        self._track_length_pos = self.file.tell()
+        self.file.write(b'\x00\x00\x00\x00')
+        self._track_start = self.file.tell()
+        self._buffer = bytearray()
+
+    def write_event(self, delta_ticks, message_bytes):
+        """
+        写入一条通道消息。
+        参数:
+            delta_ticks (int): 与上一事件的间隔 tick。
+            message_bytes (bytes or list): MIDI 消息字节。
+        """
+        self._buffer += encode_varlen(delta_ticks)
+        self._buffer += bytes(message_bytes)
+        if len(self._buffer) >= 1 << 16:
+            self.flush()
+
+    def write_encoded(self, data):
+        """
+        写入已编码的音轨字节（如 encode_channel_events 的结果）。
+        参数:
+            data (bytes): 音轨字节。
+        """
+        self.flush()
+        self.file.write(data)
+
+    def write_meta(self, delta_ticks, meta_type, data=b''):
+        """
+        写入一条元事件。
+        参数:
+            delta_ticks (int): 与上一事件的间隔 tick。
+            meta_type (int): 元事件类型 (如 0x51 表示速度)。
+            data (bytes): 元事件数据。
+        """
+        self._buffer += encode_varlen(delta_ticks)
+        self._buffer += bytes((0xFF, meta_type))
+        self._buffer += encode_varlen(len(data))
+        self._buffer += bytes(data)
+
+    def write_tempo(self, delta_ticks, tempo):
+        """
+        写入速度元事件。
+        参数:
+            delta_ticks (int): 与上一事件的间隔 tick。
+            tempo (int): 每拍的微秒数。
+        """
+        self.write_meta(delta_ticks, 0x51, int(tempo).to_bytes(3, 'big'))
+
+    def flush(self):
+        """将缓冲的事件写入文件。"""
+        if self._buffer:
+            self.file.write(self._buffer)
+            self._buffer = bytearray()
+
+    def end_track(self, delta_ticks=0):
+        """写入音轨结束事件并回填音轨长度。"""
+        self.write_meta(delta_ticks, 0x2F)
+        self.flush()
+        end = self.file.tell()
+        self.file.seek(self._track_length_pos)
+        self.file.write(struct.pack('>I', end - self._track_start))
+        self.file.seek(end)
+        self._track_length_pos = None
+        self._track_start = None
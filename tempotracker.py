@@ -0,0 +1,291 @@
+import math
+from collections import deque
+import numpy as np
+
+'''
+这是录制时的在线速度跟踪模块。
+录制过程中逐个输入音符起音时间，根据起音间隔估计拍长，并用锁相方式跟踪节拍位置，
+录制结束后生成速度图 (TempoMap)，使导出文档的网格与演奏对齐。
+'''
+
+
+class TempoMap:
+    """
+    分段恒定的速度图。每段由起始时间（秒）、起始拍位置和 BPM 描述，
+    段的起点都落在整数拍上，因此换算出的 tick 网格与节拍对齐。
+    """
+    def __init__(self, times, beats, bpms):
+        """
+        参数:
+            times (list): 各段起始时间（秒），第一段从 0 开始，严格递增。
+            beats (list): 各段起始的拍位置。
+            bpms (list): 各段的 BPM。
+        """
+        self.times = np.asarray(times, dtype=np.float64)
+        self.beats = np.asarray(beats, dtype=np.float64)
+        self.bpms = np.asarray(bpms, dtype=np.float64)
+
+    @classmethod
+    def constant(cls, bpm):
+        """返回只有一个固定速度的速度图。"""
+        return cls([0.0], [0.0], [float(bpm)])
+
+    @classmethod
+    def from_tempo_changes(cls, tempo_changes, ticks_per_beat):
+        """
+        由文档的速度变化构建速度图。
+        参数:
+            tempo_changes (list): [(tick, bpm), ...]；第一个速度变化之前按 120 BPM 计算。
+            ticks_per_beat (int): 每拍的刻度数。
+        返回:
+            TempoMap: 速度图。
+        """
+        changes = sorted((int(tick), float(bpm)) for tick, bpm in tempo_changes if bpm > 0)
+        if not changes or changes[0][0] > 0:
+            changes.insert(0, (0, 120.0))
+        ticks_per_beat = max(ticks_per_beat, 1)
+        times, beats, bpms = [], [], []
+        seconds = 0.0
+        for i, (tick, bpm) in enumerate(changes):
+            if i and tick == changes[i - 1][0]:
+                bpms[-1] = bpm  # 同一 tick 上的多个速度以最后一个为准
+                continue
+            if i:
+                seconds += (tick - changes[i - 1][0]) / ticks_per_beat * 60.0 / bpms[-1]
+            times.append(seconds)
+            beats.append(tick / ticks_per_beat)
+            bpms.append(bpm)
+        return cls(times, beats, bpms)
+
+    def seconds_to_ticks(self, seconds, ticks_per_beat):
+        """
+        将时间（秒）批量换算为 tick。
+        参数:
+            seconds (numpy.ndarray): 时间数组（秒）。
+            ticks_per_beat (int): 每拍的刻度数。
+        返回:
+            numpy.ndarray: 非负的 int64 tick 数组。
+        """
+        seconds = np.asarray(seconds, dtype=np.float64)
+        index = np.maximum(np.searchsorted(self.times, seconds, side='right') - 1, 0)
+        beats = self.beats[index] + (seconds - self.times[index]) * self.bpms[index] / 60.0
+        return np.maximum(np.rint(beats * ticks_per_beat).astype(np.int64), 0)
+
+    def ticks_to_seconds(self, ticks, ticks_per_beat):
+        """
+        将 tick 批量换算为时间（秒）。
+        参数:
+            ticks (numpy.ndarray or int): tick 数组或单个 tick。
+            ticks_per_beat (int): 每拍的刻度数。
+        返回:
+            numpy.ndarray or float: 时间（秒）。
+        """
+        beats = np.asarray(ticks, dtype=np.float64) / ticks_per_beat
+        index = np.maximum(np.searchsorted(self.beats, beats, side='right') - 1, 0)
+        return self.times[index] + (beats - self.beats[index]) * 60.0 / self.bpms[index]
+
+    def tempo_changes(self, ticks_per_beat):
+        """
+        返回:
+            list: [(tick, bpm), ...]，每段一个速度变化。
+        """
+        ticks = np.rint(self.beats * ticks_per_beat).astype(np.int64)
+        return list(zip(ticks.tolist(), self.bpms.tolist()))
+
+    def __len__(self):
+        return len(self.times)
+
+
+class TempoTracker:
+    """
+    基于起音的在线速度跟踪器，每个起音的处理代价有上限（与 history 和 bins 成正比）。
+    - 每个起音与最近 history 个起音的间隔对候选拍长（对数刻度分箱）打分：间隔接近候选拍长的
+      n 倍 (n = 1..4) 时得分 1/n，分数累加到按起音指数衰减的直方图中；
+      峰值（乘以偏向中等速度的先验）即拍长估计。
+    - 起音数达到 lock_onsets 后锁定节拍：从最近的起音中选出与网格吻合最多的作为相位起点，
+      之后每个落在预测拍点附近的起音都会修正相位和拍长；直方图估计持续偏离当前拍长时切换到新速度。
+    """
+    def __init__(self, initial_bpm=120, min_bpm=40, max_bpm=240, history=12, chord_window=0.05,
+                 bins=120, decay=0.9, sharpness=0.08, lock_onsets=6, window=0.2, phase_gain=0.3, period_gain=0.1,
+                 change_threshold=0.08, change_onsets=4, tolerance=0.05):
+        """
+        参数:
+            initial_bpm (float): 起音不足以锁定节拍时使用的速度。
+            min_bpm, max_bpm (float): 速度估计的范围。
+            history (int): 参与间隔投票的最近起音数。
+            chord_window (float): 间隔小于该值（秒）的起音视为同一和弦，只计一次。
+            bins (int): 拍长直方图的分箱数。
+            decay (float): 每个起音对直方图的衰减系数。
+            sharpness (float): 间隔与拍长整数倍的相对偏差容忍度（高斯宽度）。
+            lock_onsets (int): 锁定节拍所需的起音数。
+            window (float): 起音距预测拍点不超过 window 拍时用于修正相位。
+            phase_gain, period_gain (float): 相位与拍长的修正系数。
+            change_threshold (float): 直方图估计与当前拍长的相对偏差超过该值视为速度变化。
+            change_onsets (int): 连续多少个起音偏离后切换速度。
+            tolerance (float): 生成速度图时，合并后各拍位置偏差都不超过该值（拍）的相邻拍合并为一段。
+        """
+        self.initial_bpm = initial_bpm
+        self.min_period = 60.0 / max_bpm
+        self.max_period = 60.0 / min_bpm
+        self.history = history
+        self.chord_window = chord_window
+        self.decay = decay
+        self.sharpness = sharpness
+        self.lock_onsets = lock_onsets
+        self.window = window
+        self.phase_gain = phase_gain
+        self.period_gain = period_gain
+        self.change_threshold = change_threshold
+        self.change_onsets = change_onsets
+        self.tolerance = tolerance
+        self._log_min = math.log(self.min_period)
+        self._log_step = (math.log(self.max_period) - self._log_min) / bins
+        self._centers = np.exp(self._log_min + (np.arange(bins) + 0.5) * self._log_step)
+        self._hist = np.zeros(bins)
+        # 偏向 120 BPM 附近的对数高斯先验，减少倍频/半频误判
+        self._prior = np.exp(-0.5 * (np.log2(self._centers / 0.5) / 1.0) ** 2)
+        self.reset()
+
+    def reset(self):
+        """清除所有状态，开始新的录制时调用。"""
+        self._onsets = deque(maxlen=self.history)
+        self._hist[:] = 0
+        self.onset_count = 0
+        self.period = None  # 锁定后的拍长（秒），None 表示尚未锁定
+        self._next_beat = None  # 下一个预测拍点（秒）
+        self._deviations = 0  # 直方图估计连续偏离当前拍长的起音数
+        self.beats = []  # 已确认的拍点时间（秒）
+
+    @property
+    def bpm(self):
+        """当前速度估计，未锁定时为 initial_bpm。"""
+        return 60.0 / self.period if self.period else self.initial_bpm
+
+    def _histogram_period(self):
+        """返回直方图（乘以先验）峰值对应的拍长（秒）。"""
+        return float(self._centers[int(np.argmax(self._hist * self._prior))])
+
+    def feed(self, onset_time):
+        """
+        输入一个起音时间。
+        参数:
+            onset_time (float): 起音时间（秒），按时间顺序输入。
+        """
+        if self._onsets and onset_time - self._onsets[-1] < self.chord_window:
+            return
+        self._hist *= self.decay
+        intervals = onset_time - np.fromiter(reversed(self._onsets), dtype=np.float64, count=len(self._onsets))
+        intervals = intervals[intervals <= 4 * self.max_period]
+        if len(intervals):
+            # 行: 间隔（越近的起音权重越大）; 列: 候选拍长
+            ratio = intervals[:, None] / self._centers[None, :]
+            multiple = np.rint(ratio)
+            valid = (multiple >= 1) & (multiple <= 4)
+            multiple = np.maximum(multiple, 1)
+            score = np.exp(-0.5 * ((ratio - multiple) / (self.sharpness * multiple)) ** 2) / multiple
+            weight = 1.0 / np.arange(1, len(intervals) + 1)
+            self._hist += (np.where(valid, score, 0.0) * weight[:, None]).sum(axis=0)
+        self._onsets.append(onset_time)
+        self.onset_count += 1
+
+        if self.period is None:
+            if self.onset_count >= self.lock_onsets:
+                self._lock()
+            return
+
+        period = self.period
+        while self._next_beat + period / 2 < onset_time:
+            self.beats.append(self._next_beat)
+            self._next_beat += period
+        error = onset_time - self._next_beat
+        if abs(error) <= self.window * period:
+            self._next_beat += self.phase_gain * error
+            self.period = min(max(period + self.period_gain * error, self.min_period), self.max_period)
+
+        # 直方图估计折叠到当前拍长附近（消除倍频歧义）后比较
+        estimate = self._histogram_period()
+        while estimate > self.period * math.sqrt(2):
+            estimate /= 2.0
+        while estimate < self.period / math.sqrt(2):
+            estimate *= 2.0
+        if abs(estimate - self.period) / self.period > self.change_threshold:
+            self._deviations += 1
+            if self._deviations >= self.change_onsets:
+                # 速度突变：采用新拍长，并按最近的起音重新确定相位
+                self.period = min(max(estimate, self.min_period), self.max_period)
+                anchor = self._best_anchor(self.period)
+                self._next_beat = anchor + self.period * math.ceil((onset_time - anchor) / self.period - 0.5)
+                if self.beats and self._next_beat - self.beats[-1] < self.period / 2:
+                    self._next_beat = self.beats[-1] + self.period
+                self._deviations = 0
+        else:
+            self._deviations = 0
+
+    def _best_anchor(self, period):
+        """返回最近的起音中，以其为拍点时与拍长网格吻合的起音最多的一个。"""
+        onsets = list(self._onsets)
+        best_anchor, best_score = onsets[-1], -1
+        for anchor in reversed(onsets):
+            phase = [(t - anchor) / period for t in onsets]
+            score = sum(1 for p in phase if abs(p - round(p)) <= self.window)
+            if score > best_score:
+                best_anchor, best_score = anchor, score
+        return best_anchor
+
+    def _lock(self):
+        """锁定节拍：按直方图拍长和最佳相位建立网格，并向前补齐拍点。"""
+        period = self._histogram_period()
+        onsets = list(self._onsets)
+        best_anchor = self._best_anchor(period)
+        self.period = period
+        first = best_anchor - period * math.floor((best_anchor - onsets[0]) / period + self.window)
+        beat = max(first, 0.0)
+        while beat + period / 2 < onsets[-1]:
+            self.beats.append(beat)
+            beat += period
+        self._next_beat = beat
+
+    def tempo_map(self, end_time=None):
+        """
+        根据已确认的拍点生成速度图。
+        参数:
+            end_time (float, optional): 录制结束时间，用于补齐到结束为止的拍点。
+        返回:
+            TempoMap: 速度图；起音不足以锁定节拍时为 initial_bpm 的固定速度。
+        """
+        beats = list(self.beats)
+        if self.period is not None:
+            beat = self._next_beat
+            last = end_time if end_time is not None else (self._onsets[-1] if self._onsets else beat)
+            while beat <= last:
+                beats.append(beat)
+                beat += self.period
+        if len(beats) < 2:
+            return TempoMap.constant(self.bpm)
+        beats = np.asarray(beats)
+        first_interval = beats[1] - beats[0]
+        if beats[0] < first_interval / 2 and len(beats) > 2:
+            beats = beats[1:]  # 第一拍离起点太近，并入前导段
+        # 前导段: 从 0 到第一拍，取整数拍，使第一拍落在网格上
+        lead = max(1, int(round(beats[0] / (beats[1] - beats[0]))))
+        times = np.concatenate(([0.0], beats))
+        positions = np.concatenate(([0.0], lead + np.arange(len(beats), dtype=np.float64)))
+
+        seg_times, seg_beats, seg_bpms = [], [], []
+        start = 0
+        while start < len(times) - 1:
+            end = start + 1
+            bpm = 60.0 * (positions[end] - positions[start]) / (times[end] - times[start])
+            while end < len(times) - 1:
+                candidate = 60.0 * (positions[end + 1] - positions[start]) / (times[end + 1] - times[start])
+                # 以平均速度线性换算时，段内每一拍的位置偏差都不能超过 tolerance
+                predicted = positions[start] + (times[start:end + 2] - times[start]) * candidate / 60.0
+                if np.max(np.abs(predicted - positions[start:end + 2])) > self.tolerance:
+                    break
+                end += 1
+                bpm = candidate
+            seg_times.append(times[start])
+            seg_beats.append(positions[start])
+            seg_bpms.append(bpm)
+            start = end
+        return TempoMap(seg_times, seg_beats, seg_bpms)
@@ -0,0 +1,120 @@
+import os
+import struct
+import zlib
+import numpy as np
+from mididocument import write_atomically
+
+'''
+这是钢琴卷帘缩略图模块。
+在不使用 Qt 的情况下（可在工作进程中运行）把音符按密度分箱绘制为固定大小的图片：
+每个像素统计覆盖它的音符数，按对数密度把钢琴卷帘的音符颜色叠加到背景色上，编码为 PNG。
+缩略图按文件内容哈希缓存，内容相同的文件共用一张图。
+'''
+
+THUMBNAIL_WIDTH = 160
+THUMBNAIL_HEIGHT = 48
+DRUM_CHANNEL = 9
+
+# 与 PianoRollView 一致的颜色
+BACKGROUND_COLOR = np.array([232, 232, 232], dtype=np.float64)
+NOTE_COLOR = np.array([30, 100, 200], dtype=np.float64)
+DRUM_COLOR = np.array([200, 50, 50], dtype=np.float64)
+
+
+def thumbnail_path(cache_dir, content_hash):
+    """返回内容哈希对应的缩略图路径。"""
+    return os.path.join(cache_dir, content_hash + '.png')
+
+
+def _density(notes, end_tick, low, high, width, height):
+    """
+    统计每个像素被多少个音符覆盖（向量化的区间累加）。
+    返回:
+        numpy.ndarray: (height, width) 的计数。
+    """
+    scale = width / max(end_tick, 1)
+    first = np.clip((notes['start'] * scale).astype(np.int64), 0, width - 1)
+    last = np.clip((np.maximum(notes['end'] - 1, notes['start']) * scale).astype(np.int64), 0, width - 1)
+    rows = ((high - notes['pitch'].astype(np.int64)) * height // (high - low + 1)).clip(0, height - 1)
+    # 差分数组：区间起点 +1，终点后一格 -1，按行累加得到覆盖数
+    diff = np.zeros((height, width + 1), dtype=np.int64)
+    np.add.at(diff, (rows, first), 1)
+    np.add.at(diff, (rows, last + 1), -1)
+    return np.cumsum(diff[:, :width], axis=1)
+
+
+def shade(image, density, color):
+    """
+    按对数密度把音符颜色叠加到图像上（原地修改）：单个音符约 0.7 的不透明度，越密越接近不透明。
+    参数:
+        image (numpy.ndarray): (height, width, 3) 的 float64 图像。
+        density (numpy.ndarray): (height, width) 的覆盖数。
+        color (numpy.ndarray): RGB 颜色。
+    """
+    alpha = np.where(density > 0, 0.55 + 0.45 * np.log1p(density) / np.log1p(max(density.max(), 1)), 0)
+    image += alpha[..., None] * (color - image)
+
+
+def render_thumbnail(notes, width=THUMBNAIL_WIDTH, height=THUMBNAIL_HEIGHT):
+    """
+    将音符按密度分箱绘制为缩略图。
+    参数:
+        notes (numpy.ndarray): 带 start、end、pitch 字段的音符数组（可带 channel 字段区分鼓组）。
+        width (int): 宽度（像素）。
+        height (int): 高度（像素）。
+    返回:
+        numpy.ndarray: (height, width, 3) 的 uint8 RGB 图像。
+    """
+    image = np.empty((height, width, 3), dtype=np.float64)
+    image[:] = BACKGROUND_COLOR
+    if not len(notes):
+        return image.astype(np.uint8)
+    end_tick = int(notes['end'].max())
+    # 纵向显示实际音高范围（上下各留半个八度）
+    low = max(0, int(notes['pitch'].min()) - 6)
+    high = min(127, int(notes['pitch'].max()) + 6)
+    is_drum = notes['channel'] == DRUM_CHANNEL if 'channel' in notes.dtype.names else np.zeros(len(notes), bool)
+    for selected, color in ((~is_drum, NOTE_COLOR), (is_drum, DRUM_COLOR)):
+        if not selected.any():
+            continue
+        shade(image, _density(notes[selected], end_tick, low, high, width, height), color)
+    return np.rint(image).astype(np.uint8)
+
+
+def encode_png(image):
+    """
+    将 RGB 图像编码为 PNG（只使用标准库）。
+    参数:
+        image (numpy.ndarray): (height, width, 3) 的 uint8 图像。
+    返回:
+        bytes: PNG 文件内容。
+    """
+    height, width = image.shape[:2]
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    # 每行前加过滤类型 0（不过滤）
+    raw = np.concatenate((np.zeros((height, 1), dtype=np.uint8), image.reshape(height, width * 3)), axis=1)
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw.tobytes(), 6))
+            + chunk(b'IEND', b''))
+
+
+def save_thumbnail(notes, cache_dir, content_hash):
+    """
+    绘制缩略图并保存到缓存（已存在时跳过）。
+    参数:
+        notes (numpy.ndarray): 音符数组。
+        cache_dir (str): 缓存目录。
+        content_hash (str): 文件内容哈希。
+    返回:
+        str: 缩略图路径。
+    """
+    path = thumbnail_path(cache_dir, content_hash)
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        data = encode_png(render_thumbnail(notes))
+        write_atomically(path, lambda f: f.write(data))
+    return path